@@ -6,3 +6,6 @@ from .log import log
 from .error import format_error
 from .log import log
 from .input_repo import input_repo
+from .sweep import sweep
+from .recover import recover
+from .sync import sync
@@ -1,2 +1,3 @@
 from .ai_repo import AIRepo
 from .ai_repo_log import RecursiveLog, build_log
+from .repo_pool import RepositoryPool, open_repository, release_repositories
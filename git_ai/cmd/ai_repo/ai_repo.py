@@ -1,18 +1,20 @@
 import json
 import os
+import shutil
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Iterator, Optional, Union
 
 import pygit2
 from pygit2 import AlreadyExistsError, Repository, discover_repository
 
 from git_ai.errors.errors import AlreadyInitializedError, CommitError, CommitSignatureError
 from .ai_repo_config import AIRepoConfig, InputRepo
-from .ai_repo_log import RecursiveLog, build_log
+from .ai_repo_log import RecursiveLog, build_log, iter_log
 from git_ai.cmd.constants import AIRepoConstants
 from git_ai.errors import CorruptedRepoError
 from ...utils import list_path
 from .credentials import Credentials
+from .repo_pool import open_repository
 
 from git_ai.pygitutils import get_repo_log, read_config
 
@@ -27,28 +29,37 @@ class AIRepo(Repository, AIRepoConstants):
         self.credentials.auth_operation(
             self.remotes[remote].url, lambda cred: self.remotes[remote].fetch(callbacks=cred))
 
-    def auth_and_push(self, remote, qualified_branch):
+    def auth_and_ls_remotes(self, remote) -> list[str]:
+        """Lists the references of a remote without fetching any object."""
+        heads = self.credentials.auth_operation(
+            self.remotes[remote].url, lambda cred: self.remotes[remote].ls_remotes(callbacks=cred))
+        return [h['name'] for h in heads]
+
+    def auth_and_push(self, remote, qualified_branch, force: bool = False):
+        refspec = f"{'+' if force else ''}{qualified_branch}:{qualified_branch}"
         self.credentials.auth_operation(self.remotes[remote].url, lambda cred: self.remotes[remote].push(
-            [f"{qualified_branch}:{qualified_branch}"], callbacks=cred))
+            [refspec], callbacks=cred))
 
     def remove_ai_dirs(self):
         try:
-            os.rmdir(self.GIT_AI_ROOT)
+            os.rmdir(Path(self.workdir) / self.GIT_AI_ROOT)
         except:
             pass
 
     def make_ai_dirs(self):
-        os.makedirs(self.GIT_AI_ROOT, exist_ok=True)
-        os.makedirs(self.METRICS_PATH, exist_ok=True)
-        os.makedirs(self.ARTIFACT_PATH, exist_ok=True)
+        workdir = Path(self.workdir)
+        os.makedirs(workdir / self.GIT_AI_ROOT, exist_ok=True)
+        os.makedirs(workdir / self.METRICS_PATH, exist_ok=True)
+        os.makedirs(workdir / self.ARTIFACT_PATH, exist_ok=True)
 
     def init_ai_repo(self):
-        if os.path.isfile(self.CONFIG_PATH):
+        config_path = Path(self.workdir) / self.CONFIG_PATH
+        if os.path.isfile(config_path):
             AlreadyInitializedError.repository_already_initialized()
 
         self.make_ai_dirs()
 
-        if os.path.isfile(self.CONFIG_PATH):
+        if os.path.isfile(config_path):
             if self.CONFIG_PATH in self.index:
                 raise CorruptedRepoError.corrupted_uncommited_config()
             else:
@@ -56,10 +67,36 @@ class AIRepo(Repository, AIRepoConstants):
 
         config_json = AIRepoConfig.default().serialize()
 
-        with open(self.CONFIG_PATH, 'w') as f:
+        with open(config_path, 'w') as f:
             json.dump(config_json, f)
+        with open(Path(self.workdir) / self.GITIGNORE_PATH, 'w') as f:
+            f.write("/%s\n" % self.JOURNAL_FILE)
+
+        self.commit([self.CONFIG_PATH, self.GITIGNORE_PATH], [], "Initializing AI Repo")
+
+    def add_branch_worktree(self, name: str, branch_name: str) -> 'AIRepo':
+        """Checks out a branch in a new worktree, kept in the .git folder.
 
-        self.commit([self.CONFIG_PATH], [], "Initializing AI Repo")
+        Args:
+            name (str): name of the worktree
+            branch_name (str): local branch checked out in the worktree
+
+        Returns:
+            AIRepo: repository of the worktree, which shares the objects of
+                this one
+        """
+        path = os.path.join(self.path, self.GIT_DIR_AI_FOLDER,
+                            self.WORKTREES_FOLDER, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        branch = self.lookup_branch(branch_name)
+        self.add_worktree(name, path, self.lookup_reference(branch.name))
+        return AIRepo(path)
+
+    def remove_worktree(self, name: str):
+        """Deletes a worktree and its files. Its branch is kept."""
+        worktree = self.lookup_worktree(name)
+        shutil.rmtree(worktree.path, ignore_errors=True)
+        worktree.prune(True)
 
     def get_current_branch(self):
         try:
@@ -91,7 +128,10 @@ class AIRepo(Repository, AIRepoConstants):
         if not path_add_list and not path_remove_list:
             return
 
-        file_list = [f for path in path_add_list for f in list_path(path)]
+        # Paths are relative to the root of the working tree
+        workdir = self.workdir
+        file_list = [os.path.relpath(f, workdir) for path in path_add_list
+                     for f in list_path(os.path.join(workdir, path))]
         # Create objects in the tree
         # Create index
         self.index.read()
@@ -125,6 +165,107 @@ class AIRepo(Repository, AIRepoConstants):
         if self.is_empty:
             self.head.set_target(oid)
 
+    def commit_files(self, files: dict[str, bytes], message: str,
+                     reference_name: Optional[str] = None) -> Optional[pygit2.Oid]:
+        """Commits the contents of files without going through the index.
+
+        Blobs are written straight to the object database and only the trees
+        on the paths of the files are rebuilt, the others are reused from the
+        parent commit. The index is not updated.
+
+        Args:
+            files (dict[str, bytes]): contents of each file, keyed by its
+                posix path relative to the root of the repository
+            message (str): message of the commit
+            reference_name (Optional[str], optional): branch the commit is
+                made on. Defaults to the current branch.
+
+        Returns:
+            Optional[pygit2.Oid]: the new commit, None if the files didn't
+                change anything
+        """
+        if not reference_name:
+            reference_name = self.get_current_branch()
+        parent = (self.references[reference_name].peel(pygit2.Commit)
+                  if reference_name in self.references else None)
+
+        changes: dict = {}
+        for path, data in files.items():
+            *folders, name = path.split('/')
+            node = changes
+            for folder in folders:
+                node = node.setdefault(folder, {})
+            node[name] = data
+        tree = self.__build_tree(parent.tree if parent else None, changes)
+        if parent and tree == parent.tree_id:
+            return None
+
+        try:
+            user = self.default_signature
+        except Exception:
+            raise CommitSignatureError.missing_signature()
+        return self.create_commit(reference_name, user, user, message, tree,
+                                  [parent.id] if parent else [])
+
+    def squash_commits(self, reference_name: str, base: pygit2.Oid,
+                       keep: Callable[[pygit2.Commit], bool]) -> pygit2.Oid:
+        """Rewrites the commits of a branch made after `base`, keeping only
+        some of them.
+
+        Every commit keeps its tree, so a kept commit holds the changes of
+        the commits dropped before it. The last commit is always kept. Only
+        the first parent of each commit is followed.
+
+        Args:
+            reference_name (str): qualified name of the branch
+            base (pygit2.Oid): commit the rewrite starts after, it is kept
+                as is
+            keep (Callable[[pygit2.Commit], bool]): returns if a commit is
+                kept
+
+        Returns:
+            pygit2.Oid: the new last commit of the branch
+        """
+        tip = self.references[reference_name].peel(pygit2.Commit)
+        commits = []
+        commit = tip
+        while commit.id != base:
+            commits.append(commit)
+            if not commit.parents:
+                break
+            commit = commit.parents[0]
+        commits.reverse()
+
+        parent = base
+        for commit in commits:
+            if commit.id != tip.id and not keep(commit):
+                continue
+            parent = self.create_commit(
+                None, commit.author, commit.committer, commit.message,
+                commit.tree_id, [parent])
+        self.references[reference_name].set_target(parent, "squash")
+        return parent
+
+    def __build_tree(self, base: Optional[pygit2.Tree], changes: dict) -> pygit2.Oid:
+        builder = self.TreeBuilder(base) if base is not None else self.TreeBuilder()
+        for name, change in changes.items():
+            entry = base[name] if base is not None and name in base else None
+            if isinstance(change, dict):
+                subtree = (entry if entry is not None and
+                           entry.filemode == pygit2.GIT_FILEMODE_TREE else None)
+                oid = self.__build_tree(subtree, change)
+                if entry is None or entry.id != oid:
+                    builder.insert(name, oid, pygit2.GIT_FILEMODE_TREE)
+            elif isinstance(change, tuple):
+                # An existing object, (oid, filemode)
+                builder.insert(name, *change)
+            else:
+                mode = (entry.filemode if entry is not None and
+                        entry.filemode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+                        else pygit2.GIT_FILEMODE_BLOB)
+                builder.insert(name, self.create_blob(change), mode)
+        return builder.write()
+
     # isinstance(commit, Object)
     def list_file_contents(self, commit_oid: str, path: str):
         # TODO What if path points to a tree
@@ -167,56 +308,95 @@ class AIRepo(Repository, AIRepoConstants):
 
     def merge_experiment(self, exp_name: str, message: str) -> None:
         """Merges an experiment, bringing all the files in .git_ai from the experiment.
-        Warns if the current branch has other changes that will not be merged.
-        This is not a merge as it picks files from another commits and directly overwrites them
-        into this commit.
+        This is not a merge as it picks files from another commit and directly overwrites them
+        into this commit, see `merge_experiments`.
         TODO
             handle case where repository is dirty
             warn user if experiment commit has other changes then those in .git_ai
         Args:
             exp_name (str): Name of the experiment to be merged
-            branch_name (Optional[str], optional): Name of the branch where the the experiment will be merged.
-                Defaults to None.
+            message (str): Message of the commit. Defaults to "Merging experiment <name>".
         """
+        self.merge_experiments([exp_name], message)
+
+    def merge_experiments(self, exp_names: list[str], message: str = "") -> Optional[pygit2.Oid]:
+        """Merges several experiments, in order, with a commit for each one.
+
+        The .git_ai tree of each experiment replaces the one of the current
+        branch, with the configuration of the experiment. Trees are grafted
+        without reading the files of the experiments, and the working tree and
+        the index are only updated once, for the files that differ.
+
+        Args:
+            exp_names (list[str]): names of the experiments to be merged
+            message (str, optional): message of the commits. Defaults to
+                "Merging experiment <name>".
+
+        Returns:
+            Optional[pygit2.Oid]: the last commit, None if the experiments
+                didn't change anything
+        """
+        try:
+            user = self.default_signature
+        except Exception:
+            raise CommitSignatureError.missing_signature()
+        head = self.head.peel(pygit2.Commit)
         config = read_config(self)
-        experiment_last_commit = self.get(
-            self.branches['exp/%s' % exp_name].target)
-        new_config = read_config(self, experiment_last_commit.oid)
-        experiment = experiment_last_commit.tree / self.GIT_AI_ROOT   # type: ignore
-        experiment_git_ai_files = AIRepo.unroll_sub_tree(
-            experiment, Path(self.GIT_AI_ROOT), keep_trees=True)
-        repo_head_commit = self.get(self.head.target)
-        repo_entries = AIRepo.unroll_sub_tree(
-            repo_head_commit.tree / self.GIT_AI_ROOT,    # type: ignore
-            Path(self.GIT_AI_ROOT),
-            keep_trees=False)
-        experiment_git_ai_files_set = set([
-            path / obj.name for obj, path in experiment_git_ai_files
-        ])
-        repo_entries = set([
-            path / obj.name for obj, path in repo_entries
-        ])
-
-        removed_files = [
-            p for p in repo_entries if p not in experiment_git_ai_files_set]
-        added_files = [
-            p for p in experiment_git_ai_files_set if p not in removed_files]
-
-        # Create all the files
-        for e, path in experiment_git_ai_files:
-            if e.filemode == pygit2.GIT_FILEMODE_TREE:
-                os.makedirs(Path(self.workdir) / path / e.name, exist_ok=True)
+        tree = head.tree
+        parent = head.id
+        for exp_name in exp_names:
+            experiment_last_commit = self.branches['exp/%s' % exp_name].peel(pygit2.Commit)
+            if self.GIT_AI_ROOT not in experiment_last_commit.tree:
+                continue
+            experiment = experiment_last_commit.tree / self.GIT_AI_ROOT   # type: ignore
+            new_config = read_config(self, experiment_last_commit.id)
+
+            changes: dict = {}
+            if new_config:
+                if new_config.input_repos:
+                    # Input repos are checked out in the working tree
+                    self.merge_config(config, new_config)
+                    self.index.read()
+                    # Gitlinks, and the .gitmodules staged by new input repos
+                    staged = {Path(path).as_posix() for path in new_config.input_repos}
+                    for delta in self.index.diff_to_tree(head.tree).deltas:
+                        if (delta.status != pygit2.GIT_DELTA_DELETED and
+                                not Path(delta.new_file.path).is_relative_to(self.GIT_AI_ROOT)):
+                            staged.add(delta.new_file.path)
+                    for path in sorted(staged):
+                        entry = self.index[path]
+                        *folders, name = Path(path).parts
+                        node = changes
+                        for folder in folders:
+                            node = node.setdefault(folder, {})
+                        node[name] = (entry.id, entry.mode)
+                config_data = json.dumps(new_config.serialize()).encode()
+                experiment_tree = self.__build_tree(
+                    experiment, {self.CONFIG_JSON: config_data})
+                config = new_config
             else:
-                permissions = (0o755 if e.filemode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
-                               else 0o644)
-                with open(Path(self.workdir) / path / e.name, 'wb') as f:
-                    f.write(e.data)
-                os.chmod(Path(self.workdir) / path / e.name, mode=permissions)
-
-        self.merge_config(config, new_config)
-        if not message:
-            message = "Merging experiment %s" % exp_name
-        self.commit(added_files, removed_files, message)
+                experiment_tree = experiment.id
+            changes[self.GIT_AI_ROOT] = (experiment_tree, pygit2.GIT_FILEMODE_TREE)
+
+            new_tree = self[self.__build_tree(tree, changes)]
+            if new_tree.id == tree.id:
+                continue
+            parent = self.create_commit(
+                None, user, user,
+                message if message else "Merging experiment %s" % exp_name,
+                new_tree.id, [parent])
+            tree = new_tree
+
+        if parent == head.id:
+            return None
+        paths = set()
+        for delta in head.tree.diff_to_tree(tree).deltas:
+            paths.add(delta.old_file.path)
+            paths.add(delta.new_file.path)
+        self.checkout_tree(tree, paths=list(paths),
+                           strategy=pygit2.GIT_CHECKOUT_FORCE)
+        self.head.set_target(parent)
+        return parent
 
     def add_input_repo(self, submodule_path: Path, remote_uri: str, commit_spec: Optional[str] = None, commit: bool = True) -> None:
         """Adds an input repository to the current repo
@@ -234,7 +414,7 @@ class AIRepo(Repository, AIRepoConstants):
             lambda cred: self.submodules.add(
                 url=remote_uri, path=submodule_path, callbacks=cred, link=False)
         )
-        sub_repo = pygit2.Repository(sub.path)
+        sub_repo = open_repository(sub.path)
         input_repo_commit = str(commit_spec) if commit_spec else str(
             sub_repo.head.target)
         config.add_input_repo(input_repo=InputRepo(
@@ -257,7 +437,7 @@ class AIRepo(Repository, AIRepoConstants):
             remote_uri (str): uri to the repository
             commit_spec (Optional[str], optional): Commit in the remote repo to be cloned. Defaults to None which clones the head.
         """
-        submodule_repo = Repository(
+        submodule_repo = open_repository(
             Path(self.workdir) / submodule_path)
         submodule_commit = submodule_repo[commit_spec]
         submodule_repo.checkout_tree(submodule_commit)
@@ -307,31 +487,85 @@ class AIRepo(Repository, AIRepoConstants):
 
         self.write_config(new_config)
 
-    def get_wt_modified_files(self) -> tuple[list[str], list[str], list[str], list[str]]:
-        status = self.status()
+    def __classify_status(self, status: dict) -> tuple[list[str], list[str], list[str], list[str]]:
         new = []
         modified = []
         removed = []
         renamed = []
         for filepath, flags in status.items():
-            if flags and pygit2.GIT_STATUS_WT_NEW:
+            if filepath == self.JOURNAL_PATH.as_posix():
+                continue
+            if flags & pygit2.GIT_STATUS_WT_NEW:
                 new.append(filepath)
-            elif flags and pygit2.GIT_STATUS_WT_MODIFIED:
+            elif flags & (pygit2.GIT_STATUS_WT_MODIFIED |
+                          pygit2.GIT_STATUS_WT_TYPECHANGE):
                 modified.append(filepath)
-            elif flags and pygit2.GIT_STATUS_WT_DELETED:
+            elif flags & pygit2.GIT_STATUS_WT_DELETED:
                 removed.append(filepath)
-            elif flags and pygit2.GIT_STATUS_WT_RENAMED:
+            elif flags & pygit2.GIT_STATUS_WT_RENAMED:
                 renamed.append(filepath)
+            elif flags & (pygit2.GIT_STATUS_INDEX_NEW |
+                          pygit2.GIT_STATUS_INDEX_MODIFIED):
+                # Staged, but not committed yet
+                modified.append(filepath)
 
         return new, modified, removed, renamed
 
+    def get_wt_modified_files(self) -> tuple[list[str], list[str], list[str], list[str]]:
+        return self.__classify_status(self.status())
+
+    def get_ai_status(self) -> dict[str, int]:
+        """Returns the status of the files in .git_ai, as `status` does,
+        without looking at the rest of the working tree.
+
+        Only the files under .git_ai in the working tree, and those in the
+        .git_ai tree of HEAD, are checked.
+
+        Returns:
+            dict[str, int]: status flags of each file that changed
+        """
+        paths = set(Path(os.path.relpath(f, self.workdir)).as_posix()
+                    for f in list_path(Path(self.workdir) / self.GIT_AI_ROOT))
+        if not self.is_empty:
+            tree = self.head.peel(pygit2.Commit).tree
+            if self.GIT_AI_ROOT in tree:
+                paths.update(
+                    (path / entry.name).as_posix()
+                    for entry, path in AIRepo.unroll_sub_tree(
+                        tree / self.GIT_AI_ROOT, Path(self.GIT_AI_ROOT),
+                        keep_trees=False))
+
+        status = {}
+        for path in paths:
+            try:
+                flags = self.status_file(path)
+            except KeyError:
+                continue
+            if flags not in (pygit2.GIT_STATUS_CURRENT,
+                             pygit2.GIT_STATUS_IGNORED):
+                status[path] = flags
+        return status
+
     def get_ai_modified_files(self) -> tuple[list[str], list[str]]:
-        new, modified, removed, _ = self.get_wt_modified_files()
+        new, modified, removed, _ = self.__classify_status(
+            self.get_ai_status())
         to_add = self.filter_ai_repo_files(new + modified)
         to_remove = self.filter_ai_repo_files(removed)
         return to_add, to_remove
 
-    def get_log(self, start_commit: str = "", end_commit: str = "") -> RecursiveLog:
+    def get_log(self, start_commit: str = "", end_commit: str = "",
+                jobs: int = 1) -> RecursiveLog:
+        if not start_commit:
+            start_commit = str(self.head.target)
+        return build_log(self, start_commit, end_commit, jobs)
+
+    def iter_log(self, start_commit: str = "", end_commit: str = "",
+                 max_count: Optional[int] = None, since: Optional[float] = None,
+                 time_order: bool = False, first_parent: bool = False,
+                 jobs: int = 1) -> Iterator[str]:
+        """Yields the lines of the log of the `end_commit..start_commit` range as the commits are
+        walked, see `iter_log`. Input repos are walked by up to `jobs` threads."""
         if not start_commit:
             start_commit = str(self.head.target)
-        return build_log(self, start_commit, end_commit)
+        return iter_log(self, start_commit, end_commit, max_count, since, time_order,
+                        first_parent, jobs)
@@ -1,12 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional, Type
+from threading import Lock, local
+from typing import Callable, Iterator, Optional, Type, TypeVar
 from typing_extensions import Self
 from git_ai.cmd.constants import AIRepoConstants
-from git_ai.pygitutils import get_repo_log, read_config
+from git_ai.pygitutils import get_repo_log, iter_repo_log
 from pygit2 import Repository, Commit
 
-from .ai_repo_config import InputRepo
+from .ai_repo_config import AIRepoConfig, InputRepo
+from .config_cache import ConfigCache
+from .repo_pool import open_repository
+
+T = TypeVar('T')
+
+
+def format_commit(commit: Commit, identation: str = "") -> str:
+    short_oid = str(commit.oid)[:8]
+    user = commit.author.name[:20]
+    commit_tz = timezone(timedelta(minutes=commit.commit_time_offset))
+    commit_at = datetime.fromtimestamp(
+        commit.commit_time, tz=commit_tz).strftime("%Y-%m-%d %H:%M:%S")
+    message = commit.message.strip("\n\t ")
+    return "%s%s  %s %s %s" % (identation, short_oid, user, commit_at, message)
 
 
 class RecursiveLog:
@@ -25,14 +41,7 @@ class RecursiveLog:
     def serialize_log(self, identation: str = "", input_repo_path: Path = Path("")) -> list[str]:
         serialized_log = []
         for commit in self.commits:
-            short_oid = str(commit.oid)[:8]
-            user = commit.author.name[:20]
-            commit_tz = timezone(timedelta(minutes=commit.commit_time_offset))
-            commit_at = datetime.fromtimestamp(
-                commit.commit_time, tz=commit_tz).strftime("%Y-%m-%d %H:%M:%S")
-            message = commit.message.strip("\n\t ")
-            serialized_log.append("%s%s  %s %s %s" % (
-                identation, short_oid, user, commit_at, message))
+            serialized_log.append(format_commit(commit, identation))
             paths = sorted(self.log[str(commit.oid)].keys())
             for path in paths:
                 this_input_log = self.log[str(commit.oid)][path].serialize_log(
@@ -46,35 +55,80 @@ class RecursiveLog:
 
 
 class RootLog:
-    def __init__(self, repository: Repository):
+    """Recursive log of a repository and its input repos.
+
+    With more than one job, the input repos that changed between two commits are walked
+    concurrently by a pool of threads, libgit2 releases the GIL while it reads objects. Each
+    input repo is walked by a single thread, including its own input repos, and the logs are
+    put together in the same order as the sequential log.
+
+    Args:
+        repository (Repository): the repository
+        jobs (int, optional): maximum number of input repos walked at once. Defaults to 1.
+    """
+
+    def __init__(self, repository: Repository, jobs: int = 1):
         if 'origin' not in repository.remotes:
             url = "local"
         else:
             url = str(repository.remotes['origin'].url)
         self.repository = repository
         self.repository_cache: dict[str, Repository] = {url: repository}
-        self.commit_cache: dict[str, dict[str, Commit]] = {}
+        # Configs of the commits of each repository, keyed by its git folder
+        self.config_caches: dict[str, ConfigCache] = {}
+        self.config_lock = Lock()
+        self.pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.worker = local()
 
     def __get_input_repo_cache(self, input_repo: InputRepo) -> Repository:
         return self.__get_repo_cache(input_repo.uri, input_repo.path)
 
     def __get_repo_cache(self, uri: str, path: Path) -> Repository:
         if uri not in self.repository_cache:
-            repo = Repository(path)
+            repo = open_repository(path)
             self.repository_cache[uri] = repo
         else:
             repo = self.repository_cache[uri]
         return repo
 
-    def __check_commit_cache(self, input_repo: InputRepo, commit: Commit) -> Optional[Commit]:
-        if input_repo.uri in self.commit_cache:
-            if str(commit.oid) not in self.repository_cache[input_repo.uri]:
-                self.commit_cache[input_repo.uri][str(commit.oid)] = commit
-                return commit
-            else:
-                return None
-        else:
-            return None
+    def __read_config(self, repo: Repository, commit: Commit) -> Optional[AIRepoConfig]:
+        with self.config_lock:
+            if repo.path not in self.config_caches:
+                self.config_caches[repo.path] = ConfigCache(repo)
+            cache = self.config_caches[repo.path]
+        # Caches are read concurrently, the lock only guards the dict
+        return cache.get(commit.oid)
+
+    def save_config_caches(self):
+        for cache in self.config_caches.values():
+            cache.save()
+
+    def close(self):
+        """Saves the config caches and stops the threads."""
+        self.save_config_caches()
+        if self.pool:
+            self.pool.shutdown()
+
+    def __fans_out(self, items: list) -> bool:
+        # Threads walk their input repos by themselves, waiting for other tasks of the pool
+        # from a thread of the pool could take every thread
+        return (self.pool is not None and len(items) > 1 and
+                not getattr(self.worker, 'active', False))
+
+    def __run_task(self, func: Callable[..., T], *args) -> T:
+        self.worker.active = True
+        try:
+            return func(*args)
+        finally:
+            self.worker.active = False
+
+    def __map(self, func: Callable[..., T], items: list[tuple]) -> list[T]:
+        """Calls func with the args of each item, concurrently when possible. The results are in
+        the order of the items."""
+        if not self.__fans_out(items):
+            return [func(*args) for args in items]
+        futures = [self.pool.submit(self.__run_task, func, *args) for args in items]
+        return [f.result() for f in futures]
 
     def build_log(self, repo: Repository, commits: list[Commit]) -> RecursiveLog:
         log = RecursiveLog(repo)
@@ -105,25 +159,119 @@ class RootLog:
                 repo, input_repo.commit)
         return self.build_log(repo, commit_list)
 
+    def __build_input_repo_log(self, repo: Repository, input_repo: InputRepo,
+                               next_input_repo: Optional[InputRepo]) -> RecursiveLog:
+        input_repo_handle = open_repository(Path(repo.workdir) / input_repo.path)
+        return self.__get_input_repo_recursive_log(input_repo_handle, input_repo, next_input_repo)
+
     def __traverse_input_repos(self, repo: Repository, this_c: Commit, next_c: Commit, log: RecursiveLog):
-        this_config = read_config(repo, this_c.oid)
-        next_config = read_config(repo, next_c.oid)
+        this_config = self.__read_config(repo, this_c)
+        next_config = self.__read_config(repo, next_c)
 
         if this_config:
+            changed = []
             for input_repo in this_config.input_repos.values():
-                input_repo_handle = Repository(
-                    Path(repo.workdir) / input_repo.path)
                 next_input_repo = (next_config.get_input_repo(input_repo.path)
                                    if next_config else None)
                 if (next_input_repo and input_repo.commit != next_input_repo.commit) or not next_input_repo:
-                    log.add_recursive_log(
-                        this_c,
-                        input_repo,
-                        self.__get_input_repo_recursive_log(
-                            input_repo_handle, input_repo, next_input_repo))
+                    changed.append((repo, input_repo, next_input_repo))
+            input_logs = self.__map(self.__build_input_repo_log, changed)
+            for (_, input_repo, _), input_log in zip(changed, input_logs):
+                log.add_recursive_log(this_c, input_repo, input_log)
+
+    def iter_lines(self, repo: Repository, commits: Iterator[Commit], identation: str = "",
+                   input_repo_path: Path = Path(""), max_count: Optional[int] = None,
+                   since: Optional[float] = None) -> Iterator[str]:
+        """Yields the lines of the log of some commits, as serialize_log does, while the commits
+        are walked. The log of an input repo is only walked when its lines are reached.
+
+        Args:
+            repo (Repository): repository of the commits
+            commits (Iterator[Commit]): commits, from the newest
+            identation (str, optional): prefix of the lines. Defaults to "".
+            input_repo_path (Path, optional): path of the repository, for input repos.
+                Defaults to Path("").
+            max_count (Optional[int], optional): maximum number of commits. Defaults to None.
+            since (Optional[float], optional): timestamp of the oldest commit. Defaults to None.
+        """
+        commits = iter(commits)
+        this_c = next(commits, None)
+        count = 0
+        while this_c is not None:
+            if ((max_count is not None and count >= max_count) or
+                    (since is not None and this_c.commit_time < since)):
+                return
+            # The next commit is needed to know if input repos changed
+            next_c = next(commits, None)
+            yield format_commit(this_c, identation)
+            if next_c is not None:
+                yield from self.__iter_input_repo_lines(repo, this_c, next_c, identation,
+                                                        input_repo_path)
+            count += 1
+            this_c = next_c
+
+    def __input_repo_lines(self, repo: Repository, path: Path, start_commit: str,
+                           end_commit: str, identation: str,
+                           input_repo_path: Path) -> Iterator[str]:
+        input_repo_handle = open_repository(Path(repo.workdir) / path)
+        return self.iter_lines(
+            input_repo_handle,
+            iter_repo_log(input_repo_handle, start_commit, end_commit),
+            identation + "    ", input_repo_path / path)
+
+    def __read_input_repo_lines(self, *args) -> list[str]:
+        return list(self.__input_repo_lines(*args))
+
+    def __iter_input_repo_lines(self, repo: Repository, this_c: Commit, next_c: Commit,
+                                identation: str, input_repo_path: Path) -> Iterator[str]:
+        this_config = self.__read_config(repo, this_c)
+        next_config = self.__read_config(repo, next_c)
+        if not this_config:
+            return
+        changed = []
+        for path in sorted(this_config.input_repos.keys()):
+            input_repo = this_config.input_repos[path]
+            next_input_repo = (next_config.get_input_repo(path)
+                               if next_config else None)
+            if next_input_repo and input_repo.commit == next_input_repo.commit:
+                continue
+            end_commit = next_input_repo.commit if next_input_repo else ""
+            changed.append((repo, path, input_repo.commit, end_commit, identation,
+                            input_repo_path))
+        if self.__fans_out(changed):
+            # The logs of the input repos are read at once, and shown in order
+            outputs = self.__map(self.__read_input_repo_lines, changed)
+        else:
+            outputs = (self.__input_repo_lines(*args) for args in changed)
+        for (_, path, *_), lines in zip(changed, outputs):
+            lines = iter(lines)
+            first = next(lines, None)
+            if first is None:
+                continue
+            yield "%s%s" % (identation, str(input_repo_path / path))
+            yield first
+            yield from lines
+
+
+def iter_log(repo: Repository, start_commit: str, end_commit: str = "",
+             max_count: Optional[int] = None, since: Optional[float] = None,
+             time_order: bool = False, first_parent: bool = False,
+             jobs: int = 1) -> Iterator[str]:
+    """Yields the lines of the recursive log of a repository as the commits are walked, see
+    `RootLog.iter_lines` and `iter_repo_log`."""
+    root_log = RootLog(repo, jobs)
+    try:
+        commits = iter_repo_log(repo, start_commit, end_commit, time_order, first_parent)
+        yield from root_log.iter_lines(repo, commits, max_count=max_count, since=since)
+    finally:
+        root_log.close()
 
 
-def build_log(repo: Repository, start_commit: str, end_commit: str = "") -> RecursiveLog:
-    root_log = RootLog(repo)
-    commits = get_repo_log(repo, start_commit, end_commit)
-    return root_log.build_log(repo, commits)
+def build_log(repo: Repository, start_commit: str, end_commit: str = "",
+              jobs: int = 1) -> RecursiveLog:
+    root_log = RootLog(repo, jobs)
+    try:
+        commits = get_repo_log(repo, start_commit, end_commit)
+        return root_log.build_log(repo, commits)
+    finally:
+        root_log.close()
@@ -0,0 +1,111 @@
+import json
+import os
+from threading import Lock, get_ident
+from typing import Optional, Union
+
+from pygit2 import Oid, Repository
+
+from git_ai.cmd.constants import AIRepoConstants
+from .ai_repo_config import AIRepoConfig
+from .repo_pool import open_repository
+
+
+class ConfigCache(AIRepoConstants):
+    """Input repos pinned by the config of each commit of a repository.
+
+    Configs are parsed once per config blob. The blob of each commit, and the
+    input repos of each blob, are appended to `.git/git_ai/config_cache`, a
+    JSON record per line, so they are not read again by later processes. The
+    cache only grows with commits that were not seen before.
+
+    The cache can be read by several threads, objects are read outside its
+    lock, with the handle of the repository of each thread.
+
+    Args:
+        repo (Repository): the repository
+    """
+    CACHE_FILE = 'config_cache'
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.filename = os.path.join(repo.path, self.GIT_DIR_AI_FOLDER,
+                                     self.CACHE_FILE)
+        # commit -> config blob, None if the commit has no config
+        self.commits: dict[str, Optional[str]] = {}
+        # config blob -> input repos
+        self.blobs: dict[str, list[dict]] = {}
+        self.configs: dict[str, AIRepoConfig] = {}
+        self.new_records: list[dict] = []
+        self.lock = Lock()
+        self.owner = get_ident()
+        self.__load()
+
+    def __handle(self) -> Repository:
+        # Repository handles aren't shared by threads
+        if get_ident() == self.owner:
+            return self.repo
+        return open_repository(self.repo.workdir or self.repo.path)
+
+    def __load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Left partially written
+                        continue
+                    if 'c' in record:
+                        self.commits[record['c']] = record['b']
+                    else:
+                        self.blobs[record['b']] = record['i']
+        except FileNotFoundError:
+            pass
+
+    def __config_blob(self, oid: str) -> Optional[str]:
+        with self.lock:
+            if oid in self.commits:
+                return self.commits[oid]
+        tree = self.__handle()[oid].tree
+        blob = (str(tree[self.CONFIG_PATH.as_posix()].id)
+                if self.CONFIG_PATH.as_posix() in tree else None)
+        with self.lock:
+            if oid not in self.commits:
+                self.commits[oid] = blob
+                self.new_records.append({'c': oid, 'b': blob})
+        return blob
+
+    def get(self, oid: Union[str, Oid]) -> Optional[AIRepoConfig]:
+        """Returns the config of a commit, None if it has none."""
+        blob = self.__config_blob(str(oid))
+        if blob is None:
+            return None
+        with self.lock:
+            if blob in self.configs:
+                return self.configs[blob]
+            input_repos = self.blobs.get(blob)
+        if input_repos is None:
+            config = AIRepoConfig.from_str(self.__handle()[blob].data)
+            input_repos = [i.serialize() for i in config.input_repos.values()]
+        else:
+            config = AIRepoConfig.from_json({'input_repos': input_repos})
+        with self.lock:
+            if blob not in self.blobs:
+                self.blobs[blob] = input_repos
+                self.new_records.append({'b': blob, 'i': input_repos})
+            return self.configs.setdefault(blob, config)
+
+    def save(self):
+        """Appends the records read since the cache was loaded."""
+        with self.lock:
+            records, self.new_records = self.new_records, []
+        if not records:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        data = ''.join(json.dumps(r) + '\n' for r in records)
+        # A single append, so records of concurrent processes don't mix
+        fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        try:
+            os.write(fd, data.encode())
+        finally:
+            os.close(fd)
@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock, get_ident
+from typing import Callable, Optional, TypeVar, Union
+
+from pygit2 import Repository
+
+R = TypeVar('R', bound=Repository)
+
+
+class RepositoryPool(object):
+    """Handles of repositories opened by the process, so nested input repos
+    are opened once.
+
+    Opening a repository reads its config, references and pack indexes. The
+    pool keeps the most recently used handles, keyed by the resolved path of
+    the repository and the class of the handle. Handles aren't shared by
+    threads, each thread gets its own.
+
+    Long-running processes can `release` the handles they no longer need.
+    Released or evicted handles are freed once nobody uses them.
+
+    Args:
+        max_size (int, optional): maximum number of handles kept. Defaults
+            to 64.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.handles: OrderedDict[tuple, Repository] = OrderedDict()
+
+    def get(self, path: Union[str, os.PathLike],
+            factory: Callable[[str], R] = Repository) -> R:
+        """Returns the handle of a repository, opening it if it isn't in the
+        pool.
+
+        Args:
+            path (Union[str, os.PathLike]): working tree or git folder of the
+                repository
+            factory (Callable[[str], R], optional): class of the handle.
+                Defaults to Repository.
+
+        Returns:
+            R: the handle
+        """
+        key = (str(Path(path).resolve()), factory, get_ident())
+        with self.lock:
+            repo = self.handles.get(key)
+            if repo is not None and os.path.isdir(repo.path):
+                self.handles.move_to_end(key)
+                return repo
+        # Opened without the lock, other threads don't wait for it
+        repo = factory(key[0])
+        with self.lock:
+            self.handles[key] = repo
+            self.handles.move_to_end(key)
+            while len(self.handles) > self.max_size:
+                self.handles.popitem(last=False)
+        return repo
+
+    def release(self, path: Optional[Union[str, os.PathLike]] = None):
+        """Removes the handles of a repository from the pool, or every
+        handle if no path is given."""
+        with self.lock:
+            if path is None:
+                self.handles.clear()
+                return
+            resolved = str(Path(path).resolve())
+            for key in [k for k in self.handles if k[0] == resolved]:
+                del self.handles[key]
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+
+repository_pool = RepositoryPool()
+
+
+def open_repository(path: Union[str, os.PathLike],
+                    factory: Callable[[str], R] = Repository) -> R:
+    """Returns the handle of a repository from the pool of the process, see
+    `RepositoryPool.get`."""
+    return repository_pool.get(path, factory)
+
+
+def release_repositories(path: Optional[Union[str, os.PathLike]] = None):
+    """Releases handles of the pool of the process, see
+    `RepositoryPool.release`."""
+    repository_pool.release(path)
@@ -10,12 +10,21 @@ class AIRepoConstants:
     HPARAMS_JSON: str = 'hparams.json'
     CONFIG_JSON: str = 'config.json'
     TOPOLOGY_FILE: str = 'topology'
+    # Journal of the running experiment, never committed
+    JOURNAL_FILE: str = '.journal'
+    # Keeps the journal out of the status of the repository
+    GITIGNORE_FILE: str = '.gitignore'
+    # Folder inside the .git folder with state that is not versioned
+    GIT_DIR_AI_FOLDER: str = 'git_ai'
+    WORKTREES_FOLDER: str = 'worktrees'
     METRICS_PATH = Path(GIT_AI_ROOT) / METRICS_FOLDER
     ARTIFACT_PATH = Path(GIT_AI_ROOT) / ARTIFACT_FOLDER
     HPARAMS_JSON_PATH = Path(GIT_AI_ROOT) / HPARAMS_JSON
     TENSORBOARD_PATH = Path(GIT_AI_ROOT) / TENSORBOARD_FOLDER
     CONFIG_PATH = Path(GIT_AI_ROOT) / CONFIG_JSON
     TOPOLOGY_PATH = Path(GIT_AI_ROOT) / TOPOLOGY_FILE
+    JOURNAL_PATH = Path(GIT_AI_ROOT) / JOURNAL_FILE
+    GITIGNORE_PATH = Path(GIT_AI_ROOT) / GITIGNORE_FILE
 
     def metrics_file_list(self):
         # TODO Check if files exist
@@ -24,7 +33,8 @@ class AIRepoConstants:
 
     def filter_ai_repo_files(self, file_list: list[str]) -> list[str]:
         return [
-            f for f in file_list if (f.startswith(self.GIT_AI_ROOT))
+            f for f in file_list if (f.startswith(self.GIT_AI_ROOT) and
+                                     f != self.JOURNAL_PATH.as_posix())
         ]
 
     def metric_filename(self, workdir: str, tag: str):
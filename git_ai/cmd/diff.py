@@ -1,10 +1,12 @@
 import os
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pygit2 import Repository
-from git_ai.cmd.ai_repo import AIRepo
+from git_ai.cmd.ai_repo import AIRepo, open_repository
 from git_ai.cmd.constants import AIRepoConstants
+from git_ai.metrics.series import read_series_values
 from git_ai.pygitutils.pygitutils import read_config
 
 # Try fbi
@@ -12,8 +14,21 @@ from git_ai.pygitutils.pygitutils import read_config
 
 
 class AIDiff(AIRepoConstants):
-    def __init__(self, repo):
+    """Differences of the hyperparameters, metrics and files of two commits, and of their
+    input repos.
+
+    With more than one job, the input repos are compared concurrently by a pool of threads.
+    Each input repo is compared by a single thread, including its own input repos, and the
+    differences are shown in order.
+
+    Args:
+        repo (AIRepo): the repository
+        jobs (int, optional): maximum number of input repos compared at once. Defaults to 1.
+    """
+
+    def __init__(self, repo, jobs: int = 1):
         self.repo = repo
+        self.jobs = jobs
 
     def _check_value(self, values_dict_a, values_dict_b, value_key, cmp_func):
         changes = []
@@ -68,22 +83,26 @@ class AIDiff(AIRepoConstants):
 
         return changes, added, deleted
 
-    def print_change(self, change, type, identation):
-        print("")
+    def change_lines(self, change, type, identation):
+        lines = [""]
         if type == 'addition':
             key, new_value = change
-            print(identation + "%s" % (key))
-            print(identation + "+ %s" % str(new_value))
+            lines.append(identation + "%s" % (key))
+            lines.append(identation + "+ %s" % str(new_value))
         if type == 'deletion':
             key, old_value = change
-            print(identation + "%s" % (key))
-            print(identation + "- %s" % str(old_value))
-            pass
+            lines.append(identation + "%s" % (key))
+            lines.append(identation + "- %s" % str(old_value))
         if type == 'change':
             key, old_value, new_value = change
-            print(identation + "%s" % (key))
-            print(identation + "- %s" % str(old_value))
-            print(identation + "+ %s" % str(new_value))
+            lines.append(identation + "%s" % (key))
+            lines.append(identation + "- %s" % str(old_value))
+            lines.append(identation + "+ %s" % str(new_value))
+        return lines
+
+    def print_change(self, change, type, identation):
+        for line in self.change_lines(change, type, identation):
+            print(line)
 
     def list_plots(self, commit_spec):
         commit = self.repo.get(commit_spec)
@@ -92,13 +111,31 @@ class AIDiff(AIRepoConstants):
 
         plots_folder = commit.tree / AIRepoConstants.METRICS_PATH    # type: ignore
         all_folders = {
-            f.name.removesuffix('_header'):
-                json.loads(plots_folder[f.name.removesuffix('_header')].data)
+            f.name.removesuffix('_header'): {
+                'values': read_series_values(
+                    json.loads(f.data),
+                    plots_folder[f.name.removesuffix('_header')].data)
+            }
             for f in plots_folder if f.name.endswith('_header')}
 
         return all_folders
 
     def run(self, commitA, commitB, identation):
+        for line in self.diff_lines(commitA, commitB, identation):
+            print(line)
+
+    def diff_lines(self, commitA, commitB, identation) -> list[str]:
+        """Returns the lines of the differences of two commits, see `run`.
+
+        Args:
+            commitA: first commit
+            commitB: second commit, if empty the first commit is compared with HEAD
+            identation (str): prefix of the lines
+
+        Returns:
+            list[str]: the lines
+        """
+        lines = []
         if not commitB:
             # Reference to current head
             # TODO: This inverts the order of the commits. Can be confusing!
@@ -108,7 +145,7 @@ class AIDiff(AIRepoConstants):
             this_commit = self.repo.resolve_refish(commitA)[0].hex
             that_commit = self.repo.resolve_refish(commitB)[0].hex
 
-        print(identation + this_commit, that_commit)
+        lines.append("%s%s %s" % (identation, this_commit, that_commit))
         hparamsA = self.repo.list_file_contents(
             this_commit, self.HPARAMS_JSON_PATH)
         hparamsB = self.repo.list_file_contents(
@@ -132,26 +169,41 @@ class AIDiff(AIRepoConstants):
                 (not Path(d.delta.old_file.path).is_relative_to(Path(self.GIT_AI_ROOT))))]
 
         for d in text_diffs:
-            print(identation + d.text)
+            lines.append(identation + d.text)
 
         for change in changes:
-            self.print_change(change, 'change', identation)
+            lines.extend(self.change_lines(change, 'change', identation))
         for add in added:
-            self.print_change(add, 'addition', identation)
+            lines.extend(self.change_lines(add, 'addition', identation))
         for deletion in deleted:
-            self.print_change(deletion, 'deletion', identation)
+            lines.extend(self.change_lines(deletion, 'deletion', identation))
 
         # Check input repos
         this_config = read_config(self.repo, this_commit)
         that_config = read_config(self.repo, that_commit)
         if this_config:
-            for path, input_repo in this_config.input_repos.items():
-                input_repo_handle = AIRepo(Path(self.repo.workdir) / path)
-                that_input_commit = that_config.get_input_repo(path).commit
-                print("")
-                print(input_repo.path)
-                AIDiff(input_repo_handle).run(input_repo.commit,
-                                              that_input_commit, identation + "    ")
+            input_repos = list(this_config.input_repos.items())
+            args = [(path, input_repo.commit, that_config.get_input_repo(path).commit,
+                     identation + "    ")
+                    for path, input_repo in input_repos]
+            if self.jobs > 1 and len(args) > 1:
+                with ThreadPoolExecutor(self.jobs) as pool:
+                    futures = [pool.submit(self.__input_repo_lines, *a) for a in args]
+                    outputs = [f.result() for f in futures]
+            else:
+                outputs = [self.__input_repo_lines(*a) for a in args]
+            for (_, input_repo), input_lines in zip(input_repos, outputs):
+                lines.append("")
+                lines.append(str(input_repo.path))
+                lines.extend(input_lines)
+        return lines
+
+    def __input_repo_lines(self, path, this_input_commit, that_input_commit,
+                           identation) -> list[str]:
+        # Threads of the pool compare the input repos of their input repo by themselves
+        input_repo_handle = open_repository(Path(self.repo.workdir) / path, AIRepo)
+        return AIDiff(input_repo_handle).diff_lines(this_input_commit, that_input_commit,
+                                                    identation)
 
 
 def diff(args):
@@ -167,6 +219,11 @@ def diff(args):
         nargs='?',
         default='',
         help=('Second commit to be compared'))
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of input repos compared at once. Defaults to 1')
     parsed_args = parser.parse_args(args[2:])
     repo = AIRepo(os.getcwd())
-    AIDiff(repo).run(parsed_args.commitA, parsed_args.commitB, "")
+    AIDiff(repo, parsed_args.jobs).run(parsed_args.commitA, parsed_args.commitB, "")
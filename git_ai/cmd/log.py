@@ -1,10 +1,56 @@
+import argparse
 import os
+import sys
+from datetime import datetime
 from git_ai.cmd.ai_repo import AIRepo
+from git_ai.pygitutils import parse_range
 
 
 def log(args):
+    parser = argparse.ArgumentParser(description='Git AI log')
+    parser.add_argument(
+        'commit',
+        type=str,
+        nargs='?',
+        default='',
+        help=('Commit the log starts from, or a A..B range of the commits reachable from B '
+              'but not from A. Defaults to HEAD'))
+    parser.add_argument(
+        '-n', '--max-count',
+        type=int,
+        default=None,
+        help='Maximum number of commits shown')
+    parser.add_argument(
+        '--since',
+        type=datetime.fromisoformat,
+        default=None,
+        help='Only commits made after this date, as YYYY-MM-DD[THH:MM:SS]')
+    parser.add_argument(
+        '--date-order',
+        action='store_true',
+        help='Show newer commits first, without showing parents before their children')
+    parser.add_argument(
+        '--first-parent',
+        action='store_true',
+        help='Only follow the first parent of merge commits')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of input repos walked at once. Defaults to 1')
+    parsed_args = parser.parse_args(args[2:])
     ai_repo = AIRepo(os.getcwd())
-    commit_spec = str(ai_repo.head.target) if len(args) < 3 else args[2]
-    commit, _ = ai_repo.resolve_refish(commit_spec)
-    for line in ai_repo.get_log(str(commit.oid)).serialize_log():
-        print(line)
+    start_commit, end_commit = parse_range(parsed_args.commit)
+    commit, _ = ai_repo.resolve_refish(
+        start_commit if start_commit else str(ai_repo.head.target))
+    since = parsed_args.since.timestamp() if parsed_args.since else None
+    try:
+        for line in ai_repo.iter_log(str(commit.oid), end_commit,
+                                     max_count=parsed_args.max_count, since=since,
+                                     time_order=parsed_args.date_order,
+                                     first_parent=parsed_args.first_parent,
+                                     jobs=parsed_args.jobs):
+            print(line)
+    except BrokenPipeError:
+        # The pager was closed, nothing else can be written
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
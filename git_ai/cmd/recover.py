@@ -0,0 +1,13 @@
+import os
+from git_ai.cmd.ai_repo import AIRepo
+# git_ai.metrics.journal imports git_ai.cmd, its names are looked up when used
+from git_ai.metrics import journal
+
+
+def recover(args):
+    ai_repo = AIRepo(os.getcwd())
+    recovered = journal.recover(ai_repo, force='--force' in args[2:])
+    for name in recovered:
+        print("Recovered interrupted experiment %s" % name)
+    if not recovered:
+        print("No interrupted experiment to recover")
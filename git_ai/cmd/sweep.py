@@ -0,0 +1,38 @@
+import json
+import os
+
+from git_ai.errors.errors import SweepError
+# git_ai.metrics.sweep imports git_ai.cmd, its names are looked up when used
+from git_ai.metrics import sweep as sweeps
+
+
+def read_space(space_filename: str) -> list[dict]:
+    """Reads the parameters of the trials of a sweep.
+
+    The file has either a "grid" object with the values of each parameter,
+    or a "random" object with the distribution of each parameter, a list of
+    values or a {"min": low, "max": high} object, and the number of "trials"
+    and optionally a "seed".
+    """
+    with open(space_filename) as f:
+        spec = json.load(f)
+    if 'grid' in spec:
+        return sweeps.grid(spec['grid'])
+    elif 'random' in spec:
+        space = {name: ((d['min'], d['max']) if isinstance(d, dict) else d)
+                 for name, d in spec['random'].items()}
+        return sweeps.random_space(space, spec['trials'], spec.get('seed'))
+    raise SweepError.invalid_space(space_filename)
+
+
+def sweep(args):
+    if len(args) < 5:
+        print('Usage: git-ai sweep <space.json> <max concurrency> <command> '
+              '[<args>]')
+        return
+    trials = sweeps.Sweep(read_space(args[2]), args[4:],
+                          max_concurrency=int(args[3]),
+                          repo_root=os.getcwd()).run()
+    if any(t.status != 'done' for t in trials):
+        raise SweepError.failed_trials(
+            len([t for t in trials if t.status != 'done']), len(trials))
@@ -0,0 +1,20 @@
+import os
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.errors.errors import RemoteError
+# git_ai.metrics.outbox imports git_ai.cmd, its names are looked up when used
+from git_ai.metrics import outbox
+
+
+def sync(args):
+    ai_repo = AIRepo(os.getcwd())
+    retries = 3
+    for arg in args[2:]:
+        if arg.startswith('--retries='):
+            retries = int(arg[len('--retries='):])
+    pushed, failed = outbox.PushOutbox(ai_repo).drain(retries=retries)
+    for branch in pushed:
+        print("Pushed %s" % branch)
+    if failed:
+        raise RemoteError.failed_pending_pushes(failed)
+    if not pushed:
+        print("Nothing to push")
@@ -89,6 +89,10 @@ class ExperimentError(GitAIException):
     def failed_to_push_experiment(cls: Type[Self]) -> Self:
         return cls("Failed to push experiment branch. Check if the remotes are valid.")
 
+    @classmethod
+    def failed_checkpoint(cls: Type[Self]) -> Self:
+        return cls("Failed to commit an experiment checkpoint.")
+
     @classmethod
     def experiment_already_started(cls: Type[Self]) -> Self:
         return cls("Experiment already started but not closed. Please close the current experiment before starting a new one.")
@@ -99,6 +103,32 @@ class MetricError(GitAIException):
     def unknown_data_type_enum(cls: Type[Self], data_type: str) -> Self:
         return cls(f"Unknown data type '{data_type}' for DataTypeEnum")
 
+    @classmethod
+    def not_columnar_data_type(cls: Type[Self], data_type: str) -> Self:
+        return cls(f"Metrics of type '{data_type}' can't be stored in the columnar format")
+
+    @classmethod
+    def mismatched_value_type(cls: Type[Self], data_type: str, value_type: str) -> Self:
+        return cls(f"Values of type '{value_type}' can't be logged to a series of type '{data_type}'")
+
+    @classmethod
+    def mismatched_tags_and_values(cls: Type[Self], tags: int, values: int) -> Self:
+        return cls(f"Got {values} values for {tags} tags")
+
+    @classmethod
+    def missing_sink_dependency(cls: Type[Self], sink: str, module: str) -> Self:
+        return cls(f"The {sink} metric sink needs '{module}', which is not installed")
+
+
+class SweepError(GitAIException):
+    @classmethod
+    def invalid_space(cls: Type[Self], filename: str) -> Self:
+        return cls(f"Sweep space '{filename}' has neither a 'grid' nor a 'random' object")
+
+    @classmethod
+    def failed_trials(cls: Type[Self], failed: int, total: int) -> Self:
+        return cls(f"{failed} of {total} sweep trials failed")
+
 
 class RemoteError(GitAIException):
     @classmethod
@@ -117,6 +147,11 @@ class RemoteError(GitAIException):
     def credential_helper(cls: Type[Self]) -> Self:
         return cls("Failed to get credentials from Git credential helper.")
 
+    @classmethod
+    def failed_pending_pushes(cls: Type[Self], branches: list[str]) -> Self:
+        return cls(f"Failed to push {', '.join(branches)}, they are kept "
+                   "in the outbox.")
+
 
 class DepotError(GitAIException):
     @classmethod
@@ -8,6 +8,9 @@ from git_ai.cmd import log
 from git_ai.cmd import merge_exp
 from git_ai.cmd import input_repo
 from git_ai.cmd import init
+from git_ai.cmd import sweep
+from git_ai.cmd import recover
+from git_ai.cmd import sync
 from git_ai.cmd import format_error
 
 
@@ -27,6 +30,12 @@ def main():
             merge_exp(sys.argv)
         elif sys.argv[1] == 'input-repo':
             input_repo(sys.argv)
+        elif sys.argv[1] == 'sweep':
+            sweep(sys.argv)
+        elif sys.argv[1] == 'recover':
+            recover(sys.argv)
+        elif sys.argv[1] == 'sync':
+            sync(sys.argv)
         else:
             print('git-ai 0.1.0')
             print('Usage: git-ai <command> [<args>]')
@@ -0,0 +1,284 @@
+import os
+import time
+from collections import deque
+from pathlib import Path
+from threading import Condition, Lock, Thread
+from typing import TYPE_CHECKING, Optional, Union
+
+import pygit2
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.errors.errors import ExperimentError
+from git_ai.metrics.series import is_temp_filename
+from git_ai.metrics.stats import WriterStats
+from git_ai.utils import list_path
+
+if TYPE_CHECKING:
+    # The journal imports CheckpointSnapshot
+    from git_ai.metrics.journal import Journal
+
+
+class CheckpointPolicy(object):
+    """Decides which checkpoints of an experiment are committed.
+
+    A checkpoint is committed once `min_seconds` or `min_steps` have passed
+    since the last committed one, whichever comes first. Checkpoints closer
+    than both are skipped, their metrics are committed by the next
+    checkpoint or at the end of the experiment. Milestone checkpoints are
+    always committed.
+
+    Args:
+        min_seconds (Optional[float], optional): minimum seconds between
+            checkpoints. Defaults to None.
+        min_steps (Optional[int], optional): minimum steps between
+            checkpoints. Defaults to None.
+    """
+
+    def __init__(self, min_seconds: Optional[float] = None,
+                 min_steps: Optional[int] = None):
+        self.min_seconds = min_seconds
+        self.min_steps = min_steps
+        self.last_time: Optional[float] = None
+        self.last_step: Optional[int] = None
+
+    def should_checkpoint(self, step: int, milestone: bool = False) -> bool:
+        """Returns if a checkpoint is committed, and records it if so.
+
+        Args:
+            step (int): step of the checkpoint
+            milestone (bool, optional): the checkpoint is a milestone.
+                Defaults to False.
+
+        Returns:
+            bool: True if the checkpoint must be committed
+        """
+        now = time.monotonic()
+        if (not milestone and self.last_time is not None and
+                (self.min_seconds is not None or self.min_steps is not None)):
+            seconds_passed = (self.min_seconds is not None and
+                              now - self.last_time >= self.min_seconds)
+            steps_passed = (self.min_steps is not None and
+                            step - self.last_step >= self.min_steps)
+            if not seconds_passed and not steps_passed:
+                return False
+        self.last_time = now
+        self.last_step = step
+        return True
+
+
+class CheckpointSnapshot(object):
+    """Contents of the metric files when a checkpoint was taken.
+
+    Args:
+        files (dict[str, bytes]): contents of each file, keyed by its path
+            relative to the root of the repository
+        message (str): message of the checkpoint commit
+        mark (Optional[int], optional): mark of the journal of the experiment
+            when the snapshot was taken. Defaults to None.
+        hashes (Optional[dict[str, pygit2.Oid]], optional): blob ids of the
+            files read, keyed by their path. Defaults to None.
+    """
+    __slots__ = ('files', 'message', 'mark', 'hashes')
+
+    def __init__(self, files: dict[str, bytes], message: str,
+                 mark: Optional[int] = None,
+                 hashes: Optional[dict[str, pygit2.Oid]] = None):
+        self.files = files
+        self.message = message
+        self.mark = mark
+        self.hashes = hashes if hashes is not None else {}
+
+    def committed(self, file_hashes: dict[str, pygit2.Oid]):
+        """Records the files of the snapshot once it is committed, so the
+        next snapshots leave them out if they don't change."""
+        file_hashes.update(self.hashes)
+
+    @classmethod
+    def take(cls, workdir: str, paths: list[Union[str, Path]], message: str,
+             file_hashes: Optional[dict[str, pygit2.Oid]] = None
+             ) -> 'CheckpointSnapshot':
+        """Reads the files under `paths`, which are relative to `workdir`.
+
+        Args:
+            workdir (str): root of the repository
+            paths (list[Union[str, Path]]): files or folders to be read
+            message (str): message of the checkpoint commit
+            file_hashes (Optional[dict[str, pygit2.Oid]], optional): blob ids
+                of the files in the last committed snapshot, files with the
+                same contents are left out of the snapshot. It isn't updated,
+                see `committed`. Defaults to None.
+
+        Returns:
+            CheckpointSnapshot: the snapshot
+        """
+        files = {}
+        hashes = {}
+        for path in paths:
+            for f in list_path(os.path.join(workdir, path)):
+                if is_temp_filename(f):
+                    continue
+                with open(f, 'rb') as fd:
+                    data = fd.read()
+                # Compared by contents, modification times may be too coarse
+                # to tell writes apart
+                blob_id = pygit2.hash(data)
+                if file_hashes is not None and file_hashes.get(f) == blob_id:
+                    continue
+                hashes[f] = blob_id
+                files[Path(os.path.relpath(f, workdir)).as_posix()] = data
+        return cls(files, message, hashes=hashes)
+
+
+class CheckpointPipeline(Thread):
+    """Commits and pushes checkpoints of an experiment on a background
+    thread.
+
+    The training thread only takes a snapshot of the metric files. The
+    worker commits the snapshots in order on the branch, and pushes it when
+    no more snapshots are waiting, so several checkpoints queued behind a
+    slow remote are pushed at once.
+
+    The worker uses its own AIRepo. Commits made by other threads while the
+    pipeline runs must hold `commit_lock`, the worker doesn't commit once
+    the pipeline is closed.
+
+    Args:
+        workdir (str): root of the repository
+        branch (str): qualified name of the branch the checkpoints are
+            committed to
+        remote (Optional[str], optional): remote the branch is pushed to, None
+            to only commit. Defaults to None.
+        stats (WriterStats, optional): stats updated by the pipeline.
+            Defaults to new stats.
+        journal (Optional[Journal], optional): journal the committed
+            checkpoints are recorded in. Defaults to None.
+        file_hashes (Optional[dict[str, pygit2.Oid]], optional): updated
+            with the files of each committed snapshot, see
+            `CheckpointSnapshot.committed`. Defaults to None.
+    """
+
+    def __init__(self, workdir: str, branch: str,
+                 remote: Optional[str] = None,
+                 stats: Optional[WriterStats] = None,
+                 journal: Optional['Journal'] = None,
+                 file_hashes: Optional[dict[str, pygit2.Oid]] = None):
+        super().__init__(daemon=True)
+        self.workdir = workdir
+        self.branch = branch
+        self.remote = remote
+        self.stats = stats if stats else WriterStats()
+        self.journal = journal
+        self.file_hashes = file_hashes
+        self.commit_lock = Lock()
+        self.cond = Condition()
+        self.pending: deque[CheckpointSnapshot] = deque()
+        self.enqueued = 0
+        self.done = 0
+        self.stopping = False
+        self.error: Optional[Exception] = None
+        self.start()
+
+    def enqueue(self, snapshot: CheckpointSnapshot):
+        with self.cond:
+            if self.stopping:
+                return
+            self.pending.append(snapshot)
+            self.enqueued += 1
+            self.cond.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits for every enqueued checkpoint to be committed and pushed.
+
+        Args:
+            timeout (Optional[float], optional): seconds to wait, None waits
+                until they are done. Defaults to None.
+
+        Returns:
+            bool: True if every checkpoint is done
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            target = self.enqueued
+            while self.done < target and self.is_alive():
+                remaining = (None if deadline is None
+                             else deadline - time.monotonic())
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if self.error:
+                raise ExperimentError.failed_checkpoint() from self.error
+            return self.done >= target
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """Drains the pipeline and stops the worker.
+
+        Args:
+            timeout (Optional[float], optional): seconds to wait for pending
+                checkpoints, None waits until they are done. Defaults to None.
+
+        Returns:
+            bool: True if every checkpoint was done in time. Otherwise the
+                remaining checkpoints are discarded, and the worker stops
+                after its current commit or push.
+        """
+        try:
+            drained = self.wait(timeout)
+        finally:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+        if drained:
+            self.join()
+        return drained
+
+    def __commit(self, repo: AIRepo, snapshot: CheckpointSnapshot):
+        with self.commit_lock, self.stats.timer('checkpoint_commit_seconds'):
+            if self.stopping:
+                return
+            commit = repo.commit_files(snapshot.files, snapshot.message,
+                                       self.branch)
+        if self.file_hashes is not None:
+            snapshot.committed(self.file_hashes)
+        if self.journal and snapshot.mark is not None:
+            self.journal.checkpoint(snapshot.message, commit, snapshot.mark)
+
+    def __push(self, repo: AIRepo):
+        with self.stats.timer('push_seconds'):
+            try:
+                repo.auth_and_push(self.remote, self.branch)
+            except Exception as e:
+                self.stats.increment('failed_pushes')
+                print("Warning: Failed to push experiment branch. %s" % e)
+
+    def run(self):
+        repo = AIRepo(self.workdir)
+        pushed = 0
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    self.pending.clear()
+                    return
+                snapshot = self.pending.popleft()
+            try:
+                self.__commit(repo, snapshot)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.stopping = True
+                    self.cond.notify_all()
+                return
+
+            committed = self.done + 1
+            with self.cond:
+                last = not self.pending
+            if self.remote and last and not self.stopping:
+                # Only the latest commit of a burst of checkpoints is pushed
+                self.stats.increment('coalesced_pushes',
+                                     committed - pushed - 1)
+                self.__push(repo)
+                pushed = committed
+            with self.cond:
+                self.done = committed
+                self.cond.notify_all()
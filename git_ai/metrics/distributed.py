@@ -0,0 +1,188 @@
+import time
+from enum import Enum
+from typing import Optional
+
+import torch.distributed as dist
+
+from git_ai.metrics.writer import GitMetricsWriter, to_python_value
+
+
+class Reduction(Enum):
+    MEAN = 0
+    SUM = 1
+    PER_RANK = 2
+
+
+def broadcast_name(exp_name: Optional[str]) -> Optional[str]:
+    """Sends the experiment name from rank 0 to all ranks, None if rank 0
+    failed to start the experiment."""
+    names = [exp_name]
+    dist.broadcast_object_list(names, src=0)
+    return names[0]
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class DistributedSummaryWriter(object):
+    """Summary writer for experiments running on several ranks.
+
+    Every rank buffers the scalars it logs. `gather` is a collective call
+    that sends the buffers to rank 0, which reduces them and logs them with
+    its GitMetricsWriter, the only one that writes to the
+    repository. Other ranks don't have a local writer.
+
+    Args:
+        writer (Optional[GitMetricsWriter]): writer of rank 0, None
+            in other ranks
+        reduction (Reduction, optional): how values logged by several ranks
+            for the same tag and step are combined. MEAN and SUM log a single
+            value, PER_RANK logs the value of each rank as `<tag>/rank_<n>`.
+            MEAN and SUM can't combine values that aren't numbers, such as
+            strings or booleans, the value of the lowest rank is logged
+            instead. Defaults to Reduction.MEAN.
+        group (optional): process group used to gather the scalars. Defaults
+            to the default group.
+    """
+
+    def __init__(self, writer: Optional[GitMetricsWriter],
+                 reduction: Reduction = Reduction.MEAN, group=None):
+        self.writer = writer
+        self.reduction = reduction
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        # tag -> [(step, value, walltime)]
+        self.buffer: dict[str, list[tuple]] = {}
+        # tag -> arguments of add_scalar other than the value, step and
+        # walltime, for tags logged with any of them
+        self.options: dict[str, dict] = {}
+        self.steps: dict[str, int] = {}
+
+    def add_scalar(self, tag, scalar_value, unit=None,
+                   data_type_=None, x_title=None,
+                   global_step=None, walltime=None,
+                   new_style=False, double_precision=False):
+        """Buffers a value, see `GitMetricsWriter.add_scalar`. The other
+        arguments are used when rank 0 logs the reduced value."""
+        points = self.buffer.setdefault(tag, [])
+        if global_step is None:
+            global_step = self.steps.get(tag, 0)
+        self.steps[tag] = global_step + 1
+        points.append((global_step, to_python_value(scalar_value),
+                       time.time() if walltime is None else walltime))
+        options = {'unit': unit, 'data_type_': data_type_,
+                   'x_title': x_title, 'new_style': new_style,
+                   'double_precision': double_precision}
+        if any(options.values()):
+            self.options[tag] = options
+
+    def add_scalars_batch(self, global_step, tag_scalar_dict: dict,
+                          walltime=None):
+        for tag, value in tag_scalar_dict.items():
+            self.add_scalar(tag, value, global_step=global_step,
+                            walltime=walltime)
+
+    def add_scalars_array(self, global_step, tags, values, walltime=None):
+        if hasattr(values, 'detach'):
+            values = values.detach().cpu()
+        values = values.tolist() if hasattr(values, 'tolist') else list(values)
+        for tag, value in zip(tags, values):
+            self.add_scalar(tag, value, global_step=global_step,
+                            walltime=walltime)
+
+    def add_hparams(self, *args, **kwargs):
+        if self.writer:
+            self.writer.add_hparams(*args, **kwargs)
+
+    def save_artifact(self, *args, **kwargs):
+        if self.writer:
+            self.writer.save_artifact(*args, **kwargs)
+
+    def add_topology(self, *args, **kwargs):
+        if self.writer:
+            self.writer.add_topology(*args, **kwargs)
+
+    def reduce(self, buffers: list[dict[str, list[tuple]]]) -> dict[int, dict]:
+        """Combines the buffers of all ranks.
+
+        Args:
+            buffers (list[dict[str, list[tuple]]]): buffer of each rank
+
+        Returns:
+            dict[int, dict]: values to be logged for each step, as a
+                (walltime, {tag: value}) tuple
+        """
+        per_step: dict[int, dict[str, list]] = {}
+        walltimes: dict[int, float] = {}
+        for rank, buffer in enumerate(buffers):
+            for tag, points in buffer.items():
+                if self.reduction == Reduction.PER_RANK:
+                    tag = "%s/rank_%d" % (tag, rank)
+                for step, value, walltime in points:
+                    per_step.setdefault(step, {}).setdefault(
+                        tag, []).append(value)
+                    walltimes[step] = max(walltime, walltimes.get(step, 0))
+
+        reduced = {}
+        for step in sorted(per_step.keys()):
+            values = {}
+            for tag, tag_values in per_step[step].items():
+                if (self.reduction != Reduction.PER_RANK and
+                        not all(is_number(v) for v in tag_values)):
+                    # Values are in rank order
+                    values[tag] = tag_values[0]
+                elif self.reduction == Reduction.MEAN:
+                    values[tag] = sum(tag_values) / len(tag_values)
+                elif self.reduction == Reduction.SUM:
+                    values[tag] = sum(tag_values)
+                else:
+                    # A rank logging the same tag twice in a step keeps the
+                    # last value
+                    values[tag] = tag_values[-1]
+            reduced[step] = (walltimes[step], values)
+        return reduced
+
+    def gather(self):
+        """Sends the scalars buffered by every rank to rank 0 and logs them.
+        Must be called by all ranks."""
+        buffer, self.buffer = self.buffer, {}
+        gathered = [None] * self.world_size if self.rank == 0 else None
+        dist.gather_object((buffer, self.options), gathered, dst=0,
+                           group=self.group)
+        if self.rank != 0 or not self.writer:
+            return
+
+        buffers = [b for b, _ in gathered]
+        options = {}
+        for rank, (_, rank_options) in enumerate(gathered):
+            for tag, tag_options in rank_options.items():
+                if self.reduction == Reduction.PER_RANK:
+                    tag = "%s/rank_%d" % (tag, rank)
+                options[tag] = tag_options
+        for step, (walltime, values) in self.reduce(buffers).items():
+            # Tags logged with other arguments are logged one at a time
+            batch = {tag: v for tag, v in values.items() if tag not in options}
+            for tag, value in values.items():
+                if tag in options:
+                    self.writer.add_scalar(tag, value, global_step=step,
+                                           walltime=walltime, **options[tag])
+            if batch:
+                self.writer.add_scalars_batch(step, batch, walltime)
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
+    def sync(self):
+        if self.writer:
+            self.writer.sync()
+
+    def dump_stats(self):
+        if self.writer:
+            self.writer.dump_stats()
+
+    def close(self, dump_stats: bool = True):
+        if self.writer:
+            self.writer.close(dump_stats)
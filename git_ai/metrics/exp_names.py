@@ -0,0 +1,106 @@
+import json
+import os
+import re
+import time
+from typing import Optional
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.cmd.constants import AIRepoConstants
+from git_ai.utils import file_lock
+
+
+class ExperimentNames(object):
+    """Allocates experiment names, `<commit>-<number>`, in a repository.
+
+    Numbers are taken from the experiment branches of the commit, local or
+    in the remotes. Remotes are listed without fetching any object, and the
+    listing is cached in `.git/git_ai` for `ttl` seconds. Names are allocated
+    holding a lock on the cache, and reserved in it, so launchers running in
+    parallel in the same repository never get the same name.
+
+    Args:
+        repo (AIRepo): repository of the experiments
+        ttl (float, optional): seconds a listing of a remote is reused.
+            Defaults to 30.
+    """
+    CACHE_FOLDER = AIRepoConstants.GIT_DIR_AI_FOLDER
+    CACHE_FILE = 'exp_names.json'
+    LOCK_FILE = 'exp_names.lock'
+    # Reserved names are kept until their branch is surely created
+    RESERVATION_TTL = 24 * 60 * 60
+
+    def __init__(self, repo: AIRepo, ttl: float = 30):
+        self.repo = repo
+        self.ttl = ttl
+        self.folder = os.path.join(repo.path, self.CACHE_FOLDER)
+
+    def lock(self):
+        return file_lock(os.path.join(self.folder, self.LOCK_FILE))
+
+    def __read_cache(self) -> dict:
+        try:
+            with open(os.path.join(self.folder, self.CACHE_FILE)) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache.setdefault('remotes', {})
+        cache.setdefault('reserved', {})
+        return cache
+
+    def __write_cache(self, cache: dict):
+        filename = os.path.join(self.folder, self.CACHE_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(filename + '.tmp', filename)
+
+    def __remote_branches(self, cache: dict) -> list[str]:
+        now = time.time()
+        branches = []
+        for remote in self.repo.remotes:
+            cached = cache['remotes'].get(remote.url)
+            if not cached or now - cached['time'] > self.ttl:
+                try:
+                    refs = self.repo.auth_and_ls_remotes(remote.name)
+                    cached = {
+                        'time': now,
+                        'branches': [r[len('refs/heads/'):] for r in refs
+                                     if r.startswith('refs/heads/exp/')],
+                    }
+                    cache['remotes'][remote.url] = cached
+                except Exception as e:
+                    print("Warning: Failed to list the branches of remote "
+                          "%s. %s" % (remote.name, e))
+            if cached:
+                branches.extend(cached['branches'])
+        return branches
+
+    def allocate(self, commit: Optional[str] = None) -> str:
+        """Returns a new experiment name for a commit.
+
+        Args:
+            commit (Optional[str], optional): commit the experiment starts
+                from. Defaults to HEAD.
+
+        Returns:
+            str: the name, `<first 8 characters of the commit>-<number>`,
+                with the number padded to 3 digits
+        """
+        commit = (commit if commit else str(self.repo.head.target))[0:8]
+        pattern = re.compile(r'exp/' + commit + r'-([0-9]+)$')
+        with self.lock():
+            cache = self.__read_cache()
+            now = time.time()
+            reserved = {name: t for name, t in cache['reserved'].items()
+                        if now - t < self.RESERVATION_TTL}
+
+            names = (self.__remote_branches(cache) +
+                     list(self.repo.branches) +
+                     ['exp/' + name for name in reserved])
+            numbers = [int(m.group(1)) for m in map(pattern.search, names)
+                       if m]
+            name = f"{commit}-{max(numbers, default=-1) + 1:03d}"
+
+            reserved[name] = now
+            cache['reserved'] = reserved
+            self.__write_cache(cache)
+        return name
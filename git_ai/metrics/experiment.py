@@ -1,72 +1,263 @@
+import json
 import os
 import pygit2
-from typing import Optional
-import re
+from typing import TYPE_CHECKING, Optional
 import signal
 import threading
+import time
 from git_ai.cmd.ai_repo.ai_repo import AIRepo
 from git_ai.errors.errors import ExperimentError
 from git_ai.utils import list_path
 from git_ai.cmd.constants import AIRepoConstants
-from git_ai.metrics.writer import GitTensorboardSummaryWriter
+from git_ai.metrics.checkpoint import (CheckpointPipeline, CheckpointPolicy,
+                                      CheckpointSnapshot)
+from git_ai.metrics.exp_names import ExperimentNames
+from git_ai.metrics.journal import Journal, recover
+from git_ai.metrics.outbox import PushOutbox
+from git_ai.metrics.stats import WriterStats
+from git_ai.metrics.writer import GitMetricsWriter
 
+if TYPE_CHECKING:
+    # Imports torch
+    from git_ai.metrics.distributed import Reduction
 
-def get_new_exp_name(repo: pygit2.Repository):
-    commit = repo.head.target.hex[0:8]
-    pattern = re.compile(r'exp/' + commit + '-([0-9]+)$')
-    for remote in repo.remotes:
-        repo.auth_and_fetch(remote.name)
 
-    all_branches = [b for b in repo.listall_references()]
-    this_commit_exps = [
-        (b, int(re.search(pattern, b).group(1)))
-        for b in all_branches if re.search(pattern, b)
-    ]
-    latest_commit_id = max(
-        this_commit_exps, key=lambda x: x[1], default=(None, -1))[1]
-    # Format is exp/commit-id-<latest_commit_id + 1> with the id being a number
-    # with 3 digits padded with 0s
-    return f"{commit}-{latest_commit_id + 1:03d}"
+def get_new_exp_name(repo: AIRepo):
+    # Format is <commit>-<number> with the number padded to 3 digits, see
+    # ExperimentNames
+    return ExperimentNames(repo).allocate()
 
 
 class Experiment(AIRepoConstants):
+    # Marks the checkpoints kept when the history of the experiment is squashed
+    MILESTONE_TAG = " #MILESTONE"
     _instance = None
+    # Experiments running in their own worktree, which can run concurrently
+    _worktree_instances: set['Experiment'] = set()
+    _instances_lock = threading.Lock()
 
-    def __new__(cls, *args, **kwargs) -> 'Experiment':
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            signal.signal(signal.SIGTERM, cls._instance.close)
-            signal.signal(signal.SIGINT, cls._instance.close)
-        else:
-            raise ExperimentError.experiment_already_started()
+    def __new__(cls, *args, worktree: Optional[bool] = None,
+                **kwargs) -> 'Experiment':
+        with cls._instances_lock:
+            if cls.use_worktree(worktree):
+                instance = super().__new__(cls)
+                cls._worktree_instances.add(instance)
+            elif cls._instance is None:
+                instance = cls._instance = super().__new__(cls)
+            else:
+                raise ExperimentError.experiment_already_started()
+
+        # Signal handlers can only be set from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, cls.close_all)
+            signal.signal(signal.SIGINT, cls.close_all)
+        return instance
+
+    @staticmethod
+    def use_worktree(worktree: Optional[bool]) -> bool:
+        if worktree is not None:
+            return worktree
+        return os.environ.get('DEPOT_EXP_WORKTREE') == '1'
+
+    @classmethod
+    def close_all(cls, signum=None, frame=None):
+        """Closes every running experiment.
+
+        On a signal, the experiments are closed by threads of their own, and
+        the handler waits for them for at most the longest
+        `shutdown_timeout`, see `close`.
+        """
+        with cls._instances_lock:
+            experiments = list(cls._worktree_instances)
+            if cls._instance:
+                experiments.append(cls._instance)
+        if signum is None:
+            for experiment in experiments:
+                experiment.close()
+            return
+        closing = [(e, e.start_close(signum)) for e in experiments]
+        deadline = time.monotonic() + max(
+            [e.shutdown_timeout for e in experiments], default=0)
+        for experiment, thread in closing:
+            if thread:
+                experiment.join_close(thread, deadline)
+
+    def __init__(self, repo_root: Optional[str] = None,
+                 distributed: bool = False,
+                 reduction: Optional['Reduction'] = None,
+                 async_checkpoints: bool = False,
+                 drain_timeout: Optional[float] = 60.0,
+                 shutdown_timeout: float = 20.0,
+                 worktree: Optional[bool] = None,
+                 checkpoint_policy: Optional[CheckpointPolicy] = None,
+                 squash_checkpoints: bool = False, **kwargs):
+        """Starts an experiment.
+
+        Args:
+            repo_root (Optional[str], optional): path inside the repository.
+                Defaults to the current folder.
+            distributed (bool, optional): the experiment runs on all the
+                ranks of the torch.distributed default group, which must be
+                initialized. Only rank 0 uses the repository, other ranks send
+                their scalars to it when they checkpoint or end the
+                experiment, which all ranks must do together. Defaults to
+                False.
+            reduction (Optional[Reduction], optional): how scalars of
+                different ranks are combined in distributed experiments.
+                Defaults to Reduction.MEAN.
+            async_checkpoints (bool, optional): checkpoints only take a
+                snapshot of the metrics, which is committed and pushed by a
+                CheckpointPipeline. Defaults to False.
+            drain_timeout (Optional[float], optional): seconds the end of the
+                experiment waits for pending checkpoints, None waits until
+                they are done. Defaults to 60.
+            shutdown_timeout (float, optional): seconds the experiment is
+                waited for when it is closed by SIGTERM or SIGINT, including
+                pending checkpoints and the last commit. The experiment is
+                only committed locally then, and its branch is left in the
+                PushOutbox. An experiment that can't be committed in time is
+                recovered from its journal later. Defaults to 20.
+            worktree (Optional[bool], optional): the experiment branch is
+                checked out in a worktree of its own, inside the .git folder,
+                instead of the working tree of the repository, which is left
+                untouched. Several experiments can run at the same time in
+                the same repository this way. The worktree is removed at the
+                end of the experiment. Defaults to True if DEPOT_EXP_WORKTREE
+                is 1, as in trials of a Sweep.
+            checkpoint_policy (Optional[CheckpointPolicy], optional): skips
+                checkpoints too close to the last one. Defaults to committing
+                every checkpoint.
+            squash_checkpoints (bool, optional): at the end of the
+                experiment, its branch is rewritten to keep only the
+                milestone checkpoints, and is force pushed. Commits of the
+                experiment that are not checkpoints are kept too.
+                Checkpoints are only committed locally then, the branch is
+                pushed once at the end. Defaults to False.
 
-        return cls._instance
+        Hparams in DEPOT_EXP_HPARAMS, a JSON object, are logged when the
+        experiment starts.
 
-    def __init__(self, repo_root: Optional[str] = None, **kwargs):
+        The experiment keeps a Journal in its working tree. Experiments of
+        processes that were killed are recovered from their journal, see
+        `recover`, before a new experiment starts.
+        """
         self.close_lock = threading.Lock()
         self.has_closed = False
-        self.repo = AIRepo(path=repo_root)
-        if not self.repo.is_ai_initialized():
-            raise ExperimentError.repository_not_initialized()
-
-        self.exp_name = os.environ.get(
-            'DEPOT_EXP_NAME', get_new_exp_name(self.repo))
-        self.original_branch = self.repo.get_current_branch()
-        self.writer = GitTensorboardSummaryWriter(repo=self.repo, **kwargs)
+        self.distributed = distributed
+        self.rank = 0
+        self.repo = None
+        # Repository the experiment was started from, when the experiment
+        # runs in a worktree
+        self.main_repo: Optional[AIRepo] = None
         self.made_first_commit = False
-        self.start_experiment(self.get_exp_branch() not in self.repo.branches)
+        self.checkpoints: Optional[CheckpointPipeline] = None
+        # Blob ids of the files in the last committed checkpoint
+        self.file_hashes: dict[str, pygit2.Oid] = {}
+        self.drain_timeout = drain_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.outbox: Optional[PushOutbox] = None
+        self.checkpoint_policy = checkpoint_policy
+        self.squash_checkpoints = squash_checkpoints
+        self.checkpoint_count = 0
+        # Last commit of the branch before this run of the experiment
+        self.start_commit: Optional[pygit2.Oid] = None
+        self.journal: Optional[Journal] = None
+        # Stats of the metrics path, shared with the writer of rank 0
+        self.stats = WriterStats()
+        if distributed:
+            from git_ai.metrics.distributed import (DistributedSummaryWriter,
+                                                    Reduction, broadcast_name)
+            import torch.distributed as dist
+            self.rank = dist.get_rank()
+            reduction = reduction if reduction else Reduction.MEAN
+
+        if self.rank != 0:
+            # Other ranks never touch the repository
+            self.exp_name = broadcast_name(None)
+            if not self.exp_name:
+                raise ExperimentError.failed_to_start_experiment()
+            self.writer = DistributedSummaryWriter(None, reduction)
+            return
+
+        try:
+            self.repo = AIRepo(path=repo_root)
+            if not self.repo.is_ai_initialized():
+                raise ExperimentError.repository_not_initialized()
+            try:
+                for name in recover(self.repo):
+                    print("Recovered interrupted experiment %s" % name)
+            except Exception as e:
+                print("Warning: Failed to recover interrupted experiments. "
+                      "%s" % e)
+            self.outbox = PushOutbox(self.repo)
+            self.sync()
+
+            self.exp_name = os.environ.get('DEPOT_EXP_NAME')
+            if not self.exp_name:
+                self.exp_name = get_new_exp_name(self.repo)
+            starting_new_experiment = (
+                self.get_exp_branch() not in self.repo.branches)
+            if self.use_worktree(worktree):
+                self.main_repo = self.repo
+                if starting_new_experiment:
+                    self.repo.branches.local.create(
+                        self.get_exp_branch(), self.repo.revparse_single('HEAD'))
+                self.repo = self.main_repo.add_branch_worktree(
+                    self.get_worktree_name(), self.get_exp_branch())
+            self.original_branch = self.repo.get_current_branch()
+            self.journal = Journal(self.repo.workdir)
+            self.writer = GitMetricsWriter(repo=self.repo,
+                                           journal=self.journal, **kwargs)
+            self.stats = self.writer.stats
+            self.start_experiment(starting_new_experiment)
+            self.start_commit = self.repo.references[
+                "refs/heads/%s" % self.get_exp_branch()].target
+            self.journal.start(
+                self.exp_name, "refs/heads/%s" % self.get_exp_branch(),
+                self.original_branch,
+                self.get_worktree_name() if self.main_repo else None,
+                [self.TENSORBOARD_PATH, self.TOPOLOGY_PATH,
+                 self.ARTIFACT_PATH])
+            hparams = os.environ.get('DEPOT_EXP_HPARAMS')
+            if hparams:
+                self.writer.add_hparams(hparam_dict=json.loads(hparams),
+                                        metric_dict={})
+            if async_checkpoints:
+                # Squashed branches are only pushed at the end
+                remote = ('origin' if 'origin' in
+                          [r.name for r in self.repo.remotes] and
+                          not squash_checkpoints else None)
+                self.checkpoints = CheckpointPipeline(
+                    self.repo.workdir, "refs/heads/%s" % self.get_exp_branch(),
+                    remote, self.stats, self.journal, self.file_hashes)
+        except Exception:
+            self.has_closed = True
+            if self.journal:
+                self.journal.end()
+            self.unregister()
+            if distributed:
+                broadcast_name(None)
+            raise
+
+        if distributed:
+            broadcast_name(self.exp_name)
+            self.writer = DistributedSummaryWriter(self.writer, reduction)
 
     def get_exp_branch(self):
         return "exp/%s" % self.exp_name
 
+    def get_worktree_name(self):
+        return "git-ai-%s" % self.exp_name
+
     def remove_existing_metrics(self):
-        removed_files = (list_path(self.METRICS_PATH) +
-                         [self.HPARAMS_JSON_PATH])
+        workdir = self.repo.workdir
+        removed_files = (list_path(os.path.join(workdir, self.METRICS_PATH)) +
+                         [os.path.join(workdir, self.HPARAMS_JSON_PATH)])
         actually_removed = []
         for f in removed_files:
             if os.path.isfile(f):
                 os.remove(f)
-                actually_removed.append(f)
+                actually_removed.append(os.path.relpath(f, workdir))
 
         # make sure metrics are in git
         actually_removed = [
@@ -86,13 +277,18 @@ class Experiment(AIRepoConstants):
             m = message + " #EXPERIMENT_ROOT"
         else:
             m = message
-        self.repo.commit(add_list, remove_list, m)
+        if self.checkpoints:
+            with self.checkpoints.commit_lock:
+                self.repo.commit(add_list, remove_list, m)
+        else:
+            self.repo.commit(add_list, remove_list, m)
 
     def start_experiment(self, starting_new_experiment):
         try:
             stasher = pygit2.Signature("Git AI", "gitai@gitai.ai")
-            self.repo.checkout_branch(
-                self.get_exp_branch(), new=starting_new_experiment)
+            if not self.main_repo:
+                self.repo.checkout_branch(
+                    self.get_exp_branch(), new=starting_new_experiment)
             new, modified, removed, _ = self.repo.get_wt_modified_files()
             if new or modified or removed:
                 self.commit_dirty_files(
@@ -106,53 +302,251 @@ class Experiment(AIRepoConstants):
             self.repo.make_ai_dirs()
         except Exception as e:
             self.writer.close()
-            self.repo.checkout_branch(self.original_branch)
+            self.leave_exp_branch()
             raise ExperimentError.failed_to_start_experiment() from e
 
-    def push(self):
-        self.repo.auth_and_push(
-            'origin', f"refs/heads/{self.get_exp_branch()}")
+    def leave_exp_branch(self):
+        """Goes back to the branch the experiment was started from, or
+        removes its worktree."""
+        if self.main_repo:
+            self.main_repo.remove_worktree(self.get_worktree_name())
+        else:
+            self.repo.checkout_branch(self.original_branch)
+
+    def push(self, force: bool = False):
+        with self.stats.timer('push_seconds'):
+            self.repo.auth_and_push(
+                'origin', f"refs/heads/{self.get_exp_branch()}", force)
+
+    def is_kept_by_squash(self, commit: pygit2.Commit) -> bool:
+        return (not commit.message.startswith("Checkpoint of ") or
+                self.MILESTONE_TAG in commit.message)
+
+    def checkpoint(self, checkpoint_name: str, step: Optional[int] = None,
+                   milestone: bool = False):
+        """Commits the metrics logged so far to the experiment branch, and
+        pushes it.
 
-    def checkpoint(self, checkpoint_name: str):
-        # TODO Check if current branch is correct
+        Args:
+            checkpoint_name (str): name of the checkpoint, in the message of
+                the commit
+            step (Optional[int], optional): step of the checkpoint for the
+                checkpoint policy. Defaults to the number of checkpoints
+                taken so far.
+            milestone (bool, optional): the checkpoint is always committed,
+                and is kept when the history is squashed. Defaults to False.
+        """
+        if self.distributed:
+            self.writer.gather()
+        if self.rank != 0 or self.has_closed:
+            # Experiments closed by a signal keep running until they exit
+            return
+        step = self.checkpoint_count if step is None else step
+        self.checkpoint_count += 1
+        if (self.checkpoint_policy and
+                not self.checkpoint_policy.should_checkpoint(step, milestone)):
+            self.stats.increment('skipped_checkpoints')
+            return
+        # Files written from now on are recovered after this checkpoint
+        mark = self.journal.mark()
         self.writer.flush()
-        self.__exp_commit(
-            self.metrics_file_list(),
-            [],
-            "Checkpoint of %s: %s" % (
-                self.get_exp_branch(), checkpoint_name
-            ),
-        )
-
-        # Check if there a remote to push to
-        if 'origin' not in [r.name for r in self.repo.remotes]:
+        self.writer.sync()
+        message = "Checkpoint of %s: %s" % (
+            self.get_exp_branch(), checkpoint_name)
+        if milestone:
+            message += self.MILESTONE_TAG
+        with self.stats.timer('checkpoint_snapshot_seconds'):
+            snapshot = CheckpointSnapshot.take(
+                self.repo.workdir, self.metrics_file_list(), message,
+                self.file_hashes)
+        snapshot.mark = mark
+        if self.checkpoints:
+            self.checkpoints.enqueue(snapshot)
             return
-        else:
+
+        with self.stats.timer('checkpoint_commit_seconds'):
+            commit = self.repo.commit_files(
+                snapshot.files, message, "refs/heads/%s" % self.get_exp_branch())
+        snapshot.committed(self.file_hashes)
+        self.journal.checkpoint(message, commit, mark)
+
+        # Check if there a remote to push to. Checkpoints squashed at the
+        # end of the experiment are never pushed
+        if (self.squash_checkpoints or
+                'origin' not in [r.name for r in self.repo.remotes]):
+            return
+        try:
             self.push()
+        except Exception as e:
+            # Trials of a sweep push to the same remote, a failed push is
+            # retried by the next checkpoint
+            self.stats.increment('failed_pushes')
+            print("Warning: Failed to push experiment branch. %s" % e)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the checkpoints taken so far to be committed and pushed.
+
+        Args:
+            timeout (Optional[float], optional): seconds to wait, None waits
+                until they are done. Defaults to None.
 
-    def end_experiment(self):
-        self.writer.close()
+        Returns:
+            bool: True if every checkpoint is done
+        """
+        if not self.checkpoints:
+            return True
+        return self.checkpoints.wait(timeout)
+
+    def sync(self):
+        """Pushes the branches left in the outbox by other experiments."""
+        try:
+            pushed, failed = self.outbox.drain()
+        except Exception as e:
+            print("Warning: Failed to push pending experiments. %s" % e)
+            return
+        for branch in pushed:
+            print("Pushed pending experiment branch %s" % branch)
+        for branch in failed:
+            print("Warning: Failed to push pending experiment branch %s" %
+                  branch)
+
+    def end_experiment(self, timeout: Optional[float] = None):
+        """Commits the metrics of the experiment, pushes its branch and
+        leaves it.
+
+        Args:
+            timeout (Optional[float], optional): seconds the end of the
+                experiment has, pending checkpoints are waited for what is
+                left of it instead of `drain_timeout`. With a timeout, the
+                branch is not pushed but left in the outbox, so the end of
+                the experiment doesn't wait for the network. Defaults to
+                None.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.distributed:
+            self.writer.gather()
+        self.writer.close(dump_stats=False)
+        if self.rank != 0:
+            return
+        try:
+            self.__end(deadline, timeout)
+        finally:
+            # The stats include the last commit and push
+            self.writer.dump_stats()
+
+    def __end(self, deadline: Optional[float], timeout: Optional[float]):
+        if self.checkpoints:
+            drain_timeout = self.drain_timeout
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                drain_timeout = (remaining if drain_timeout is None
+                                 else min(remaining, drain_timeout))
+            try:
+                if not self.checkpoints.close(drain_timeout):
+                    print("Warning: Pending checkpoints were not pushed in "
+                          "%s seconds, they are included in the last "
+                          "commit." % drain_timeout)
+            except ExperimentError as e:
+                print("Warning: %s %s" % (e, e.__cause__))
+        # Checkpoints are committed without the index, it is brought up to
+        # date before looking for the files changed since the last one
+        index = self.repo.index
+        index.read_tree(self.repo.head.peel(pygit2.Commit).tree)
+        index.write()
         to_add, to_remove = self.repo.get_ai_modified_files()
         if to_add or to_remove:
             self.__exp_commit(to_add, to_remove, "End of experiment commit")
-        try:
-            if [r for r in self.repo.remotes if r.name == 'origin']:
-                self.push()
-        except Exception as e:
-            print("Warning: Failed to push experiment branch. %s" % e)
-        self.repo.checkout_branch(self.original_branch)
+        if self.squash_checkpoints and self.start_commit:
+            self.repo.squash_commits(
+                "refs/heads/%s" % self.get_exp_branch(), self.start_commit,
+                self.is_kept_by_squash)
+        # Everything is committed, there's nothing left to recover
+        self.journal.end()
+        if [r for r in self.repo.remotes if r.name == 'origin']:
+            branch = "refs/heads/%s" % self.get_exp_branch()
+            if timeout is not None:
+                self.outbox.add('origin', branch, self.squash_checkpoints)
+                print("Experiment branch %s will be pushed by the next "
+                      "experiment or by git-ai sync" % branch)
+            else:
+                try:
+                    self.push(force=self.squash_checkpoints)
+                except Exception as e:
+                    print("Warning: Failed to push experiment branch, it will "
+                          "be pushed by the next experiment or by git-ai "
+                          "sync. %s" % e)
+                    self.outbox.add('origin', branch, self.squash_checkpoints,
+                                    str(e))
+        self.leave_exp_branch()
 
     def __enter__(self):
         # Checks if experiment branch exists
         return self
 
     def close(self, signum=None, frame=None):
-        with self.close_lock:
-            if self.has_closed:
-                return
-            self.has_closed = True
-            self.end_experiment()
-            Experiment._instance = None
+        """Ends the experiment, once.
+
+        Closing on a signal is bounded, the process may be killed soon
+        after. The experiment is closed by another thread, as the
+        interrupted thread may hold locks the end of the experiment needs,
+        and is waited for at most `shutdown_timeout` seconds.
+        """
+        if signum is None:
+            with self.close_lock:
+                self.__close(None)
+            return
+        thread = self.start_close(signum)
+        if thread:
+            self.join_close(thread,
+                            time.monotonic() + self.shutdown_timeout)
+
+    def start_close(self, signum) -> Optional[threading.Thread]:
+        """Starts closing the experiment on a thread, for a signal.
+
+        Returns:
+            Optional[threading.Thread]: the thread, None if the experiment
+                is already being closed
+        """
+        # A signal handler can run while the same thread is closing the
+        # experiment, it must not wait for it
+        if not self.close_lock.acquire(blocking=False):
+            return None
+        thread = threading.Thread(target=self.__close_and_release,
+                                  args=(signum,), daemon=True)
+        thread.start()
+        return thread
+
+    def join_close(self, thread: threading.Thread, deadline: float):
+        thread.join(max(0.0, deadline - time.monotonic()))
+        if thread.is_alive():
+            print("Warning: Experiment %s was not closed in %s seconds, it "
+                  "will be recovered by the next experiment or by git-ai "
+                  "recover" % (self.exp_name, self.shutdown_timeout))
+
+    def __close_and_release(self, signum):
+        try:
+            self.__close(signum)
+        except Exception as e:
+            print("Warning: Failed to close experiment %s. %s" %
+                  (self.exp_name, e))
+        finally:
+            self.close_lock.release()
+
+    def __close(self, signum):
+        if self.has_closed:
+            return
+        self.has_closed = True
+        try:
+            self.end_experiment(
+                self.shutdown_timeout if signum is not None else None)
+        finally:
+            self.unregister()
+
+    def unregister(self):
+        with Experiment._instances_lock:
+            if Experiment._instance is self:
+                Experiment._instance = None
+            Experiment._worktree_instances.discard(self)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
@@ -0,0 +1,256 @@
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Optional, Union
+
+import pygit2
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.cmd.constants import AIRepoConstants
+from git_ai.metrics.checkpoint import CheckpointSnapshot
+from git_ai.metrics.series import recover_series_folder
+
+
+class Journal(AIRepoConstants):
+    """Append-only journal of the experiment running in a working tree.
+
+    It records the experiment when it starts, every checkpoint committed and
+    the metric files written since, before they are written. If the process
+    is killed before the experiment ends, `recover` commits those files as a
+    checkpoint of the experiment from the journal, without looking at the
+    rest of the working tree.
+
+    The journal is `.git_ai/.journal`, a JSON record per line, and is never
+    committed, the `.git_ai/.gitignore` written by `init_ai_repo` ignores
+    it. It is removed when the experiment ends.
+
+    Args:
+        workdir (str): working tree of the experiment
+    """
+
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.filename = os.path.join(workdir, self.JOURNAL_PATH)
+        self.lock = Lock()
+        self.fd: Optional[int] = None
+        self.records = 0
+        # Files recorded since the last mark
+        self.pending: set[str] = set()
+
+    def __append(self, record: dict, sync: bool = False):
+        os.write(self.fd, (json.dumps(record) + '\n').encode())
+        self.records += 1
+        if sync:
+            os.fsync(self.fd)
+
+    def start(self, exp_name: str, branch: str, original_branch: str,
+              worktree: Optional[str], paths: list[Union[str, Path]]):
+        """Starts the journal of an experiment.
+
+        Args:
+            exp_name (str): name of the experiment
+            branch (str): qualified name of the experiment branch
+            original_branch (str): branch the experiment was started from
+            worktree (Optional[str]): name of the worktree of the
+                experiment, None if it runs in the working tree of the
+                repository
+            paths (list[Union[str, Path]]): files or folders written
+                without the journal, which are always recovered
+        """
+        with self.lock:
+            self.fd = os.open(self.filename,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                              os.O_APPEND)
+            self.records = 0
+            self.__append({
+                'event': 'start',
+                'exp_name': exp_name,
+                'branch': branch,
+                'original_branch': original_branch,
+                'worktree': worktree,
+                'paths': [Path(p).as_posix() for p in paths],
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'time': time.time(),
+            }, sync=True)
+            for path in self.pending:
+                self.__append({'event': 'segment', 'path': path})
+
+    def add_segment(self, filename: Union[str, os.PathLike]):
+        """Records a metric file before it is written."""
+        path = Path(os.path.relpath(filename, self.workdir)).as_posix()
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+            if self.fd is not None:
+                self.__append({'event': 'segment', 'path': path})
+
+    def mark(self) -> int:
+        """Marks the files written so far as taken by a checkpoint.
+
+        Returns:
+            int: the mark, passed to `checkpoint` once the checkpoint is
+                committed
+        """
+        with self.lock:
+            self.pending = set()
+            return self.records
+
+    def checkpoint(self, message: str, commit: Optional[pygit2.Oid],
+                   mark: int):
+        """Records a checkpoint that was committed.
+
+        Args:
+            message (str): message of the checkpoint
+            commit (Optional[pygit2.Oid]): commit of the checkpoint, None if
+                nothing changed
+            mark (int): mark taken with the files of the checkpoint
+        """
+        with self.lock:
+            if self.fd is None:
+                return
+            self.__append({
+                'event': 'checkpoint',
+                'message': message,
+                'commit': str(commit) if commit else None,
+                'mark': mark,
+                'time': time.time(),
+            }, sync=True)
+
+    def end(self):
+        """Removes the journal of an experiment that ended."""
+        with self.lock:
+            if self.fd is None:
+                return
+            os.close(self.fd)
+            self.fd = None
+            os.remove(self.filename)
+
+    @classmethod
+    def read(cls, workdir: str) -> list[dict]:
+        """Reads the records of the journal of a working tree.
+
+        Returns:
+            list[dict]: the records, empty if there's no journal. A record
+                left partially written is ignored.
+        """
+        records = []
+        try:
+            with open(os.path.join(workdir, cls.JOURNAL_PATH)) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+
+def is_abandoned(start: dict) -> bool:
+    """Returns if the process that started a journal is gone.
+
+    Processes running in other hosts are never considered gone.
+    """
+    if start['host'] != socket.gethostname():
+        return False
+    if start['pid'] == os.getpid():
+        return False
+    try:
+        os.kill(start['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def recover_journal(repo: AIRepo, main_repo: Optional[AIRepo] = None,
+                    force: bool = False) -> Optional[str]:
+    """Commits the metrics of an experiment left behind by a killed process
+    in a working tree.
+
+    The files written since the last checkpoint in the journal are committed
+    to the experiment branch, which is pushed to origin. Then the worktree
+    of the experiment is removed, or the working tree goes back to the
+    branch the experiment was started from.
+
+    Args:
+        repo (AIRepo): repository of the working tree
+        main_repo (Optional[AIRepo], optional): repository the worktree of
+            the experiment belongs to. Defaults to None.
+        force (bool, optional): recovers the journal even if the process
+            that wrote it could still be running. Defaults to False.
+
+    Returns:
+        Optional[str]: name of the recovered experiment, None if there was
+            nothing to recover
+    """
+    records = Journal.read(repo.workdir)
+    if not records or records[0].get('event') != 'start':
+        return None
+    start = records[0]
+    if not force and not is_abandoned(start):
+        return None
+
+    mark = 0
+    last_checkpoint = None
+    for record in records:
+        if record['event'] == 'checkpoint':
+            mark = record['mark']
+            last_checkpoint = record['message']
+    paths = list(dict.fromkeys(
+        start['paths'] +
+        [r['path'] for r in records[mark:] if r['event'] == 'segment']))
+    paths = [p for p in paths if os.path.exists(os.path.join(repo.workdir, p))]
+
+    recover_series_folder(os.path.join(repo.workdir, repo.METRICS_PATH))
+    branch = start['branch']
+    message = "Recovered checkpoint of %s: interrupted after %s" % (
+        branch[len('refs/heads/'):],
+        last_checkpoint if last_checkpoint else "the start of the experiment")
+    snapshot = CheckpointSnapshot.take(repo.workdir, paths, message)
+    repo.commit_files(snapshot.files, message, branch)
+    if 'origin' in [r.name for r in repo.remotes]:
+        try:
+            repo.auth_and_push('origin', branch)
+        except Exception as e:
+            print("Warning: Failed to push experiment branch. %s" % e)
+
+    if start['worktree'] and main_repo:
+        main_repo.remove_worktree(start['worktree'])
+    else:
+        os.remove(os.path.join(repo.workdir, repo.JOURNAL_PATH))
+        if repo.get_current_branch() == branch:
+            index = repo.index
+            index.read_tree(repo.references[branch].peel(pygit2.Commit).tree)
+            index.write()
+            repo.checkout_branch(start['original_branch'])
+    return start['exp_name']
+
+
+def recover(repo: AIRepo, force: bool = False) -> list[str]:
+    """Recovers the experiments killed in the working tree of a repository
+    and in the worktrees of experiments, see `recover_journal`.
+
+    Args:
+        repo (AIRepo): the repository
+        force (bool, optional): see `recover_journal`. Defaults to False.
+
+    Returns:
+        list[str]: names of the recovered experiments
+    """
+    recovered = [recover_journal(repo, force=force)]
+    for name in repo.list_worktrees():
+        worktree = repo.lookup_worktree(name)
+        if (not name.startswith('git-ai-') or worktree.is_prunable or
+                not os.path.isfile(os.path.join(worktree.path,
+                                                repo.JOURNAL_PATH))):
+            continue
+        recovered.append(
+            recover_journal(AIRepo(worktree.path), repo, force=force))
+    return [name for name in recovered if name]
@@ -0,0 +1,137 @@
+import json
+import os
+import time
+from typing import Optional
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.cmd.constants import AIRepoConstants
+from git_ai.utils import file_lock
+
+
+class PushOutbox(object):
+    """Pushes of experiment branches that are left for later.
+
+    Experiments closed by a signal, or whose push failed, add their branch
+    to the outbox instead of pushing it. The outbox is drained by `git-ai
+    sync` and when the next experiment starts. It is kept in `.git/git_ai`,
+    one entry per remote and branch, and is only changed holding a lock, so
+    several processes can use it.
+
+    Args:
+        repo (AIRepo): the repository, not a worktree of it
+    """
+    FOLDER = AIRepoConstants.GIT_DIR_AI_FOLDER
+    OUTBOX_FILE = 'outbox.json'
+    LOCK_FILE = 'outbox.lock'
+
+    def __init__(self, repo: AIRepo):
+        self.repo = repo
+        self.folder = os.path.join(repo.path, self.FOLDER)
+
+    def lock(self):
+        return file_lock(os.path.join(self.folder, self.LOCK_FILE))
+
+    def __read(self) -> list[dict]:
+        try:
+            with open(os.path.join(self.folder, self.OUTBOX_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def __write(self, entries: list[dict]):
+        filename = os.path.join(self.folder, self.OUTBOX_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    def entries(self) -> list[dict]:
+        with self.lock():
+            return self.__read()
+
+    def add(self, remote: str, branch: str, force: bool = False,
+            error: Optional[str] = None):
+        """Adds the push of a branch, merging it with a pending push of the
+        same branch.
+
+        Args:
+            remote (str): name of the remote
+            branch (str): qualified name of the branch
+            force (bool, optional): the branch was rewritten and must be force
+                pushed. Defaults to False.
+            error (Optional[str], optional): why the branch wasn't pushed.
+                Defaults to None.
+        """
+        with self.lock():
+            entries = self.__read()
+            entry = next((e for e in entries if e['remote'] == remote and
+                          e['branch'] == branch), None)
+            if not entry:
+                entry = {'remote': remote, 'branch': branch, 'force': False,
+                         'attempts': 0}
+                entries.append(entry)
+            entry['force'] = entry['force'] or force
+            entry['time'] = time.time()
+            entry['error'] = error
+            self.__write(entries)
+
+    def drain(self, retries: int = 1, backoff: float = 1.0
+              ) -> tuple[list[str], list[str]]:
+        """Pushes the branches in the outbox.
+
+        Branches that are pushed, or that no longer exist, leave the outbox.
+
+        Args:
+            retries (int, optional): attempts to push each branch. Defaults
+                to 1.
+            backoff (float, optional): seconds waited before the second
+                attempt, doubled on every attempt. Defaults to 1.0.
+
+        Returns:
+            tuple[list[str], list[str]]: branches pushed, and branches that
+                are still in the outbox
+        """
+        with self.lock():
+            entries = self.__read()
+        # Pushes are slow, the outbox isn't locked while they are done
+        pushed = []
+        failed = []
+        done = []
+        for entry in entries:
+            key = (entry['remote'], entry['branch'], entry['time'])
+            if (entry['branch'] not in self.repo.references or
+                    entry['remote'] not in
+                    [r.name for r in self.repo.remotes]):
+                done.append(key)
+                continue
+            delay = backoff
+            for attempt in range(retries):
+                if attempt:
+                    time.sleep(delay)
+                    delay *= 2
+                entry['attempts'] += 1
+                try:
+                    self.repo.auth_and_push(entry['remote'], entry['branch'],
+                                            entry['force'])
+                    pushed.append(entry['branch'])
+                    done.append(key)
+                    break
+                except Exception as e:
+                    entry['error'] = str(e)
+            else:
+                failed.append(entry['branch'])
+
+        if not entries:
+            return pushed, failed
+        drained = {(e['remote'], e['branch'], e['time']): e for e in entries}
+        with self.lock():
+            remaining = []
+            # Entries added again while they were pushed are kept
+            for entry in self.__read():
+                key = (entry['remote'], entry['branch'], entry['time'])
+                if key in done:
+                    continue
+                remaining.append(drained.get(key, entry))
+            self.__write(remaining)
+        return pushed, failed
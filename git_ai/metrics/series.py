@@ -0,0 +1,442 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Optional, Union
+
+# A metric series is stored as two files in the metrics folder: `<tag>_header`
+# is a small JSON object describing the series and `<tag>` holds the values.
+#
+# The original layout stores the values as a single JSON object
+# ({'values': [...], 'dataType': ...}), which has to be rewritten completely
+# every time a value is added. The append-only layout stores one JSON encoded
+# value per line, so a flush only appends the values logged since the last
+# one. The header records the format and the number of values that are known
+# to be complete, any trailing data past that count is ignored.
+#
+# Numeric series use the columnar layout: the file starts with a magic string
+# and every flush appends a chunk with the number of points in the chunk
+# followed by the value, global_step and walltime columns, each one a packed
+# little endian array of 8 byte items. Values are float64 for FLOAT series
+# and int64 for INT and BOOLEAN series, steps are int64 and walltimes are
+# float64. Since every field is 8 bytes long, all the columns are aligned
+# and can be mapped into array views without copying them.
+SERIES_FORMAT_JSON = 'json'
+SERIES_FORMAT_JSONL = 'jsonl'
+SERIES_FORMAT_COLUMNAR = 'columnar'
+
+COLUMNAR_MAGIC = b'GAISCOL1'
+# Files that are rewritten completely are written to a temporary file in the
+# same folder first, and renamed over the original once complete.
+TEMP_SUFFIX = '.tmp'
+HEADER_SUFFIX = '_header'
+_CHUNK_COUNT = struct.Struct('<Q')
+_ITEM_SIZE = 8
+COLUMN_TYPECODES = {'float64': 'd', 'int64': 'q'}
+_NUMPY_TYPES = {'float64': '<f8', 'int64': '<i8'}
+
+
+def series_format(header: dict) -> str:
+    return header.get('format', SERIES_FORMAT_JSON)
+
+
+def encode_jsonl(formatted_values: list[str]) -> str:
+    if not formatted_values:
+        return ''
+    return '\n'.join([json.dumps(v) for v in formatted_values]) + '\n'
+
+
+def decode_jsonl(data: Union[str, bytes], count: int = -1) -> list[str]:
+    """Decodes values stored with the append-only layout.
+
+    Args:
+        data (Union[str, bytes]): contents of the series file
+        count (int, optional): number of complete values recorded in the
+            header. Defaults to -1 which reads every complete line.
+
+    Returns:
+        list[str]: formatted values, in the order they were logged
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    lines = data.split('\n')
+    # The last element is either empty or a partially written line
+    lines = lines[:-1]
+    if count >= 0:
+        lines = lines[:count]
+    return [json.loads(line) for line in lines]
+
+
+def read_series_values(header: dict, data: Union[str, bytes]) -> list[str]:
+    """Reads the formatted values of a series regardless of its layout.
+
+    Args:
+        header (dict): parsed contents of the `<tag>_header` file
+        data (Union[str, bytes]): contents of the `<tag>` file
+
+    Returns:
+        list[str]: formatted values, as found in the 'values' entry of the
+            JSON layout. Values of columnar series are formatted without
+            losing precision.
+    """
+    layout = series_format(header)
+    if layout == SERIES_FORMAT_JSONL:
+        return decode_jsonl(data, header.get('count', -1))
+    elif layout == SERIES_FORMAT_COLUMNAR:
+        data_type = header['dataType']
+        series = ColumnarSeries(columnar_value_type(data_type), data,
+                                header.get('count', -1))
+        return [format_columnar_value(v, data_type) for v in series.values]
+    return json.loads(data)['values']
+
+
+def columnar_value_type(data_type: str) -> Optional[str]:
+    """Returns the type of the value column used for a data type.
+
+    Args:
+        data_type (str): data type of the series, as stored in the header
+
+    Returns:
+        Optional[str]: 'float64' or 'int64', None if the data type can't be
+            stored with the columnar layout
+    """
+    if data_type == 'FLOAT':
+        return 'float64'
+    elif data_type in ('INT', 'BOOLEAN'):
+        return 'int64'
+    return None
+
+
+def _pack(typecode: str, items) -> bytes:
+    column = array(typecode, items)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+def encode_columnar_chunk(value_type: str, values, steps, walltimes,
+                          with_magic: bool = False) -> bytes:
+    """Encodes points as a chunk of the columnar layout.
+
+    Args:
+        value_type (str): type of the value column, 'float64' or 'int64'
+        values: values of the points
+        steps: global step of each point
+        walltimes: walltime of each point
+        with_magic (bool, optional): prepend the magic string that starts a
+            series file. Defaults to False.
+
+    Returns:
+        bytes: encoded chunk, empty if there are no points to encode
+    """
+    magic = COLUMNAR_MAGIC if with_magic else b''
+    if not len(values):
+        return magic
+    return b''.join([
+        magic,
+        _CHUNK_COUNT.pack(len(values)),
+        _pack(COLUMN_TYPECODES[value_type], values),
+        _pack('q', steps),
+        _pack('d', walltimes),
+    ])
+
+
+class ColumnarSeries(object):
+    """Read only view of a series stored with the columnar layout.
+
+    Columns are exposed as memoryviews (or NumPy arrays) over the buffer the
+    series was read from, so loading a series does not copy or box its
+    values. Only complete chunks are read, up to `count` points.
+    """
+
+    def __init__(self, value_type: str, buffer, count: int = -1):
+        self.value_type = value_type
+        self.buffer = buffer
+        # (offset of the columns, points read, points in the chunk)
+        self.chunks: list[tuple[int, int, int]] = []
+        self.count = 0
+        # Offset after the last complete chunk that was read
+        self.end = 0
+
+        data = memoryview(buffer)
+        if len(data) < len(COLUMNAR_MAGIC):
+            return
+        if bytes(data[:len(COLUMNAR_MAGIC)]) != COLUMNAR_MAGIC:
+            raise ValueError("Metric series is not in the columnar format")
+
+        offset = len(COLUMNAR_MAGIC)
+        self.end = offset
+        while offset + _CHUNK_COUNT.size <= len(data):
+            if count >= 0 and self.count >= count:
+                break
+            n, = _CHUNK_COUNT.unpack_from(data, offset)
+            chunk_end = offset + _CHUNK_COUNT.size + 3 * n * _ITEM_SIZE
+            if chunk_end > len(data):
+                break
+            self.chunks.append((offset + _CHUNK_COUNT.size, n, n))
+            self.count += n
+            offset = chunk_end
+            self.end = offset
+
+        if count >= 0 and self.count > count:
+            # The header is behind the data, ignore the points it doesn't
+            # cover. The chunk can't be appended to anymore.
+            start, n, total = self.chunks[-1]
+            self.chunks[-1] = (start, n - (self.count - count), total)
+            self.count = count
+            self.end = -1
+
+    @classmethod
+    def from_file(cls, filename: Union[str, os.PathLike], value_type: str,
+                  count: int = -1) -> 'ColumnarSeries':
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(value_type, b'', count)
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(value_type, buffer, count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def is_complete(self, count: int) -> bool:
+        """True if the buffer ends right after `count` points, so new chunks
+        can be appended to it."""
+        return self.count == count and self.end == len(self.buffer)
+
+    def __column(self, column: int, typecode: str):
+        data = memoryview(self.buffer)
+        views = []
+        for start, n, total in self.chunks:
+            offset = start + column * total * _ITEM_SIZE
+            views.append(data[offset:offset + n * _ITEM_SIZE].cast(typecode))
+        if len(views) == 1 and sys.byteorder == 'little':
+            return views[0]
+        joined = array(typecode)
+        for v in views:
+            joined.frombytes(v.tobytes())
+        if sys.byteorder != 'little':
+            joined.byteswap()
+        return joined
+
+    @property
+    def values(self):
+        return self.__column(0, COLUMN_TYPECODES[self.value_type])
+
+    @property
+    def steps(self):
+        return self.__column(1, 'q')
+
+    @property
+    def walltimes(self):
+        return self.__column(2, 'd')
+
+    def to_numpy(self):
+        """Returns the value, step and walltime columns as NumPy arrays. The
+        arrays are views over the buffer if the series has a single chunk.
+        """
+        import numpy as np
+        columns = []
+        for column, dtype in enumerate([_NUMPY_TYPES[self.value_type],
+                                        '<i8', '<f8']):
+            parts = []
+            for start, n, total in self.chunks:
+                parts.append(np.frombuffer(
+                    self.buffer, dtype=dtype, count=n,
+                    offset=start + column * total * _ITEM_SIZE))
+            if len(parts) == 1:
+                columns.append(parts[0])
+            elif parts:
+                columns.append(np.concatenate(parts))
+            else:
+                columns.append(np.empty(0, dtype=dtype))
+        return tuple(columns)
+
+
+class ChunkedColumn(object):
+    """In-memory column of a series, stored as a list of typed chunks.
+
+    Items are appended by one thread. Another thread may drop leading chunks
+    whose items are already written to the series file with `drop_before`,
+    the last chunk is never dropped so appends are never lost.
+
+    Args:
+        typecode (Optional[str]): array typecode of the items, None to keep
+            them in lists
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, typecode: Optional[str]):
+        self.typecode = typecode
+        self.chunks: list = []
+        # Index of the first item still in memory
+        self.offset = 0
+        self.count = 0
+
+    def __new_chunk(self):
+        return array(self.typecode) if self.typecode else []
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, item):
+        chunks = self.chunks
+        if not chunks or len(chunks[-1]) >= self.CHUNK_SIZE:
+            chunks.append(self.__new_chunk())
+        chunks[-1].append(item)
+        self.count += 1
+
+    def pop(self):
+        """Removes the last item, which must be in memory."""
+        chunks = self.chunks
+        chunks[-1].pop()
+        if not chunks[-1] and len(chunks) > 1:
+            chunks.pop()
+        self.count -= 1
+
+    def extend(self, items):
+        """Appends items from a sequence or a typed memoryview, which is
+        copied without boxing its items."""
+        chunk = self.__new_chunk()
+        if isinstance(items, memoryview):
+            chunk.frombytes(items.cast('B'))
+        else:
+            chunk.extend(items)
+        if chunk:
+            self.chunks.append(chunk)
+            self.count += len(chunk)
+
+    def skip(self, count: int):
+        """Makes an empty column start after `count` items that are only in
+        the series file."""
+        self.offset = self.count = count
+
+    def slice(self, start: int, end: int):
+        """Returns the items in [start, end), which must be in memory."""
+        items = self.__new_chunk()
+        chunk_start = self.offset
+        for chunk in list(self.chunks):
+            chunk_end = chunk_start + len(chunk)
+            if chunk_end > start and chunk_start < end:
+                items.extend(chunk[max(start - chunk_start, 0):
+                                   end - chunk_start])
+            chunk_start = chunk_end
+            if chunk_start >= end:
+                break
+        return items
+
+    def drop_before(self, index: int) -> int:
+        """Drops the chunks that only have items before `index`.
+
+        Returns:
+            int: index of the first item still in memory
+        """
+        dropped = 0
+        chunk_end = self.offset
+        for chunk in self.chunks[:-1]:
+            if chunk_end + len(chunk) > index:
+                break
+            chunk_end += len(chunk)
+            dropped += 1
+        del self.chunks[:dropped]
+        self.offset = chunk_end
+        return self.offset
+
+    def tolist(self) -> list:
+        return self.slice(self.offset, self.count).tolist() \
+            if self.typecode else self.slice(self.offset, self.count)
+
+
+def format_columnar_value(value, data_type: str) -> str:
+    if data_type == 'FLOAT':
+        return repr(float(value))
+    elif data_type == 'BOOLEAN':
+        return 'true' if value else 'false'
+    return '%d' % value
+
+
+def temp_filename(filename: Union[str, os.PathLike]) -> str:
+    head, tail = os.path.split(filename)
+    return os.path.join(head, '.%s%s' % (tail, TEMP_SUFFIX))
+
+
+def is_temp_filename(filename: Union[str, os.PathLike]) -> bool:
+    name = os.path.basename(filename)
+    return name.startswith('.') and name.endswith(TEMP_SUFFIX)
+
+
+def valid_series_length(header: dict, filename: Union[str, os.PathLike]) -> int:
+    """Returns the length of the data covered by the header of a series.
+
+    Args:
+        header (dict): parsed contents of the `<tag>_header` file
+        filename (Union[str, os.PathLike]): file of the series
+
+    Returns:
+        int: number of bytes that hold complete values, -1 if the data
+            covered by the header doesn't end at the boundary of an append
+    """
+    layout = series_format(header)
+    count = header.get('count', -1)
+    if layout == SERIES_FORMAT_COLUMNAR:
+        series = ColumnarSeries.from_file(
+            filename, columnar_value_type(header['dataType']), count)
+        return series.end if series.count == count else -1
+    elif layout == SERIES_FORMAT_JSONL:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        end = 0
+        for _ in range(count):
+            end = data.find(b'\n', end)
+            if end < 0:
+                return -1
+            end += 1
+        return end
+    # Files in the JSON layout are always rewritten completely
+    return os.path.getsize(filename)
+
+
+def recover_series_folder(folder: Union[str, os.PathLike]) -> list[str]:
+    """Discards partially written files in a metrics folder.
+
+    Temporary files left by interrupted rewrites are removed, and data
+    appended to a series after the last complete write of its header is
+    truncated. Series with a header that can't be read are removed.
+
+    Args:
+        folder (Union[str, os.PathLike]): metrics folder
+
+    Returns:
+        list[str]: files that were removed or truncated
+    """
+    recovered = []
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if is_temp_filename(name):
+                os.remove(path)
+                recovered.append(path)
+                continue
+            if not name.endswith(HEADER_SUFFIX):
+                continue
+
+            series_path = path.removesuffix(HEADER_SUFFIX)
+            try:
+                with open(path, 'r') as f:
+                    header = json.load(f)
+                if not os.path.isfile(series_path):
+                    continue
+                length = valid_series_length(header, series_path)
+            except (ValueError, KeyError):
+                length = -1
+
+            if length < 0:
+                for p in (path, series_path):
+                    if os.path.isfile(p):
+                        os.remove(p)
+                        recovered.append(p)
+            elif length < os.path.getsize(series_path):
+                os.truncate(series_path, length)
+                recovered.append(series_path)
+    return recovered
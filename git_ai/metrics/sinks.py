@@ -0,0 +1,121 @@
+from enum import Enum
+from typing import Optional, Union
+
+from git_ai.errors.errors import MetricError
+
+
+class SinkType(Enum):
+    TENSORBOARD = 0
+    NONE = 1
+    # Tensorboard if torch and tensorboard are installed, no sink otherwise
+    AUTO = 2
+
+
+class MetricSink(object):
+    """Receives the metrics logged by a GitMetricsWriter, besides the metric
+    files it writes to the repository.
+
+    Subclasses override the methods for the metrics they handle, every
+    method does nothing by default.
+    """
+
+    def add_scalar(self, tag: str, value, global_step: Optional[int],
+                   walltime: Optional[float], **kwargs):
+        self.add_scalars(global_step, [tag], [value], walltime)
+
+    def add_scalars(self, global_step: Optional[int], tags: list[str],
+                    values: list, walltime: Optional[float]):
+        """Receives the values of several tags for the same step.
+
+        Args:
+            global_step (Optional[int]): step of the values
+            tags (list[str]): tag of each value
+            values (list): Python values, one for each tag
+            walltime (Optional[float]): walltime of the values
+        """
+
+    def add_hparams(self, hparam_dict: dict, metric_dict: dict,
+                    hparam_domain_discrete=None, run_name=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TensorboardSink(MetricSink):
+    """Writes the metrics to tensorboard event files.
+
+    torch and tensorboard are only imported when the sink is created.
+
+    Args:
+        log_dir (str): folder of the event files
+        **kwargs: passed to torch's SummaryWriter
+    """
+
+    def __init__(self, log_dir: str, **kwargs):
+        try:
+            from tensorboard.compat.proto.summary_pb2 import Summary
+            from torch.utils.tensorboard import SummaryWriter
+        except ImportError as e:
+            raise MetricError.missing_sink_dependency(
+                SinkType.TENSORBOARD.name, e.name) from e
+        self.summary_class = Summary
+        self.summary_writer = SummaryWriter(log_dir=log_dir, **kwargs)
+
+    def add_scalar(self, tag, value, global_step, walltime, **kwargs):
+        if not isinstance(value, str):
+            self.summary_writer.add_scalar(tag, value, global_step, walltime,
+                                           **kwargs)
+
+    def add_scalars(self, global_step, tags, values, walltime):
+        Summary = self.summary_class
+        # Event files can't hold strings
+        summary = Summary(value=[
+            Summary.Value(tag=tag, simple_value=value)
+            for tag, value in zip(tags, values) if not isinstance(value, str)])
+        self.summary_writer._get_file_writer().add_summary(
+            summary, global_step, walltime)
+
+    def add_hparams(self, hparam_dict, metric_dict,
+                    hparam_domain_discrete=None, run_name=None):
+        self.summary_writer.add_hparams(hparam_dict, metric_dict,
+                                        hparam_domain_discrete, run_name)
+
+    def flush(self):
+        self.summary_writer.flush()
+
+    def close(self):
+        self.summary_writer.close()
+
+
+def make_sinks(sinks: Union[SinkType, MetricSink, list, None],
+               log_dir: str, **kwargs) -> list[MetricSink]:
+    """Creates the sinks of a writer.
+
+    Args:
+        sinks (Union[SinkType, MetricSink, list, None]): a sink type, a sink
+            or a list of them. None is the same as SinkType.NONE.
+        log_dir (str): folder of the tensorboard event files
+        **kwargs: passed to the tensorboard sink
+
+    Returns:
+        list[MetricSink]: the sinks
+    """
+    if not isinstance(sinks, list):
+        sinks = [sinks]
+    created = []
+    for sink in sinks:
+        if sink == SinkType.TENSORBOARD:
+            created.append(TensorboardSink(log_dir, **kwargs))
+        elif sink == SinkType.AUTO:
+            try:
+                created.append(TensorboardSink(log_dir, **kwargs))
+            except MetricError as e:
+                print("Warning: Metrics are not sent to tensorboard. %s, "
+                      "install git-ai[tensorboard] to use it." % e)
+        elif isinstance(sink, MetricSink):
+            created.append(sink)
+    return created
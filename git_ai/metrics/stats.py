@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Union
+
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BOUNDS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0)
+
+
+class Histogram(object):
+    """Distribution of the values of a measure.
+
+    Args:
+        bounds (tuple[float], optional): upper bounds of the buckets, values
+            above the last one go to an overflow bucket. Defaults to
+            LATENCY_BOUNDS.
+    """
+
+    def __init__(self, bounds: tuple[float] = LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self) -> dict:
+        labels = ['<=%g' % b for b in self.bounds] + ['>%g' % self.bounds[-1]]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class WriterStats(object):
+    """Counters, gauges and histograms of the metrics path.
+
+    All methods can be called from any thread.
+
+    Counters:
+        enqueued: writes enqueued
+        coalesced: writes merged with a pending write to the same file
+        dropped: pending writes discarded by QueueFullPolicy.DROP_OLDEST
+        files_written: files written or appended to
+        bytes_written: bytes written or appended
+        scalars_logged: values logged by the summary writer
+
+    Gauges:
+        queue_depth: files waiting for the writer thread, and its maximum as
+            max_queue_depth
+
+    Histograms, in seconds:
+        serialize_seconds: time to serialize the contents of a file
+        write_seconds: time to write a file
+        enqueue_blocked_seconds: time producers waited for room in the queue
+        flush_blocked_seconds: time callers of flush waited for the writer
+        checkpoint_commit_seconds, push_seconds: commits and pushes of an
+            Experiment
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def increment(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+            max_name = 'max_' + name
+            self.gauges[max_name] = max(value, self.gauges.get(max_name, value))
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if not histogram:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observes the time spent in a with block in the `name` histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """Returns the current value of every stat."""
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: h.to_dict()
+                               for name, h in self.histograms.items()},
+            }
+
+    def dump(self, filename: Union[str, os.PathLike]):
+        """Appends a snapshot to a JSONL file."""
+        with open(filename, 'a') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
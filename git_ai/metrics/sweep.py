@@ -0,0 +1,219 @@
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import time
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from typing import Callable, Optional, Union
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.metrics.exp_names import ExperimentNames
+
+
+# Environment of the trials, read by Experiment
+EXP_NAME_ENV = 'DEPOT_EXP_NAME'
+EXP_WORKTREE_ENV = 'DEPOT_EXP_WORKTREE'
+EXP_HPARAMS_ENV = 'DEPOT_EXP_HPARAMS'
+
+
+def grid(space: dict[str, list]) -> list[dict]:
+    """Returns every combination of the values of the parameters.
+
+    Args:
+        space (dict[str, list]): values of each parameter
+
+    Returns:
+        list[dict]: parameters of each trial
+    """
+    names = list(space.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*space.values())]
+
+
+def random_space(space: dict, trials: int,
+                 seed: Optional[int] = None) -> list[dict]:
+    """Returns random parameters for a number of trials.
+
+    Args:
+        space (dict): distribution of each parameter. A list is sampled
+            uniformly, a (low, high) tuple is a uniform float in that range
+            and a callable is called with a random.Random.
+        trials (int): number of trials
+        seed (Optional[int], optional): seed of the random generator.
+            Defaults to None.
+
+    Returns:
+        list[dict]: parameters of each trial
+    """
+    rng = random.Random(seed)
+
+    def sample(distribution):
+        if callable(distribution):
+            return distribution(rng)
+        elif isinstance(distribution, tuple):
+            return rng.uniform(*distribution)
+        return rng.choice(distribution)
+
+    return [{name: sample(d) for name, d in space.items()}
+            for _ in range(trials)]
+
+
+class Trial(object):
+    """A run of a sweep with some parameters, in its own experiment."""
+
+    def __init__(self, index: int, params: dict, exp_name: str):
+        self.index = index
+        self.params = params
+        self.exp_name = exp_name
+        self.status = 'pending'
+        self.duration: Optional[float] = None
+        self.metrics: dict = {}
+        self.error: Optional[str] = None
+
+    def environment(self) -> dict[str, str]:
+        return {
+            EXP_NAME_ENV: self.exp_name,
+            EXP_WORKTREE_ENV: '1',
+            EXP_HPARAMS_ENV: json.dumps(self.params),
+        }
+
+
+def command_args(command: list[str], params: dict) -> list[str]:
+    """Formats the `{name}` fields of a command with the parameters, and
+    passes the parameters that aren't used as `--name=value` arguments."""
+    args = [arg.format(**params) for arg in command]
+    used = [name for name in params
+            if any('{%s}' % name in arg for arg in command)]
+    return args + ['--%s=%s' % (name, value) for name, value in params.items()
+                   if name not in used]
+
+
+def _run_callable_trial(repo_root: str, environment: dict[str, str],
+                        target: Callable,
+                        experiment_kwargs: dict) -> tuple[dict, float]:
+    # Runs in a worker process
+    from git_ai.metrics.experiment import Experiment
+    start = time.monotonic()
+    os.environ.update(environment)
+    params = json.loads(environment[EXP_HPARAMS_ENV])
+    with Experiment(repo_root=repo_root, **experiment_kwargs) as exp:
+        metrics = target(exp, params)
+        if metrics:
+            exp.writer.add_hparams(hparam_dict={}, metric_dict=metrics)
+    return (metrics if metrics else {}), time.monotonic() - start
+
+
+def _run_command_trial(repo_root: str, environment: dict[str, str],
+                       args: list[str]) -> tuple[dict, float]:
+    start = time.monotonic()
+    subprocess.run(args, cwd=repo_root, env={**os.environ, **environment},
+                   check=True)
+    return {}, time.monotonic() - start
+
+
+class Sweep(object):
+    """Runs trials of a training with different parameters in parallel.
+
+    Every trial is an experiment of its own, running in its own worktree, see
+    `Experiment`, so trials never share a working tree or an index. Names of
+    the experiments are allocated before the trials start, and are passed to
+    them in DEPOT_EXP_NAME. The parameters of each trial are logged as
+    hparams of its experiment.
+
+    Args:
+        params (list[dict]): parameters of each trial, see `grid` and
+            `random_space`
+        target (Union[Callable, list[str]]): a function called in a worker
+            process with the Experiment and the parameters of the trial,
+            which can return metrics to be logged as hparams, or a command
+            that creates an Experiment, see `command_args`
+        max_concurrency (int, optional): trials running at the same time.
+            Defaults to the number of CPUs.
+        repo_root (Optional[str], optional): path inside the repository.
+            Defaults to the current folder.
+        experiment_kwargs (Optional[dict], optional): arguments of the
+            Experiment of each trial when the target is a function. Defaults
+            to None.
+    """
+
+    def __init__(self, params: list[dict], target: Union[Callable, list[str]],
+                 max_concurrency: Optional[int] = None,
+                 repo_root: Optional[str] = None,
+                 experiment_kwargs: Optional[dict] = None):
+        self.repo = AIRepo(repo_root)
+        self.target = target
+        self.experiment_kwargs = experiment_kwargs if experiment_kwargs else {}
+        self.max_concurrency = (max_concurrency if max_concurrency
+                                else os.cpu_count())
+        names = ExperimentNames(self.repo)
+        self.trials = [Trial(i, p, names.allocate())
+                       for i, p in enumerate(params)]
+
+    def __executor(self):
+        if callable(self.target):
+            return ProcessPoolExecutor(
+                self.max_concurrency,
+                mp_context=multiprocessing.get_context('spawn'))
+        # Commands run in processes of their own
+        return ThreadPoolExecutor(self.max_concurrency)
+
+    def __submit(self, executor, trial: Trial):
+        if callable(self.target):
+            return executor.submit(_run_callable_trial, self.repo.workdir,
+                                   trial.environment(), self.target,
+                                   self.experiment_kwargs)
+        return executor.submit(_run_command_trial, self.repo.workdir,
+                               trial.environment(),
+                               command_args(self.target, trial.params))
+
+    def run(self, verbose: bool = True) -> list[Trial]:
+        """Runs every trial, printing their progress.
+
+        Returns:
+            list[Trial]: the trials, with their status, duration and metrics
+        """
+        total = len(self.trials)
+        finished = 0
+        with self.__executor() as executor:
+            running = {self.__submit(executor, trial): trial
+                       for trial in self.trials}
+            while running:
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial = running.pop(future)
+                    try:
+                        trial.metrics, trial.duration = future.result()
+                        trial.status = 'done'
+                    except Exception as e:
+                        trial.status = 'failed'
+                        trial.error = str(e)
+                    finished += 1
+                    if verbose:
+                        print("[%d/%d] %s %s" % (finished, total,
+                                                 trial.status, trial.exp_name))
+        if verbose:
+            print(self.summary())
+        return self.trials
+
+    def summary(self) -> str:
+        """Returns a table with the parameters and results of each trial."""
+        param_names = list(dict.fromkeys(
+            name for t in self.trials for name in t.params))
+        metric_names = list(dict.fromkeys(
+            name for t in self.trials for name in t.metrics))
+        header = (['trial', 'experiment', 'status', 'seconds'] +
+                  param_names + metric_names)
+        rows = [header]
+        for t in self.trials:
+            rows.append(
+                [str(t.index), t.exp_name, t.status,
+                 '%.1f' % t.duration if t.duration is not None else ''] +
+                [str(t.params.get(n, '')) for n in param_names] +
+                [str(t.metrics.get(n, '')) for n in metric_names])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join('  '.join(cell.ljust(w) for cell, w in
+                                   zip(row, widths)).rstrip()
+                         for row in rows)
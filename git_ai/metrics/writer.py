@@ -2,16 +2,26 @@ import json
 import os
 import time
 from enum import Enum
-from typing import IO, BinaryIO, Union
-from threading import Event, Thread
-import queue
+from collections import OrderedDict
+from typing import IO, TYPE_CHECKING, BinaryIO, Optional, Union
+from threading import Condition, Lock, RLock, Thread
 
-import torch
 from git_ai.cmd.ai_repo import AIRepo
 from git_ai.cmd.constants import AIRepoConstants
-from torch.utils.tensorboard import SummaryWriter
 
 from git_ai.errors.errors import MetricError
+from git_ai.metrics.series import (SERIES_FORMAT_COLUMNAR, SERIES_FORMAT_JSON,
+                                   SERIES_FORMAT_JSONL, ColumnarSeries,
+                                   COLUMN_TYPECODES, ChunkedColumn,
+                                   columnar_value_type, decode_jsonl,
+                                   encode_columnar_chunk, encode_jsonl,
+                                   recover_series_folder, temp_filename)
+from git_ai.metrics.sinks import (MetricSink, SinkType, TensorboardSink,
+                                  make_sinks)
+from git_ai.metrics.stats import WriterStats
+
+if TYPE_CHECKING:
+    from git_ai.metrics.journal import Journal
 
 
 class DataTypeEnum(Enum):
@@ -47,85 +57,273 @@ class DataTypeEnum(Enum):
             raise MetricError.unknown_data_type_enum(str(v))
 
 
-class AsynchFileWriter(Thread):
+class QueueFullPolicy(Enum):
+    BLOCK = 0
+    DROP_OLDEST = 1
+    COALESCE = 2
+
+
+class DurabilityPolicy(Enum):
+    NONE = 0
+    FLUSH = 1
+    CHECKPOINT = 2
+
 
-    def __init__(self) -> None:
+class AsynchFileWriter(Thread):
+    """Writes metric files on a background thread.
+
+    Writes are kept in an ordered map from filename to the object to be
+    written, so several writes to the same file before the writer gets to it
+    are coalesced into one. Objects are serialized on the writer thread when
+    they are written, not when they are enqueued.
+
+    Args:
+        max_pending (int, optional): maximum number of files waiting for the
+            writer thread, writes coalesced into a waiting file don't count.
+            Defaults to 0, no limit.
+        full_policy (QueueFullPolicy, optional): what to do when `max_pending`
+            files are waiting. BLOCK waits for the writer thread,
+            DROP_OLDEST discards the least recently enqueued file and
+            COALESCE never waits, relying on writes to the same file being
+            merged. Defaults to QueueFullPolicy.COALESCE.
+        linger (float, optional): seconds the writer waits for more writes
+            before writing a batch, unless there's a flush. Defaults to 0.1.
+        durability (DurabilityPolicy, optional): when written files are
+            synced to disk. NONE leaves it to the OS, FLUSH syncs them before
+            a flush returns and CHECKPOINT syncs them when `sync` is called.
+            Defaults to DurabilityPolicy.NONE.
+        stats (WriterStats, optional): stats updated by the writer. Defaults
+            to new stats.
+        journal (Optional[Journal], optional): journal every file is recorded
+            in before it is written. Defaults to None.
+
+    Files that are rewritten completely are written to a temporary file and
+    renamed, so they are never left partially written. Series are appended
+    to, and only the part covered by their header is valid, see
+    `recover_series_folder`.
+    """
+
+    def __init__(self, max_pending: int = 0,
+                 full_policy: QueueFullPolicy = QueueFullPolicy.COALESCE,
+                 linger: float = 0.1,
+                 durability: DurabilityPolicy = DurabilityPolicy.NONE,
+                 stats: Optional[WriterStats] = None,
+                 journal: Optional['Journal'] = None) -> None:
         super().__init__()
-        self.stop_event = Event()
-        self.flush_event = Event()
-        self.flush_done_event = Event()
-        self.q = queue.Queue()
-        self.writer_queue = []
-        self.pending_items = {}
+        self.stats = stats if stats else WriterStats()
+        self.journal = journal
+        self.max_pending = max_pending
+        self.full_policy = full_policy
+        self.linger = linger
+        self.durability = durability
+        # Files written since the last sync
+        self.sync_lock = Lock()
+        self.unsynced: set[str] = set()
+        self.cond = Condition()
+        # filename -> [mode, contents, number of coalesced writes]
+        self.pending_items: OrderedDict[str, list] = OrderedDict()
+        self.enqueued_seq = 0
+        self.written_seq = 0
+        self.flush_waiters = 0
+        self.blocked_producers = 0
+        self.stopping = False
+        self.failed = False
         self.start()
 
     def flush(self):
-        self.flush_event.set()
-        while not self.stop_event.is_set() and not self.flush_done_event.wait(0.1):
-            pass
-        if self.flush_done_event.is_set():
-            self.flush_done_event.clear()
+        start = time.perf_counter()
+        with self.cond:
+            target = self.enqueued_seq
+            self.flush_waiters += 1
+            self.cond.notify_all()
+            while self.written_seq < target and not self.failed:
+                self.cond.wait()
+            self.flush_waiters -= 1
+        if self.durability == DurabilityPolicy.FLUSH:
+            self.sync()
+        self.stats.observe('flush_blocked_seconds',
+                           time.perf_counter() - start)
+
+    def sync(self):
+        """Syncs every file written since the last sync, and the folders
+        they were renamed in, to disk."""
+        with self.sync_lock:
+            unsynced, self.unsynced = self.unsynced, set()
+        folders = set()
+        for filename in unsynced:
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            folders.add(os.path.dirname(filename))
+        for folder in folders:
+            fd = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def __enqueue(self, filename, mode, contents):
+        with self.cond:
+            if self.stopping:
+                return
+            if filename not in self.pending_items:
+                self.__wait_for_room()
+            self.enqueued_seq += 1
+            stats = self.stats
+            stats.increment('enqueued')
+            if filename in self.pending_items:
+                # Already waiting to be written, it will be serialized with
+                # its latest contents.
+                item = self.pending_items[filename]
+                item[1] = contents
+                item[2] += 1
+                self.pending_items.move_to_end(filename)
+                stats.increment('coalesced')
+            else:
+                self.pending_items[filename] = [mode, contents, 1]
+            stats.set_gauge('queue_depth', len(self.pending_items))
+            self.cond.notify_all()
+
+    def __wait_for_room(self):
+        if not self.max_pending:
+            return
+        if self.full_policy == QueueFullPolicy.BLOCK:
+            if len(self.pending_items) < self.max_pending:
+                return
+            self.blocked_producers += 1
+            self.cond.notify_all()
+            with self.stats.timer('enqueue_blocked_seconds'):
+                while (len(self.pending_items) >= self.max_pending and
+                       not self.stopping):
+                    self.cond.wait()
+            self.blocked_producers -= 1
+        elif self.full_policy == QueueFullPolicy.DROP_OLDEST:
+            while len(self.pending_items) >= self.max_pending:
+                _, (_, _, requests) = self.pending_items.popitem(last=False)
+                self.stats.increment('dropped', requests)
 
     def enqueue_write(self, filename, contents):
-        self.q.put((filename, contents.to_dict()), block=True)
+        """Enqueues a write of the whole contents of the file.
+
+        Args:
+            filename (str): file to be written
+            contents (JsonObj): object written with its `to_dict`
+        """
+        self.__enqueue(filename, 'w', contents)
 
-    def dequeue_writes(self) -> bool:
-        """Dequees an items from the process queue and puts it in an internal queue.
-        Keeps only the most recent item for each file. Pushes the file to the head
-        of the queue if it is already in the queue.
+    def enqueue_append(self, filename, contents):
+        """Enqueues the values of a series that have not been written yet.
 
-        Returns:
-            bool: True if is successful false if it fails
+        Args:
+            filename (str): file of the series
+            contents (Scalar): series with the values to be appended
         """
-        try:
-            while self.q.qsize() > 0:
-                filename, item = self.q.get()
-                # If the file is already in the queue, put it in the front
-                # If it is not, just append it
-                if filename in self.writer_queue:
-                    self.writer_queue.remove(filename)
-
-                self.writer_queue.append(filename)
-                self.pending_items[filename] = item
-        except FileNotFoundError:
-            return False
-        return True
-
-    def __worker_loop(self):
-        process_running = self.dequeue_writes()
-        if process_running:
-            for filename in self.writer_queue:
+        self.__enqueue(filename, 'a', contents)
+
+    def enqueue_batch(self, key, contents):
+        """Enqueues a write unit that covers several files.
+
+        Args:
+            key (str): key used to coalesce the unit with pending ones
+            contents (SeriesBatch): unit whose `take_writes` returns the
+                (filename, mode, contents) writes to be done
+        """
+        self.__enqueue(key, 'b', contents)
+
+    def __write(self, filename, mode, contents):
+        if mode == 'b':
+            for f, m, c in contents.take_writes():
+                self.__write(f, m, c)
+            return
+
+        stats = self.stats
+        start = time.perf_counter()
+        if mode == 'a':
+            truncate, data = contents.take_unwritten()
+            if not data and not truncate:
+                return
+            mode = 'w' if truncate else 'a'
+        else:
+            data = json.dumps(contents.to_dict())
+        serialized = time.perf_counter()
+        stats.observe('serialize_seconds', serialized - start)
+
+        if isinstance(data, bytes):
+            mode += 'b'
+        if self.journal:
+            self.journal.add_segment(filename)
+        target = filename if mode.startswith('a') else temp_filename(filename)
+        with open(target, mode) as f:
+            f.write(data)
+            f.flush()
+            if (self.durability == DurabilityPolicy.FLUSH and
+                    target != filename):
+                # The contents must be on disk before the rename is
+                os.fsync(f.fileno())
+        if target != filename:
+            os.replace(target, filename)
+        stats.observe('write_seconds', time.perf_counter() - serialized)
+        stats.increment('files_written')
+        stats.increment('bytes_written', len(data))
+
+        if self.durability != DurabilityPolicy.NONE:
+            with self.sync_lock:
+                self.unsynced.add(filename)
+
+    def __take_batch(self):
+        with self.cond:
+            while not self.pending_items and not self.stopping:
+                self.cond.wait()
+            if self.linger and not self.stopping:
+                deadline = time.monotonic() + self.linger
+                while not (self.flush_waiters or self.blocked_producers or
+                           self.stopping):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            batch = self.pending_items
+            self.pending_items = OrderedDict()
+            self.stats.set_gauge('queue_depth', 0)
+            seq = self.enqueued_seq
+            # Producers waiting for room can continue
+            self.cond.notify_all()
+        return batch, seq
+
+    def run(self):
+        while True:
+            batch, seq = self.__take_batch()
+            running = True
+            for filename, (mode, contents, _) in batch.items():
                 try:
-                    with open(filename, 'w') as f:
-                        json.dump(self.pending_items[filename], f)
-                        f.flush()
+                    self.__write(filename, mode, contents)
                 except Exception as e:
                     print("Error writing to file %s: %s" % (filename, str(e)))
-                    process_running = False
+                    running = False
                     break
-            self.writer_queue = []
-        return process_running
 
-    def run(self):
-        running = True
-        while not self.stop_event.is_set() and running:
-            running = self.__worker_loop()
-            if self.flush_event.is_set():
-                # Flush the queue
-                running = self.__worker_loop()
-                self.flush_event.clear()
-                self.flush_done_event.set()
-            time.sleep(0.1)
-        # This is flush
-        self.__worker_loop()
-        # Something went wrong
-        if not running:
-            print("File writer failed to write, won't be able to write further.")
-            self.stop_event.set()
+            with self.cond:
+                self.written_seq = seq
+                if not running:
+                    # Something went wrong
+                    print("File writer failed to write, won't be able to "
+                          "write further.")
+                    self.failed = True
+                    self.stopping = True
+                self.cond.notify_all()
+                if self.stopping and not self.pending_items:
+                    return
 
     def close(self):
         self.flush()
-        self.stop_event.set()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
         self.join()
 
 
@@ -241,18 +439,28 @@ class Hparams(JsonObj):
 
 
 class ScalarHeader(JsonObj):
-    def __init__(self, title, data_type, x_title=None, unit=None):
+    def __init__(self, title, data_type, x_title=None, unit=None,
+                 series_format=None, count=0):
         super().__init__()
         self.title = title
         self.x_title = x_title
         self.unit = unit
         self.data_type = data_type
+        if not series_format:
+            series_format = (
+                SERIES_FORMAT_COLUMNAR
+                if columnar_value_type(DataTypeEnum.to_string(data_type))
+                else SERIES_FORMAT_JSONL)
+        self.series_format = series_format
+        self.count = count
 
     def to_dict(self):
         dict = {
             'title': self.title,
             'x_title': self.x_title,
-            'dataType': DataTypeEnum.to_string(self.data_type)
+            'dataType': DataTypeEnum.to_string(self.data_type),
+            'format': self.series_format,
+            'count': self.count
         }
 
         if self.unit:
@@ -265,18 +473,200 @@ class ScalarHeader(JsonObj):
         unit = None if ('unit' not in json) else json['unit']
         x_title = None if ('x_title' not in json) else json['x_title']
         data_type = DataTypeEnum.from_string(json['dataType'])
+        series_format = json.get('format', SERIES_FORMAT_JSON)
+        count = json.get('count', 0)
         return cls(json['title'], data_type=data_type, unit=unit,
-                   x_title=x_title)
+                   x_title=x_title, series_format=series_format, count=count)
 
 
 class Scalar(JsonObj):
-    def __init__(self, values, data_type):
+    """Values of a series, with the global step and walltime of each one.
+
+    Values are kept in typed chunks. With `max_resident`, chunks that are
+    already in the series file are dropped from memory once the series has
+    more than `max_resident` values in memory, and are read back from the
+    file when the whole history is requested.
+
+    Values are checked before they are appended, so the columns always have
+    the same length. A float logged to an INT or BOOLEAN series turns it
+    into a FLOAT series, which is written again from scratch.
+    """
+
+    def __init__(self, values, data_type, written=0, steps=None,
+                 walltimes=None, max_resident=0):
         super().__init__()
-        self.values = values
         self.data_type = data_type
+        self.value_column = ChunkedColumn(COLUMN_TYPECODES.get(self.value_type))
+        self.step_column = ChunkedColumn('q')
+        self.walltime_column = ChunkedColumn('d')
+        self.value_column.extend(values)
+        self.step_column.extend(steps if steps is not None
+                                else range(len(values)))
+        self.walltime_column.extend(walltimes if walltimes is not None
+                                    else [0.0] * len(values))
+        # Number of values already in the file using the append-only layout.
+        # When it is 0, the next write recreates the file from scratch.
+        self.written = written
+        # Header whose count is updated when values are written
+        self.header = None
+        # File the values dropped from memory are read from
+        self.filename = None
+        self.max_resident = max_resident
+        # Guards the columns against being replaced or spilled while they
+        # are read
+        self.history_lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.value_column)
+
+    @property
+    def series_format(self):
+        if self.value_type:
+            return SERIES_FORMAT_COLUMNAR
+        return SERIES_FORMAT_JSONL
+
+    @property
+    def value_type(self):
+        return columnar_value_type(DataTypeEnum.to_string(self.data_type))
+
+    @property
+    def resident(self) -> int:
+        """Number of values kept in memory."""
+        return len(self) - self.value_column.offset
+
+    @property
+    def values(self) -> list:
+        values = self.__history()[0]
+        if self.data_type == DataTypeEnum.BOOLEAN:
+            values = [bool(v) for v in values]
+        return values
+
+    @property
+    def steps(self) -> list:
+        return self.__history()[1]
+
+    @property
+    def walltimes(self) -> list:
+        return self.__history()[2]
+
+    def __history(self) -> tuple[list, list, list]:
+        columns = [self.value_column, self.step_column, self.walltime_column]
+        with self.history_lock:
+            # Chunks of the columns may not line up, items before the last
+            # dropped one are read from the file for every column
+            spilled = max(c.offset for c in columns)
+            if not spilled:
+                return tuple(c.tolist() for c in columns)
+            on_disk = self.__read_written(spilled)
+            return tuple(d + list(c.slice(spilled, len(self)))
+                         for d, c in zip(on_disk, columns))
+
+    def __read_written(self, count: int) -> tuple[list, list, list]:
+        if self.value_type:
+            series = ColumnarSeries.from_file(self.filename, self.value_type,
+                                              count)
+            return (series.values.tolist(), series.steps.tolist(),
+                    series.walltimes.tolist())
+        with open(self.filename, 'r') as f:
+            values = [self.read_value(v, self.data_type)
+                      for v in decode_jsonl(f.read(), count)]
+        return values, list(range(count)), [0.0] * count
+
+    def add_value(self, value, global_step=None, walltime=None):
+        step = len(self) if global_step is None else int(global_step)
+        walltime = time.time() if walltime is None else float(walltime)
+        value = self.__column_value(value)
+        appended = []
+        try:
+            # The value goes last, values up to len(self) are always
+            # complete
+            for column, item in ((self.step_column, step),
+                                 (self.walltime_column, walltime),
+                                 (self.value_column, value)):
+                column.append(item)
+                appended.append(column)
+        except BaseException:
+            # Columns never have different lengths
+            for column in appended:
+                column.pop()
+            raise
+
+    def __column_value(self, value):
+        """Returns a value as it is stored in the value column, widening the
+        column if the value doesn't fit in it."""
+        value_type = self.value_type
+        if not value_type:
+            return value
+        if not isinstance(value, (bool, int, float)):
+            raise MetricError.mismatched_value_type(
+                DataTypeEnum.to_string(self.data_type), type(value).__name__)
+        if value_type == 'float64':
+            return float(value)
+        if isinstance(value, float) or not -2 ** 63 <= value < 2 ** 63:
+            self.__widen()
+            return float(value)
+        return value
+
+    def __widen(self):
+        """Turns the series into a FLOAT series, with every value in
+        memory, so it is written again."""
+        with self.history_lock:
+            values, steps, walltimes = self.__history()
+            self.data_type = DataTypeEnum.FLOAT
+            self.value_column = ChunkedColumn(
+                COLUMN_TYPECODES[self.value_type])
+            self.value_column.extend([float(v) for v in values])
+            self.step_column = ChunkedColumn('q')
+            self.step_column.extend(steps)
+            self.walltime_column = ChunkedColumn('d')
+            self.walltime_column.extend(walltimes)
+            self.written = 0
+
+    def take_unwritten(self) -> tuple[bool, Union[str, bytes]]:
+        """Encodes the values that have not been written to the series file.
+
+        Values written by previous calls may be dropped from memory.
 
-    def add_value(self, value):
-        self.values.append(value)
+        Returns:
+            tuple[bool, Union[str, bytes]]: True if the file has to be
+                truncated before writing, and the data to be written
+        """
+        with self.history_lock:
+            truncate = self.written == 0
+            start, end = self.written, len(self)
+            values = self.value_column.slice(start, end)
+            if self.value_type:
+                data = encode_columnar_chunk(
+                    self.value_type, values,
+                    self.step_column.slice(start, end),
+                    self.walltime_column.slice(start, end),
+                    with_magic=truncate)
+            else:
+                data = encode_jsonl([self.format_value(v, self.data_type)
+                                     for v in values])
+            self.written = end
+            if self.header:
+                # The header is written after the data, with its type
+                self.header.data_type = self.data_type
+                self.header.count = end
+            if self.max_resident and self.filename:
+                self.spill(start)
+        return truncate, data
+
+    def spill(self, written: int):
+        """Drops values that are in the series file from memory, keeping at
+        least the last `max_resident` values.
+
+        Args:
+            written (int): number of values known to be in the file
+        """
+        keep_from = min(written, len(self) - self.max_resident)
+        if keep_from <= self.value_column.offset:
+            return
+        with self.history_lock:
+            for column in [self.value_column, self.step_column,
+                           self.walltime_column]:
+                column.drop_before(keep_from)
 
     def to_dict(self):
         return {
@@ -285,74 +675,369 @@ class Scalar(JsonObj):
             'dataType': DataTypeEnum.to_string(self.data_type)
         }
 
+    def to_columnar(self) -> bytes:
+        """Encodes the whole series with the columnar layout.
+
+        Returns:
+            bytes: contents of a columnar series file
+        """
+        if not self.value_type:
+            raise MetricError.not_columnar_data_type(
+                DataTypeEnum.to_string(self.data_type))
+        values, steps, walltimes = self.__history()
+        return encode_columnar_chunk(self.value_type, values, steps,
+                                     walltimes, with_magic=True)
+
     @classmethod
     def from_json(cls, json):
         data_type = DataTypeEnum.from_string(json['dataType'])
         values = [cls.read_value(v, data_type) for v in json['values']]
         return cls(values, data_type)
 
+    @classmethod
+    def from_columnar(cls, series: ColumnarSeries, data_type, **kwargs):
+        return cls(series.values, data_type, steps=series.steps,
+                   walltimes=series.walltimes, **kwargs)
 
-class GitTensorboardSummaryWriter(SummaryWriter, AIRepoConstants):
+    @classmethod
+    def from_series_file(cls, filename, header: ScalarHeader,
+                         max_resident=0, lazy=False):
+        """Reads a series stored with any of the supported layouts.
+
+        Args:
+            filename (str): file of the series
+            header (ScalarHeader): header of the series
+            max_resident (int, optional): see `Scalar`. Defaults to 0.
+            lazy (bool, optional): if the file can be appended to, only its
+                header is used and values are read from the file when the
+                whole history is requested. Defaults to False.
 
-    def __init__(self, repo: AIRepo, **kwargs):
+        Returns:
+            Scalar: the series, or None if the file does not exist
+        """
+        if header.series_format == SERIES_FORMAT_JSON:
+            scalar = cls.from_file(filename)
+            if scalar:
+                scalar.max_resident = max_resident
+                scalar.filename = filename
+            return scalar
+        if not os.path.isfile(filename):
+            return None
+
+        if lazy:
+            scalar = cls([], header.data_type, max_resident=max_resident)
+            if (scalar.series_format == header.series_format and
+                    cls.__can_append(filename, header)):
+                for column in [scalar.value_column, scalar.step_column,
+                               scalar.walltime_column]:
+                    column.skip(header.count)
+                scalar.written = header.count
+                scalar.filename = filename
+                return scalar
+
+        if header.series_format == SERIES_FORMAT_COLUMNAR:
+            series = ColumnarSeries.from_file(
+                filename,
+                columnar_value_type(DataTypeEnum.to_string(header.data_type)),
+                header.count)
+            scalar = cls.from_columnar(series, header.data_type,
+                                       max_resident=max_resident)
+            complete = series.is_complete(header.count)
+        else:
+            with open(filename, 'r') as f:
+                data = f.read()
+            formatted_values = decode_jsonl(data)
+            scalar = cls([cls.read_value(v, header.data_type)
+                          for v in formatted_values[:header.count]],
+                         header.data_type, max_resident=max_resident)
+            complete = ((not data or data.endswith('\n')) and
+                        len(formatted_values) == header.count)
+
+        # Only keep appending to files that match their header, otherwise
+        # the whole series is written again.
+        scalar.written = len(scalar) if complete else 0
+        scalar.filename = filename
+        return scalar
+
+    @staticmethod
+    def __can_append(filename, header: ScalarHeader) -> bool:
+        # Checks the layout of the file without decoding its values
+        if header.series_format == SERIES_FORMAT_COLUMNAR:
+            return ColumnarSeries.from_file(
+                filename,
+                columnar_value_type(DataTypeEnum.to_string(header.data_type)),
+                header.count).is_complete(header.count)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return ((not data or data.endswith(b'\n')) and
+                data.count(b'\n') == header.count)
+
+
+class TagSeries(object):
+    """State kept by the writer for every tag it logs."""
+    __slots__ = ('filename', 'header_filename', 'scalar', 'header')
+
+    def __init__(self, filename: str, header_filename: str, scalar: Scalar,
+                 header: ScalarHeader):
+        self.filename = filename
+        self.header_filename = header_filename
+        self.scalar = scalar
+        self.header = header
+
+
+class SeriesBatch(object):
+    """Write unit for every series with values that haven't been written.
+
+    Logging marks series as dirty and enqueues the batch, which is coalesced
+    with the pending one, so the async writer gets a single unit no matter
+    how many tags are logged.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.dirty: dict[str, TagSeries] = {}
+
+    def mark(self, series: TagSeries):
+        with self.lock:
+            self.dirty[series.filename] = series
+
+    def mark_all(self, series_list: list[TagSeries]):
+        with self.lock:
+            for series in series_list:
+                self.dirty[series.filename] = series
+
+    def take_writes(self) -> list[tuple]:
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        writes = []
+        for series in dirty.values():
+            # Headers go after the values, see Scalar.take_unwritten
+            writes.append((series.filename, 'a', series.scalar))
+            writes.append((series.header_filename, 'w', series.header))
+        return writes
+
+
+def to_python_value(value):
+    # Tensors and NumPy scalars
+    return value.item() if hasattr(value, 'item') else value
+
+
+class GitMetricsWriter(AIRepoConstants):
+    """Writes the metrics of an experiment to the repository.
+
+    Metrics are also sent to the sinks of the writer. By default they go to
+    tensorboard when torch and tensorboard are installed, as the
+    `tensorboard` extra does, and to no sink otherwise. With
+    `SinkType.NONE`, neither torch nor tensorboard are imported.
+
+    Args:
+        repo (AIRepo): repository of the experiment
+        max_pending_writes (int, optional): see `AsynchFileWriter`.
+            Defaults to 0.
+        full_policy (QueueFullPolicy, optional): see `AsynchFileWriter`.
+            Defaults to QueueFullPolicy.COALESCE.
+        durability (DurabilityPolicy, optional): see `AsynchFileWriter`.
+            Defaults to DurabilityPolicy.NONE.
+        max_resident_points (int, optional): values of each series kept in
+            memory once they are written, 0 keeps the whole series. Defaults
+            to 0.
+        sinks (Union[SinkType, MetricSink, list, None], optional): sink type,
+            sink or list of them. SinkType.TENSORBOARD fails if torch or
+            tensorboard are missing. Defaults to SinkType.AUTO.
+        stats_file (Optional[str], optional): JSONL file the stats of the
+            writer are appended to when it is closed. Defaults to None.
+        journal (Optional[Journal], optional): journal of the experiment, see
+            `AsynchFileWriter`. Defaults to None.
+        **kwargs: passed to the tensorboard sink
+    """
+    SERIES_BATCH_KEY = '<series>'
+
+    def __init__(self, repo: AIRepo, max_pending_writes: int = 0,
+                 full_policy: QueueFullPolicy = QueueFullPolicy.COALESCE,
+                 durability: DurabilityPolicy = DurabilityPolicy.NONE,
+                 max_resident_points: int = 0,
+                 sinks: Union[SinkType, MetricSink, list,
+                              None] = SinkType.AUTO,
+                 stats_file: Optional[str] = None,
+                 journal: Optional['Journal'] = None, **kwargs):
         self.workdir = repo.workdir
+        self.max_resident_points = max_resident_points
         self._tb_folder = os.path.join(self.workdir, self.GIT_AI_ROOT,
                                        self.TENSORBOARD_FOLDER)
+        self.sinks = make_sinks(sinks, self._tb_folder, **kwargs)
+        self.stats = WriterStats()
+        self.stats_file = stats_file
+        # Values logged once the writer is closed are dropped
+        self.closed = False
 
-        super().__init__(log_dir=self._tb_folder, **kwargs)
         self.hparams = None
         self.scalars = {}
         self.scalar_headers = {}
-        self.async_writer = AsynchFileWriter()
+        self.tag_series: dict[str, TagSeries] = {}
+        self.series_batch = SeriesBatch()
+        self.recover()
+        self.async_writer = AsynchFileWriter(max_pending=max_pending_writes,
+                                             full_policy=full_policy,
+                                             durability=durability,
+                                             stats=self.stats,
+                                             journal=journal)
+
+    def __getattr__(self, name):
+        # Other SummaryWriter methods, like add_histogram, go to the
+        # tensorboard sink
+        for sink in self.__dict__.get('sinks', []):
+            if isinstance(sink, TensorboardSink):
+                return getattr(sink.summary_writer, name)
+        raise AttributeError("'%s' object has no attribute '%s'" %
+                             (type(self).__name__, name))
+
+    def get_tag_series(self, tag, data_type, unit=None,
+                       x_title=None) -> TagSeries:
+        """Returns the state of a tag, loading its series if it exists.
+
+        Args:
+            tag (str): tag of the series
+            data_type (DataTypeEnum): data type used for new series
+            unit (str, optional): unit used for new series. Defaults to None.
+            x_title (str, optional): x title used for new series. Defaults
+                to None.
+
+        Returns:
+            TagSeries: state of the tag
+        """
+        series = self.tag_series.get(tag)
+        if series:
+            return series
+
+        scalar_filename = self.metric_filename(self.workdir, tag)
+        scalar_header_filename = scalar_filename + '_header'
+        scalar_header = ScalarHeader.from_file(scalar_header_filename)
+        if not scalar_header:
+            scalar_header = ScalarHeader(
+                title=tag, x_title=x_title, unit=unit, data_type=data_type)
+
+        scalar = Scalar.from_series_file(
+            scalar_filename, scalar_header,
+            max_resident=self.max_resident_points, lazy=True)
+        if not scalar:
+            scalar = Scalar(values=[], data_type=data_type,
+                            max_resident=self.max_resident_points)
+            scalar.filename = scalar_filename
+        # Series in other layouts are converted on their first write
+        if scalar_header.series_format != scalar.series_format:
+            scalar_header.series_format = scalar.series_format
+            scalar.written = 0
+        scalar.header = scalar_header
+
+        self.scalar_headers[scalar_header_filename] = scalar_header
+        self.scalars[scalar_filename] = scalar
+        series = TagSeries(scalar_filename, scalar_header_filename, scalar,
+                           scalar_header)
+        self.tag_series[tag] = series
+        return series
 
     def add_scalar(self, tag, scalar_value, unit=None,
                    data_type_=None, x_title=None,
                    global_step=None, walltime=None,
                    new_style=False, double_precision=False):
-        super().add_scalar(tag, scalar_value, global_step, walltime, new_style,
-                           double_precision)
-
-        data_type = (data_type_ if data_type_
-                     else JsonObj.get_data_type(scalar_value))
-
-        scalar_filename = self.metric_filename(self.workdir, tag)
-        scalar_header_filename = self.metric_filename(
-            self.workdir, tag) + '_header'
-        if scalar_header_filename not in self.scalar_headers:
-            scalar_header = ScalarHeader.from_file(scalar_header_filename)
-            if not scalar_header:
-                scalar_header = ScalarHeader(
-                    title=tag, x_title=x_title, unit=unit, data_type=data_type)
-            self.scalar_headers[scalar_header_filename] = scalar_header
-        else:
-            scalar_header = self.scalar_headers[scalar_header_filename]
-
-        self.async_writer.enqueue_write(scalar_header_filename, scalar_header)
-
-        if scalar_filename not in self.scalars:
-            scalar = Scalar.from_file(scalar_filename)
-            if not scalar:
-                scalar = Scalar(values=[], data_type=data_type)
-            self.scalars[scalar_filename] = scalar
-        else:
-            scalar = self.scalars[scalar_filename]
-
-        scalar.add_value(scalar_value)
-        self.async_writer.enqueue_write(scalar_filename, scalar)
+        if self.closed:
+            return
+        for sink in self.sinks:
+            sink.add_scalar(tag, to_python_value(scalar_value), global_step,
+                            walltime, new_style=new_style,
+                            double_precision=double_precision)
+
+        series = self.tag_series.get(tag)
+        if not series:
+            data_type = (data_type_ if data_type_
+                         else JsonObj.get_data_type(scalar_value))
+            series = self.get_tag_series(tag, data_type, unit, x_title)
+
+        series.scalar.add_value(scalar_value, global_step, walltime)
+        self.series_batch.mark(series)
+        self.stats.increment('scalars_logged')
+        self.async_writer.enqueue_batch(self.SERIES_BATCH_KEY,
+                                        self.series_batch)
+
+    def add_scalars_batch(self, global_step, tag_scalar_dict: dict,
+                          walltime=None):
+        """Logs the values of several tags for the same step.
+
+        The values are sent to the sinks at once, tensorboard writes them as
+        a single event, and a single write is enqueued for all of them.
+
+        Args:
+            global_step (int): step of the values
+            tag_scalar_dict (dict): values to be logged, keyed by tag
+            walltime (float, optional): walltime of the values. Defaults to
+                the current time.
+        """
+        if walltime is None:
+            walltime = time.time()
+        tags = list(tag_scalar_dict.keys())
+        values = [to_python_value(v) for v in tag_scalar_dict.values()]
+        self.__add_values(global_step, tags, values, walltime)
+
+    def add_scalars_array(self, global_step, tags, values, walltime=None):
+        """Logs a vector of values, one for each tag, for the same step.
+
+        Works like `add_scalars_batch`, but takes the values as a NumPy array
+        or a tensor, which is converted with a single call instead of one per
+        value.
+
+        Args:
+            global_step (int): step of the values
+            tags (list[str]): tag of each value
+            values: NumPy array, tensor or list with one value for each tag
+            walltime (float, optional): walltime of the values. Defaults to
+                the current time.
+        """
+        if walltime is None:
+            walltime = time.time()
+        if hasattr(values, 'detach'):
+            values = values.detach().cpu()
+        values = values.tolist() if hasattr(values, 'tolist') else list(values)
+        if len(values) != len(tags):
+            raise MetricError.mismatched_tags_and_values(len(tags), len(values))
+        self.__add_values(global_step, tags, values, walltime)
+
+    def __add_values(self, global_step, tags, values, walltime):
+        if self.closed:
+            return
+        for sink in self.sinks:
+            sink.add_scalars(global_step, tags, values, walltime)
+
+        tag_series = self.tag_series
+        batch = []
+        for tag, value in zip(tags, values):
+            series = tag_series.get(tag)
+            if not series:
+                series = self.get_tag_series(tag,
+                                             JsonObj.get_data_type(value))
+            series.scalar.add_value(value, global_step, walltime)
+            batch.append(series)
+        self.series_batch.mark_all(batch)
+        self.stats.increment('scalars_logged', len(batch))
+        self.async_writer.enqueue_batch(self.SERIES_BATCH_KEY,
+                                        self.series_batch)
 
     def add_hparams(self, hparam_dict, metric_dict,
                     hparam_unit_dict={}, metric_unit_dict={},
                     hparam_domain_discrete=None, run_name=None):
-
+        if self.closed:
+            return
         all_data = {**hparam_dict, **metric_dict}
-        super().add_hparams(all_data, {}, hparam_domain_discrete,
-                            run_name)
+        for sink in self.sinks:
+            sink.add_hparams(all_data, {}, hparam_domain_discrete, run_name)
 
+        hparams_filename = self.hparam_filename(self.workdir)
         if not self.hparams:
-            hparams_filename = self.hparam_filename(self.workdir)
             hparams = Hparams.from_file(hparams_filename)
             if not hparams:
                 hparams = Hparams()
+            # Writes are serialized lazily, keep the same object so they
+            # always see every metric
+            self.hparams = hparams
         else:
             hparams = self.hparams
 
@@ -367,17 +1052,60 @@ class GitTensorboardSummaryWriter(SummaryWriter, AIRepoConstants):
 
     def save_artifact(self, obj,
                       f: Union[str, os.PathLike, BinaryIO, IO[bytes]]):
-        torch.save(obj, self.ARTIFACT_PATH / str(f))
+        import torch
+        torch.save(obj, os.path.join(self.workdir, self.ARTIFACT_PATH, str(f)))
 
     def add_topology(self, topology):
-        with open(self.TOPOLOGY_PATH, 'w') as f:
+        with open(os.path.join(self.workdir, self.TOPOLOGY_PATH), 'w') as f:
             f.write(topology)
 
+    def recover(self) -> list[str]:
+        """Discards metric files left partially written by a process that was
+        killed while writing them.
+
+        Returns:
+            list[str]: files that were removed or truncated
+        """
+        metrics_folder = os.path.join(self.workdir, self.METRICS_PATH)
+        recovered = recover_series_folder(metrics_folder)
+        for f in recovered:
+            print("Recovered partially written metric file %s" % f)
+        return recovered
+
     def flush(self):
         self.async_writer.flush()
-        super().flush()
-
-    def close(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def sync(self):
+        """Syncs the metric files to disk when the durability policy is
+        CHECKPOINT."""
+        if self.async_writer.durability == DurabilityPolicy.CHECKPOINT:
+            self.async_writer.sync()
+
+    def dump_stats(self):
+        """Appends the stats of the writer to `stats_file`, if any."""
+        if self.stats_file:
+            self.stats.dump(self.stats_file)
+
+    def close(self, dump_stats: bool = True):
+        """Writes the pending values and closes the writer.
+
+        Args:
+            dump_stats (bool, optional): the stats are dumped once the writer
+                is closed. Experiments dump them at their end instead, so
+                they include the last commit and push. Defaults to True.
+        """
+        if self.closed:
+            return
+        self.closed = True
         self.flush()
         self.async_writer.close()
-        super().close()
+        for sink in self.sinks:
+            sink.close()
+        if dump_stats:
+            self.dump_stats()
+
+
+# Name of the writer when it was a tensorboard SummaryWriter
+GitTensorboardSummaryWriter = GitMetricsWriter
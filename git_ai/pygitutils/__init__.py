@@ -1,2 +1,5 @@
 from .pygitutils import get_repo_log
+from .pygitutils import iter_repo_log
+from .pygitutils import parse_range
 from .pygitutils import read_config
+from .pygitutils import resolve_commit
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional, Union
+from typing import Iterator, Optional, Union
 import pygit2
 from pygit2 import Repository, Oid, Commit
 from git_ai.cmd.constants import AIRepoConstants
@@ -7,13 +7,59 @@ from git_ai.cmd.ai_repo.ai_repo_config import AIRepoConfig
 import os
 
 
-def get_repo_log(repo: Repository, start_commit: Union[str, Oid] = "", end_commit: Union[str, Oid] = "") -> list[Optional[Commit]]:
-    commits = []
-    for c in repo.walk(start_commit, pygit2.GIT_SORT_TOPOLOGICAL):
-        if end_commit and end_commit in c.oid.hex:
-            break
-        commits.append(c)
-    return commits
+def resolve_commit(repo: Repository, commit_spec: Union[str, Oid]) -> Optional[Oid]:
+    """Returns the full oid of a commit given by an oid, a prefix or a reference, None if it is
+    not in the repository."""
+    try:
+        return repo.revparse_single(str(commit_spec)).peel(Commit).id
+    except (KeyError, ValueError, pygit2.GitError):
+        return None
+
+
+def parse_range(range_spec: str) -> tuple[str, str]:
+    """Splits a `A..B` range into (B, A), the commit the walk starts from and the one it hides.
+    Either side can be empty, a spec without `..` is a start commit."""
+    if '..' not in range_spec:
+        return range_spec, ""
+    end_commit, start_commit = range_spec.split('..', 1)
+    return start_commit, end_commit
+
+
+def iter_repo_log(repo: Repository, start_commit: Union[str, Oid] = "", end_commit: Union[str, Oid] = "",
+                  time_order: bool = False, first_parent: bool = False) -> Iterator[Commit]:
+    """Yields the commits reachable from start_commit but not from end_commit, the `end..start`
+    range, as they are walked. Commits behind end_commit are never walked.
+
+    Args:
+        repo (Repository): the repository
+        start_commit (Union[str, Oid], optional): commit, prefix or reference the walk starts
+            from. Defaults to HEAD.
+        end_commit (Union[str, Oid], optional): commit, prefix or reference hidden with its
+            ancestors. It is ignored if it is not in the repository. Defaults to "".
+        time_order (bool, optional): newer commits first, instead of only topological order.
+            Defaults to False.
+        first_parent (bool, optional): only follows the first parent of merges. Defaults to
+            False.
+    """
+    start = resolve_commit(repo, start_commit) if start_commit else repo.head.target
+    if start is None:
+        raise KeyError(str(start_commit))
+    sort = pygit2.GIT_SORT_TOPOLOGICAL
+    if time_order:
+        sort |= pygit2.GIT_SORT_TIME
+    walker = repo.walk(start, sort)
+    if end_commit:
+        end = resolve_commit(repo, end_commit)
+        if end is not None:
+            walker.hide(end)
+    if first_parent:
+        walker.simplify_first_parent()
+    yield from walker
+
+
+def get_repo_log(repo: Repository, start_commit: Union[str, Oid] = "", end_commit: Union[str, Oid] = "",
+                 time_order: bool = False, first_parent: bool = False) -> list[Optional[Commit]]:
+    return list(iter_repo_log(repo, start_commit, end_commit, time_order, first_parent))
 
 
 def read_config(repo: Repository, oid: Union[str, Oid] = "") -> Optional[AIRepoConfig]:
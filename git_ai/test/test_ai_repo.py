@@ -7,6 +7,7 @@ import subprocess
 import signal
 import time
 from git_ai.metrics.experiment import Experiment
+from git_ai.metrics.sinks import SinkType
 from git_ai.test.utils.ai_repo_read import AIRepoRead
 from git_ai.test.utils.data_gen import ExperimentDataGen, RepositoryDataGen
 from git_ai.test.utils.setup_repo import SetupRepo
@@ -78,6 +79,9 @@ def test_creation(tmp_path):
         with open(Path(copy.workdir) / ai_repo.CONFIG_PATH) as f:
             config = json.load(f)
             assert config['ai_repo']
+        # The journal of experiments is ignored
+        (Path(copy.workdir) / ai_repo.JOURNAL_PATH).touch()
+        assert not copy.status()
 
 
 def test_experiment_new_repository(tmp_path):
@@ -200,6 +204,404 @@ def test_merge_experiment(tmp_path):
                         repo_read.get_plots(data_commit=oid))
 
 
+def test_merge_experiments(tmp_path):
+    data = RepositoryDataGen.default(experiment_count=2)
+    with SetupRepo(Path(tmp_path), "test") as handles:
+        copy, _, _ = handles
+        repo_read = AIRepoRead(copy)
+        ai_repo = AIRepo(copy.workdir)
+        ai_repo.init_ai_repo()
+        head = copy.head.target
+        for exp_data in data:
+            run_experiment(exp_data, last_commit=True)
+        names = [exp_name(str(head), i) for i, _ in enumerate(data)]
+
+        last = ai_repo.merge_experiments(names)
+        assert copy.head.target == last
+        assert [c.message for c in copy.walk(last)][0:2] == [
+            "Merging experiment %s" % names[1],
+            "Merging experiment %s" % names[0]]
+        assert copy[last].parents[0].parents[0].id == head
+        assert ((copy[last].tree / ai_repo.GIT_AI_ROOT).id ==
+                (copy.branches['exp/%s' % names[1]].peel(pygit2.Commit).tree /
+                 ai_repo.GIT_AI_ROOT).id)
+        data.match_data(names[1], repo_read.get_metrics(data_commit=last),
+                        repo_read.get_plots(data_commit=last))
+        assert not copy.status()
+        assert ai_repo.merge_experiments(names[1:]) is None
+
+
+def test_merge_experiment_adding_input_repo(tmp_path):
+    with SetupRepo(Path(tmp_path), "child") as (child, _, _):
+        child_url = 'file://%s' % Path(child.workdir).resolve()
+        with SetupRepo(Path(tmp_path), "parent") as (copy, _, _):
+            ai_repo = AIRepo(copy.workdir)
+            ai_repo.init_ai_repo()
+            os.chdir(copy.workdir)
+            with Experiment() as exp:
+                name = exp.exp_name
+                exp.writer.add_scalar('loss', 1.0, global_step=0)
+                AIRepo(copy.workdir).add_input_repo(
+                    Path('input_repo_test'), child_url, str(child.head.target))
+
+            last = ai_repo.merge_experiments([name])
+            # The input repo is merged with its .gitmodules
+            assert '.gitmodules' in copy[last].tree
+            assert 'input_repo_test' in copy[last].tree
+            assert not copy.status()
+
+
+def run_distributed_rank(rank: int, tmp_path: Path, world_size: int):
+    import torch.distributed as dist
+    from git_ai.metrics.distributed import Reduction
+    dist.init_process_group('gloo', init_method='file://%s' % (
+        tmp_path / 'dist_store'), rank=rank, world_size=world_size)
+    try:
+        if rank == 0:
+            with SetupRepo(tmp_path, "distributed") as (copy, _, _):
+                AIRepo(copy.workdir).init_ai_repo()
+                run_distributed_experiment(rank)
+        else:
+            run_distributed_experiment(rank)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_distributed_experiment(rank: int):
+    with Experiment(distributed=True) as exp:
+        for step in range(3):
+            exp.writer.add_scalar('loss', float(rank + step), 'nats',
+                                  global_step=step)
+            exp.writer.add_scalars_batch(step, {'rank': rank})
+        exp.checkpoint("first")
+        exp.writer.add_scalar('loss', 10.0 * (rank + 1), global_step=3)
+
+
+def test_distributed_experiment(tmp_path):
+    import torch.multiprocessing as mp
+    world_size = 2
+    mp.spawn(run_distributed_rank, args=(tmp_path, world_size),
+             nprocs=world_size)
+
+    copy = pygit2.Repository(tmp_path / "distributed" / "copy")
+    repo_read = AIRepoRead(copy)
+    experiments = set(repo_read.get_experiments())
+    assert len(experiments) == 1
+    plots = repo_read.get_plots(experiments.pop())
+    assert plots['loss'].values == [0.5, 1.5, 2.5, 15.0]
+    assert plots['rank'].values == [0.5, 0.5, 0.5]
+    # Arguments of add_scalar reach the writer of rank 0
+    header = (copy.branches['exp/%s' % list(repo_read.get_experiments())[0]]
+              .peel(pygit2.Commit).tree /
+              AIRepo.METRICS_PATH / 'loss_header')
+    assert json.loads(header.data)['unit'] == 'nats'
+    assert 'dist_store' not in os.listdir(copy.workdir)
+
+
+def test_async_checkpoints(tmp_path):
+    with SetupRepo(Path(tmp_path), "async") as (copy, bare, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        with Experiment(async_checkpoints=True) as exp:
+            for step in range(5):
+                exp.writer.add_scalar('loss', float(step), global_step=step)
+                exp.checkpoint("step %d" % step)
+            assert exp.wait(timeout=60)
+            branch = "refs/heads/%s" % exp.get_exp_branch()
+            assert (bare.references[branch].target ==
+                    copy.references[branch].target)
+            stats = exp.stats.snapshot()
+            assert stats['histograms']['checkpoint_commit_seconds'][
+                'count'] == 5
+            assert (stats['histograms']['push_seconds']['count'] +
+                    stats['counters'].get('coalesced_pushes', 0)) == 5
+
+        messages = [c.message for c in copy.walk(
+            bare.references[branch].target)]
+        for step in range(5):
+            assert "Checkpoint of %s: step %d" % (
+                branch[len('refs/heads/'):], step) in messages
+        repo_read = AIRepoRead(copy)
+        plots = repo_read.get_plots(exp.exp_name)
+        assert plots['loss'].values == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_stats_include_last_push(tmp_path):
+    stats_file = Path(tmp_path) / 'stats.jsonl'
+    with SetupRepo(Path(tmp_path), "stats") as (copy, _, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        with Experiment(sinks=SinkType.NONE,
+                        stats_file=str(stats_file)) as exp:
+            exp.writer.add_scalar('loss', 1.0, global_step=0)
+    lines = stats_file.read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['histograms']['push_seconds']['count'] == 1
+
+
+def test_commit_files(tmp_path):
+    with SetupRepo(Path(tmp_path), "commit_files") as (copy, _, _):
+        ai_repo = AIRepo(copy.workdir)
+        ai_repo.init_ai_repo()
+        first = ai_repo.commit_files({'.git_ai/metrics/loss': b'1',
+                                      '.git_ai/artifacts/model': b'm'},
+                                     "First checkpoint")
+        assert ai_repo.head.target == first
+        assert ai_repo.commit_files({'.git_ai/metrics/loss': b'1'},
+                                    "Nothing changed") is None
+
+        second = ai_repo.commit_files({'.git_ai/metrics/loss': b'12'},
+                                      "Second checkpoint")
+        first_tree = ai_repo[first].tree / '.git_ai'
+        second_tree = ai_repo[second].tree / '.git_ai'
+        assert ai_repo[second].parents[0].id == first
+        assert (second_tree / 'artifacts').id == (first_tree / 'artifacts').id
+        assert (second_tree / 'metrics' / 'loss').data == b'12'
+        assert (ai_repo[second].tree / 'README.md').id == \
+            (ai_repo[first].tree / 'README.md').id
+
+
+def test_ai_modified_files(tmp_path):
+    with SetupRepo(Path(tmp_path), "status") as (copy, _, _):
+        ai_repo = AIRepo(copy.workdir)
+        ai_repo.init_ai_repo()
+        workdir = Path(copy.workdir)
+        (workdir / "outside.txt").write_text("untracked")
+        (workdir / "README.md").write_text("modified")
+        (workdir / ai_repo.HPARAMS_JSON_PATH).write_text("[]")
+        ai_repo.commit([ai_repo.HPARAMS_JSON_PATH], [], "Hparams")
+        (workdir / ai_repo.METRICS_PATH / "loss").write_text("1")
+        (workdir / ai_repo.CONFIG_PATH).write_text("{}")
+        os.remove(workdir / ai_repo.HPARAMS_JSON_PATH)
+
+        assert sorted(ai_repo.get_ai_status()) == [
+            '.git_ai/config.json', '.git_ai/hparams.json',
+            '.git_ai/metrics/loss']
+        assert ai_repo.get_ai_modified_files() == (
+            ['.git_ai/metrics/loss', '.git_ai/config.json'],
+            ['.git_ai/hparams.json'])
+        new, modified, removed, _ = ai_repo.get_wt_modified_files()
+        assert sorted(new) == ['.git_ai/metrics/loss', 'outside.txt']
+        assert sorted(modified) == ['.git_ai/config.json', 'README.md']
+        assert removed == ['.git_ai/hparams.json']
+
+
+def test_checkpoint_policy_and_squash(tmp_path):
+    from git_ai.metrics.checkpoint import CheckpointPolicy
+    with SetupRepo(Path(tmp_path), "squash") as (copy, bare, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        with Experiment(checkpoint_policy=CheckpointPolicy(min_steps=3),
+                        squash_checkpoints=True) as exp:
+            for step in range(10):
+                exp.writer.add_scalar('loss', float(step), global_step=step)
+                exp.checkpoint("step %d" % step, milestone=(step == 5))
+            branch = "refs/heads/%s" % exp.get_exp_branch()
+            before_end = [c.message for c in copy.walk(
+                copy.references[branch].target)]
+            assert exp.stats.snapshot()['counters']['skipped_checkpoints'] == 6
+            # The branch is only pushed once it is squashed
+            assert branch not in bare.references
+        committed = [m.split(': ')[1].split(' ')[1] for m in before_end
+                     if m.startswith("Checkpoint of")]
+        assert sorted(committed, key=int) == ['0', '3', '5', '8']
+
+        messages = [c.message for c in copy.walk(
+            bare.references[branch].target)]
+        assert bare.references[branch].target == copy.references[branch].target
+        assert not [m for m in messages if m.startswith("Checkpoint of") and
+                    Experiment.MILESTONE_TAG not in m]
+        assert [m for m in messages if Experiment.MILESTONE_TAG in m]
+        repo_read = AIRepoRead(copy)
+        plots = repo_read.get_plots(exp.exp_name)
+        assert plots['loss'].values == [float(s) for s in range(10)]
+
+
+KILLED_EXPERIMENT = """
+import os, signal
+from git_ai.metrics.experiment import Experiment
+from git_ai.metrics.sinks import SinkType
+exp = Experiment(sinks=SinkType.NONE)
+print(exp.exp_name, flush=True)
+for step in range(3):
+    exp.writer.add_scalar('loss', float(step), global_step=step)
+exp.checkpoint("step 2")
+for step in range(3, 6):
+    exp.writer.add_scalar('loss', float(step), global_step=step)
+exp.writer.flush()
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def test_recover_killed_experiment(tmp_path):
+    import sys
+    with SetupRepo(Path(tmp_path), "recover") as (copy, bare, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        # The child runs in the test repo, git_ai is imported from here
+        root = str(Path(__file__).resolve().parents[2])
+        pythonpath = os.pathsep.join(
+            path for path in [root, os.environ.get('PYTHONPATH')] if path)
+        p = subprocess.run([sys.executable, "-c", KILLED_EXPERIMENT],
+                           cwd=copy.workdir, capture_output=True, text=True,
+                           env={**os.environ, 'PYTHONPATH': pythonpath})
+        assert p.returncode == -signal.SIGKILL
+        killed_name = p.stdout.strip()
+        assert os.path.isfile(Path(copy.workdir) / AIRepo.JOURNAL_PATH)
+
+        with Experiment(sinks=SinkType.NONE) as exp:
+            assert exp.exp_name != killed_name
+            assert os.path.isfile(Path(copy.workdir) / AIRepo.JOURNAL_PATH)
+        assert not os.path.exists(Path(copy.workdir) / AIRepo.JOURNAL_PATH)
+
+        branch = "refs/heads/exp/%s" % killed_name
+        last = copy.references[branch].peel(pygit2.Commit)
+        assert last.message.startswith(
+            "Recovered checkpoint of exp/%s: interrupted after" % killed_name)
+        assert bare.references[branch].target == last.id
+        assert AIRepo.JOURNAL_PATH.as_posix() not in last.tree
+        plots = AIRepoRead(copy).get_plots(killed_name)
+        assert plots['loss'].values == [float(s) for s in range(6)]
+        assert copy.head.name == "refs/heads/main"
+        assert not copy.status()
+
+
+def test_signal_close_defers_push(tmp_path):
+    from git_ai.metrics.outbox import PushOutbox
+    with SetupRepo(Path(tmp_path), "outbox") as (copy, bare, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        exp = Experiment(sinks=SinkType.NONE)
+        exp.writer.add_scalar('loss', 1.0, global_step=0)
+        exp.close(signal.SIGTERM)
+        branch = "refs/heads/%s" % exp.get_exp_branch()
+        assert branch in copy.references
+        assert branch not in bare.references
+        assert copy.head.name == "refs/heads/main"
+        outbox = PushOutbox(AIRepo(copy.workdir))
+        assert [e['branch'] for e in outbox.entries()] == [branch]
+
+        # The next experiment pushes it
+        with Experiment(sinks=SinkType.NONE):
+            assert (bare.references[branch].target ==
+                    copy.references[branch].target)
+            assert not outbox.entries()
+
+
+def test_signal_close_is_bounded(tmp_path):
+    with SetupRepo(Path(tmp_path), "bounded") as (copy, _, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        exp = Experiment(sinks=SinkType.NONE, shutdown_timeout=0.5)
+        exp.writer.add_scalar('loss', 1.0, global_step=0)
+        # The signal interrupts the thread while it holds a lock the end of
+        # the experiment needs
+        with exp.journal.lock:
+            start = time.monotonic()
+            exp.close(signal.SIGTERM)
+            assert time.monotonic() - start < 5
+        # The experiment is closed once the lock is released
+        exp.close()
+        assert copy.head.name == "refs/heads/main"
+        assert "refs/heads/%s" % exp.get_exp_branch() in copy.references
+
+
+def test_experiment_names(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from git_ai.metrics.exp_names import ExperimentNames
+    with SetupRepo(Path(tmp_path), "names") as (copy, bare, _):
+        ai_repo = AIRepo(copy.workdir)
+        commit = str(ai_repo.head.target)
+        # A branch that only exists in the remote
+        bare.references.create('refs/heads/exp/%s-004' % commit[0:8],
+                               bare.references['refs/heads/main'].target)
+        names = ExperimentNames(ai_repo, ttl=3600)
+        assert names.allocate() == exp_name(commit, 5)
+
+        bare.references.create('refs/heads/exp/%s-009' % commit[0:8],
+                               bare.references['refs/heads/main'].target)
+        # The listing is cached, and reserved names are never reused
+        with ThreadPoolExecutor(4) as pool:
+            allocated = list(pool.map(lambda _: names.allocate(), range(8)))
+        assert sorted(allocated) == [exp_name(commit, i)
+                                     for i in range(6, 14)]
+        assert ExperimentNames(ai_repo, ttl=0).allocate() == \
+            exp_name(commit, 14)
+
+
+def run_worktree_experiment(repo_root: str, loss: float) -> str:
+    with Experiment(repo_root=repo_root, worktree=True,
+                    sinks=SinkType.NONE) as exp:
+        assert exp.repo.workdir != exp.main_repo.workdir
+        for step in range(3):
+            exp.writer.add_scalar('loss', loss + step, global_step=step)
+            exp.checkpoint("step %d" % step)
+        return exp.exp_name
+
+
+def test_worktree_experiments(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    with SetupRepo(Path(tmp_path), "worktrees") as (copy, _, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        with ThreadPoolExecutor(3) as pool:
+            names = list(pool.map(
+                lambda loss: run_worktree_experiment(copy.workdir, loss),
+                [0.0, 10.0, 20.0]))
+
+        assert len(set(names)) == 3
+        assert copy.head.name == 'refs/heads/main'
+        assert not copy.status()
+        assert not copy.list_worktrees()
+        repo_read = AIRepoRead(copy)
+        for name, loss in zip(names, [0.0, 10.0, 20.0]):
+            plots = repo_read.get_plots(name)
+            assert plots['loss'].values == [loss, loss + 1, loss + 2]
+
+
+def train_sweep_trial(exp: Experiment, params: dict) -> dict:
+    for step in range(2):
+        exp.writer.add_scalar('loss', params['lr'] * step, global_step=step)
+    return {'final_loss': params['lr'] * params['layers']}
+
+
+def test_sweep(tmp_path):
+    from git_ai.metrics.sweep import Sweep, command_args, grid
+    assert command_args(['train.py', '--lr={lr}'], {'lr': 0.1, 'layers': 2}) \
+        == ['train.py', '--lr=0.1', '--layers=2']
+    with SetupRepo(Path(tmp_path), "sweep") as (copy, _, _):
+        AIRepo(copy.workdir).init_ai_repo()
+        params = grid({'lr': [0.1, 0.2], 'layers': [1, 2]})
+        sweep = Sweep(params, train_sweep_trial, max_concurrency=2,
+                      repo_root=copy.workdir,
+                      experiment_kwargs={'sinks': SinkType.NONE})
+        trials = sweep.run(verbose=False)
+
+        assert [t.status for t in trials] == ['done'] * 4, [t.error for t in trials]
+        assert len(set(t.exp_name for t in trials)) == 4
+        assert copy.head.name == 'refs/heads/main' and not copy.status()
+        repo_read = AIRepoRead(copy)
+        for trial in trials:
+            metrics = repo_read.get_metrics(trial.exp_name)
+            assert metrics['lr'].value == trial.params['lr']
+            assert metrics['final_loss'].value == trial.metrics['final_loss']
+        assert 'final_loss' in sweep.summary().splitlines()[0]
+
+
+def test_repository_pool(tmp_path):
+    from git_ai.cmd.ai_repo import RepositoryPool
+    paths = [tmp_path / ('repo_%d' % i) for i in range(3)]
+    for path in paths:
+        pygit2.init_repository(path)
+    pool = RepositoryPool(max_size=2)
+    repo = pool.get(paths[0])
+    # Handles are keyed by the resolved path and their class
+    assert pool.get(paths[0] / '..' / 'repo_0') is repo
+    ai_repo = pool.get(paths[0], AIRepo)
+    assert isinstance(ai_repo, AIRepo) and ai_repo is not repo
+    assert len(pool) == 2
+    pool.get(paths[1])
+    assert len(pool) == 2
+    assert pool.get(paths[0]) is not repo
+    pool.release(paths[0])
+    assert len(pool) == 1
+    pool.release()
+    assert len(pool) == 0
+
+
 def test_commands_away_from_root():
     assert True == True
 
@@ -279,6 +681,38 @@ def test_recursive_log(tmp_path):
             assert 'input_repo_test' == log[7]
             assert experiment_names[0] in log[8]
 
+            # Configs are parsed once, later logs read them from the cache
+            from git_ai.cmd.ai_repo.config_cache import ConfigCache
+            cache = ConfigCache(parent_ai_repo)
+            assert cache.commits
+            assert [p['path'] for pins in cache.blobs.values()
+                    for p in pins] == [['input_repo_test']] * 2
+            cache_size = os.path.getsize(cache.filename)
+            assert parent_ai_repo.get_log().serialize_log() == log
+            assert os.path.getsize(cache.filename) == cache_size
+
+            # The streaming log has the same lines
+            assert list(parent_ai_repo.iter_log()) == log
+            assert list(parent_ai_repo.iter_log(max_count=2)) == log[:5]
+            head_time = parent_copy[parent_copy.head.target].commit_time
+            assert list(parent_ai_repo.iter_log(since=head_time + 1)) == []
+
+            # Input repos walked by threads give the same log
+            assert parent_ai_repo.get_log(jobs=4).serialize_log() == log
+            assert list(parent_ai_repo.iter_log(jobs=4)) == log
+
+            # Ranges hide the commits reachable from their end
+            from git_ai.pygitutils import get_repo_log, parse_range
+            head = parent_copy.head.target
+            parent = parent_copy[head].parents[0].id
+            assert parse_range('%s..%s' % (parent, head)) == (str(head),
+                                                              str(parent))
+            assert [c.id for c in get_repo_log(
+                parent_copy, str(head), str(parent)[:8])] == [head]
+            child_head = str(child_copy.head.target)
+            assert len(get_repo_log(parent_copy, str(head), child_head)) == \
+                len(get_repo_log(parent_copy, str(head)))
+
 
 def test_interrupted_experiment(tmp_path):
     """Starts an experiment on a different thread and interrupts it. 
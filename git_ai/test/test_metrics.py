@@ -0,0 +1,490 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pygit2
+import pytest
+
+from git_ai.cmd.ai_repo import AIRepo
+from git_ai.errors.errors import MetricError
+
+from git_ai.metrics.series import (COLUMNAR_MAGIC, SERIES_FORMAT_COLUMNAR,
+                                   SERIES_FORMAT_JSONL, ChunkedColumn,
+                                   ColumnarSeries, read_series_values,
+                                   recover_series_folder, temp_filename)
+from git_ai.metrics.sinks import MetricSink, SinkType
+from git_ai.metrics.writer import (AsynchFileWriter, DataTypeEnum,
+                                   DurabilityPolicy,
+                                   GitMetricsWriter, Hparams,
+                                   Metric, QueueFullPolicy, Scalar,
+                                   ScalarHeader)
+
+
+def write_series(writer: AsynchFileWriter, filename: str, scalar: Scalar,
+                 header: ScalarHeader):
+    scalar.header = header
+    writer.enqueue_append(filename, scalar)
+    writer.enqueue_write(filename + '_header', header)
+    writer.flush()
+
+
+def read_series(filename: str) -> list[str]:
+    with open(filename + '_header') as f:
+        header = json.load(f)
+    with open(filename, 'rb') as f:
+        return read_series_values(header, f.read())
+
+
+def test_append_only_series(tmp_path):
+    filename = str(tmp_path / 'loss')
+    header = ScalarHeader('loss', DataTypeEnum.FLOAT)
+    scalar = Scalar([], DataTypeEnum.FLOAT)
+    writer = AsynchFileWriter()
+    for v in [1.0, 2.0, 3.0]:
+        scalar.add_value(v)
+    write_series(writer, filename, scalar, header)
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        prefix = f.read()
+
+    for v in [4.0, 5.0]:
+        scalar.add_value(v)
+    write_series(writer, filename, scalar, header)
+    writer.close()
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    assert data.startswith(prefix) and len(data) > size
+    assert read_series(filename) == ['1.0', '2.0', '3.0', '4.0', '5.0']
+
+    # Data past the count in the header is ignored
+    with open(filename, 'ab') as f:
+        f.write(b'\x01\x00')
+    loaded = Scalar.from_series_file(filename, ScalarHeader.from_file(
+        filename + '_header'))
+    assert loaded.values == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert loaded.written == 0
+
+
+def test_legacy_series_is_converted(tmp_path):
+    filename = str(tmp_path / 'acc')
+    legacy = Scalar([0.5, 0.25], DataTypeEnum.FLOAT)
+    with open(filename, 'w') as f:
+        json.dump(legacy.to_dict(), f)
+    with open(filename + '_header', 'w') as f:
+        json.dump({'title': 'acc', 'x_title': None, 'dataType': 'FLOAT'}, f)
+
+    header = ScalarHeader.from_file(filename + '_header')
+    assert read_series(filename) == ['0.500', '0.250']
+    scalar = Scalar.from_series_file(filename, header)
+    assert scalar.values == [0.5, 0.25] and scalar.written == 0
+
+    header.series_format = SERIES_FORMAT_COLUMNAR
+    scalar.add_value(1.0)
+    writer = AsynchFileWriter()
+    write_series(writer, filename, scalar, header)
+    writer.close()
+    assert read_series(filename) == ['0.5', '0.25', '1.0']
+
+
+def test_string_series_use_jsonl(tmp_path):
+    filename = str(tmp_path / 'optimizer')
+    header = ScalarHeader('optimizer', DataTypeEnum.STRING)
+    assert header.series_format == SERIES_FORMAT_JSONL
+    scalar = Scalar([], DataTypeEnum.STRING)
+    assert scalar.series_format == SERIES_FORMAT_JSONL
+    writer = AsynchFileWriter()
+    scalar.add_value('ADAM')
+    write_series(writer, filename, scalar, header)
+    scalar.add_value('SGD\nmomentum')
+    write_series(writer, filename, scalar, header)
+    writer.close()
+    assert read_series(filename) == ['ADAM', 'SGD\nmomentum']
+
+
+def test_columnar_series_round_trip(tmp_path):
+    values = [1e-7, 0.123456789, 3.5]
+    scalar = Scalar([], DataTypeEnum.FLOAT)
+    for step, v in enumerate(values):
+        scalar.add_value(v, global_step=step * 10, walltime=100.0 + step)
+    data = scalar.to_columnar()
+    json_layout = scalar.to_dict()
+    truncate, first_chunk = scalar.take_unwritten()
+    assert truncate and first_chunk == data
+    # Two chunks, the second one appended to the first
+    scalar.add_value(7.0, global_step=30, walltime=103.0)
+    truncate, second_chunk = scalar.take_unwritten()
+    assert not truncate
+    series = ColumnarSeries('float64', first_chunk + second_chunk)
+    assert series.values.tolist() == values + [7.0]
+    assert series.steps.tolist() == [0, 10, 20, 30]
+    assert series.walltimes.tolist() == [100.0, 101.0, 102.0, 103.0]
+
+    single = ColumnarSeries('float64', data)
+    assert isinstance(single.values, memoryview)
+    assert Scalar.from_columnar(single, DataTypeEnum.FLOAT).to_dict() == \
+        Scalar.from_json(json_layout).to_dict()
+
+    np = pytest.importorskip('numpy')
+    values_column, steps_column, _ = single.to_numpy()
+    assert np.shares_memory(values_column, np.frombuffer(data, dtype='u1'))
+    assert values_column.tolist() == values
+    assert steps_column.dtype == np.int64
+
+
+class CountingHparams(Hparams):
+    def __init__(self):
+        super().__init__()
+        self.serialized = 0
+
+    def to_dict(self):
+        self.serialized += 1
+        return super().to_dict()
+
+
+def test_writer_coalesces_lazy_writes(tmp_path):
+    filename = str(tmp_path / 'hparams.json')
+    hparams = CountingHparams()
+    writer = AsynchFileWriter(linger=10)
+    for i in range(100):
+        hparams.add_metric(Metric('m%d' % i, i))
+        writer.enqueue_write(filename, hparams)
+    assert hparams.serialized == 0
+
+    start = time.monotonic()
+    writer.flush()
+    # The flush doesn't wait for the writer to linger
+    assert time.monotonic() - start < 5
+    assert hparams.serialized == 1
+    writer.close()
+    with open(filename) as f:
+        assert len(json.load(f)) == 100
+
+
+def test_writer_full_policies(tmp_path):
+    writer = AsynchFileWriter(max_pending=2,
+                              full_policy=QueueFullPolicy.DROP_OLDEST,
+                              linger=10)
+    files = [str(tmp_path / ('drop_%d' % i)) for i in range(3)]
+    for f in files:
+        writer.enqueue_write(f, Hparams())
+    writer.flush()
+    assert [os.path.isfile(f) for f in files] == [False, True, True]
+    writer.close()
+
+    writer = AsynchFileWriter(max_pending=2,
+                              full_policy=QueueFullPolicy.BLOCK, linger=10)
+    files = [str(tmp_path / ('block_%d' % i)) for i in range(5)]
+    producer = threading.Thread(
+        target=lambda: [writer.enqueue_write(f, Hparams()) for f in files])
+    producer.start()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+    writer.close()
+    assert all([os.path.isfile(f) for f in files])
+
+    # Writes coalesced into a waiting file don't take room
+    writer = AsynchFileWriter(max_pending=1,
+                              full_policy=QueueFullPolicy.BLOCK, linger=10)
+    producer = threading.Thread(
+        target=lambda: [writer.enqueue_write(files[0], Hparams())
+                        for _ in range(5)])
+    producer.start()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+    assert writer.stats.snapshot()['counters']['coalesced'] == 4
+    writer.close()
+
+
+def test_batched_scalars(tmp_path):
+    torch = pytest.importorskip('torch')
+    np = pytest.importorskip('numpy')
+    from tensorboard.backend.event_processing.event_accumulator import \
+        EventAccumulator
+
+    pygit2.init_repository(tmp_path / 'repo')
+    repo = AIRepo(str(tmp_path / 'repo'))
+    os.makedirs(Path(repo.workdir) / repo.METRICS_PATH)
+    writer = GitMetricsWriter(repo=repo)
+    tags = ['loss', 'acc', 'lr']
+    writer.add_scalars_batch(0, {'loss': 1.5, 'acc': 0.25, 'lr': 1e-4})
+    writer.add_scalars_array(1, tags, np.array([1.25, 0.5, 1e-4]))
+    writer.add_scalars_array(2, tags, torch.tensor([1.0, 0.75, 1e-5],
+                                                   dtype=torch.float64))
+    writer.add_scalar('loss', 0.5, global_step=3)
+    with pytest.raises(MetricError):
+        writer.add_scalars_array(4, tags, [1.0])
+    writer.close()
+
+    metrics = Path(repo.workdir) / repo.METRICS_PATH
+    assert read_series(str(metrics / 'loss')) == ['1.5', '1.25', '1.0', '0.5']
+    assert read_series(str(metrics / 'lr')) == ['0.0001', '0.0001', '1e-05']
+    header = ScalarHeader.from_file(str(metrics / 'acc_header'))
+    series = ColumnarSeries.from_file(str(metrics / 'acc'), 'float64',
+                                      header.count)
+    assert series.steps.tolist() == [0, 1, 2]
+
+    events = EventAccumulator(str(Path(repo.workdir) / repo.TENSORBOARD_PATH))
+    events.Reload()
+    assert [e.step for e in events.Scalars('loss')] == [0, 1, 2, 3]
+    assert [e.value for e in events.Scalars('acc')] == [0.25, 0.5, 0.75]
+
+
+@pytest.mark.parametrize('max_resident', [0, 1])
+def test_float_widens_int_series(tmp_path, max_resident):
+    pygit2.init_repository(tmp_path / 'repo')
+    repo = AIRepo(str(tmp_path / 'repo'))
+    os.makedirs(Path(repo.workdir) / repo.METRICS_PATH)
+    writer = GitMetricsWriter(repo=repo, sinks=SinkType.NONE,
+                              max_resident_points=max_resident)
+    writer.add_scalar('count', 1, global_step=10)
+    writer.flush()
+    writer.add_scalar('count', 2, global_step=20)
+    writer.flush()
+    writer.add_scalar('count', 3.5, global_step=30)
+    with pytest.raises(MetricError):
+        writer.add_scalar('count', 'four', global_step=40)
+    scalar = writer.tag_series['count'].scalar
+    assert scalar.values == [1.0, 2.0, 3.5]
+    assert scalar.steps == [10, 20, 30]
+    writer.close()
+
+    metrics = Path(repo.workdir) / repo.METRICS_PATH
+    header = ScalarHeader.from_file(str(metrics / 'count_header'))
+    assert header.data_type == DataTypeEnum.FLOAT
+    series = ColumnarSeries.from_file(str(metrics / 'count'), 'float64',
+                                      header.count)
+    assert series.values.tolist() == [1.0, 2.0, 3.5]
+    assert series.steps.tolist() == [10, 20, 30]
+
+
+def test_failed_append_keeps_columns_aligned(monkeypatch):
+    scalar = Scalar([], DataTypeEnum.FLOAT)
+    scalar.add_value(1.0, global_step=1)
+
+    def fail(item):
+        raise MemoryError()
+    monkeypatch.setattr(scalar.value_column, 'append', fail)
+    with pytest.raises(MemoryError):
+        scalar.add_value(2.0, global_step=2)
+    monkeypatch.undo()
+    assert [len(c) for c in [scalar.value_column, scalar.step_column,
+                             scalar.walltime_column]] == [1, 1, 1]
+    scalar.add_value(3.0, global_step=3)
+    assert scalar.values == [1.0, 3.0]
+    assert scalar.steps == [1, 3]
+
+
+def test_recover_partial_files(tmp_path):
+    writer = AsynchFileWriter(durability=DurabilityPolicy.FLUSH)
+    loss = str(tmp_path / 'loss')
+    scalar = Scalar([], DataTypeEnum.FLOAT)
+    header = ScalarHeader('loss', DataTypeEnum.FLOAT)
+    scalar.add_value(1.0)
+    scalar.add_value(2.0)
+    write_series(writer, loss, scalar, header)
+    optimizer = str(tmp_path / 'optimizer')
+    text = Scalar([], DataTypeEnum.STRING)
+    text_header = ScalarHeader('optimizer', DataTypeEnum.STRING)
+    text.add_value('ADAM')
+    write_series(writer, optimizer, text, text_header)
+    writer.close()
+    assert not writer.unsynced
+    size = os.path.getsize(loss)
+
+    # A process killed in the middle of appends and rewrites
+    with open(loss, 'ab') as f:
+        f.write(b'\x03\x00\x00')
+    with open(optimizer, 'a') as f:
+        f.write('"SG')
+    with open(temp_filename(str(tmp_path / 'hparams.json')), 'w') as f:
+        f.write('[{"label"')
+    with open(str(tmp_path / 'broken_header'), 'w') as f:
+        f.write('{"title": "bro')
+    with open(str(tmp_path / 'broken'), 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+
+    recovered = recover_series_folder(tmp_path)
+    assert sorted(os.listdir(tmp_path)) == [
+        'loss', 'loss_header', 'optimizer', 'optimizer_header']
+    assert len(recovered) == 5
+    assert os.path.getsize(loss) == size
+    assert read_series(optimizer) == ['ADAM']
+    loaded = Scalar.from_series_file(loss, ScalarHeader.from_file(
+        loss + '_header'))
+    assert loaded.values == [1.0, 2.0] and loaded.written == 2
+
+
+def test_scalar_spills_written_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(ChunkedColumn, 'CHUNK_SIZE', 8)
+    filename = str(tmp_path / 'loss')
+    header = ScalarHeader('loss', DataTypeEnum.FLOAT)
+    scalar = Scalar([], DataTypeEnum.FLOAT, max_resident=10)
+    scalar.filename = filename
+    writer = AsynchFileWriter()
+    for step in range(100):
+        scalar.add_value(float(step), global_step=step)
+        if step % 7 == 0:
+            write_series(writer, filename, scalar, header)
+    write_series(writer, filename, scalar, header)
+    writer.close()
+
+    assert len(scalar) == 100 and scalar.resident < 20
+    assert scalar.values == [float(v) for v in range(100)]
+    assert scalar.steps == list(range(100))
+    assert read_series(filename) == [repr(float(v)) for v in range(100)]
+
+
+def test_lazy_resume_reads_only_header(tmp_path):
+    filename = str(tmp_path / 'loss')
+    header = ScalarHeader('loss', DataTypeEnum.FLOAT)
+    scalar = Scalar([], DataTypeEnum.FLOAT)
+    for step in range(5):
+        scalar.add_value(step / 2, global_step=step)
+    writer = AsynchFileWriter()
+    write_series(writer, filename, scalar, header)
+
+    header = ScalarHeader.from_file(filename + '_header')
+    resumed = Scalar.from_series_file(filename, header, lazy=True)
+    assert len(resumed) == 5 and resumed.resident == 0
+    assert resumed.written == 5
+    resumed.add_value(9.0)
+    write_series(writer, filename, resumed, header)
+    writer.close()
+    assert resumed.steps == [0, 1, 2, 3, 4, 5]
+    assert read_series(filename) == ['0.0', '0.5', '1.0', '1.5', '2.0', '9.0']
+
+    # Files that can't be appended to are loaded to be written again
+    with open(filename, 'ab') as f:
+        f.write(b'\x01')
+    resumed = Scalar.from_series_file(filename, header, lazy=True)
+    assert resumed.written == 0 and resumed.resident == 6
+
+
+class RecordingSink(MetricSink):
+    def __init__(self):
+        self.points = []
+
+    def add_scalars(self, global_step, tags, values, walltime):
+        self.points.extend(zip(tags, values, [global_step] * len(tags)))
+
+
+def test_writer_without_tensorboard(tmp_path):
+    # Importing experiments doesn't import torch nor tensorboard
+    imported = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, git_ai.metrics.experiment; '
+        'print("torch" in sys.modules or "tensorboard" in sys.modules)'])
+    assert imported.strip() == b'False'
+
+    pygit2.init_repository(tmp_path / 'repo')
+    repo = AIRepo(str(tmp_path / 'repo'))
+    os.makedirs(Path(repo.workdir) / repo.METRICS_PATH)
+    sink = RecordingSink()
+    writer = GitMetricsWriter(repo=repo, sinks=[SinkType.NONE, sink])
+    writer.add_scalar('loss', 1.5, global_step=0)
+    writer.add_scalars_batch(1, {'loss': 1.0, 'acc': 0.5})
+    writer.close()
+
+    assert sink.points == [('loss', 1.5, 0), ('loss', 1.0, 1),
+                           ('acc', 0.5, 1)]
+    metrics = Path(repo.workdir) / repo.METRICS_PATH
+    assert read_series(str(metrics / 'loss')) == ['1.5', '1.0']
+    assert not os.path.exists(Path(repo.workdir) / repo.TENSORBOARD_PATH)
+
+
+def test_default_sink_without_tensorboard(tmp_path, monkeypatch):
+    # torch.utils.tensorboard can't be imported
+    monkeypatch.setitem(sys.modules, 'torch.utils.tensorboard', None)
+    pygit2.init_repository(tmp_path / 'repo')
+    repo = AIRepo(str(tmp_path / 'repo'))
+    os.makedirs(Path(repo.workdir) / repo.METRICS_PATH)
+    writer = GitMetricsWriter(repo=repo)
+    assert writer.sinks == []
+    writer.add_scalar('loss', 1.5, global_step=0)
+    writer.close()
+    with pytest.raises(MetricError):
+        GitMetricsWriter(repo=repo, sinks=SinkType.TENSORBOARD)
+
+
+def test_checkpoint_policy_either_threshold():
+    from git_ai.metrics.checkpoint import CheckpointPolicy
+    policy = CheckpointPolicy(min_seconds=3600, min_steps=2)
+    assert [policy.should_checkpoint(s) for s in range(5)] == [
+        True, False, True, False, True]
+    assert policy.should_checkpoint(5, milestone=True)
+    # Enough time passed, whatever the steps
+    policy = CheckpointPolicy(min_seconds=0, min_steps=100)
+    assert all(policy.should_checkpoint(s) for s in range(3))
+
+
+def test_checkpoint_snapshot_compares_contents(tmp_path):
+    from git_ai.metrics.checkpoint import CheckpointSnapshot
+    loss = tmp_path / 'metrics' / 'loss'
+    os.makedirs(loss.parent)
+    loss.write_bytes(b'1.0')
+    file_hashes = {}
+    snapshot = CheckpointSnapshot.take(str(tmp_path), ['metrics'], 'first',
+                                       file_hashes)
+    assert snapshot.files == {'metrics/loss': b'1.0'}
+    # Not committed, the file is still taken
+    snapshot = CheckpointSnapshot.take(str(tmp_path), ['metrics'], 'first',
+                                       file_hashes)
+    snapshot.committed(file_hashes)
+    assert CheckpointSnapshot.take(str(tmp_path), ['metrics'], 'second',
+                                   file_hashes).files == {}
+
+    # Same size and modification time, other contents
+    st = os.stat(loss)
+    loss.write_bytes(b'2.0')
+    os.utime(loss, ns=(st.st_atime_ns, st.st_mtime_ns))
+    snapshot = CheckpointSnapshot.take(str(tmp_path), ['metrics'], 'third',
+                                       file_hashes)
+    assert snapshot.files == {'metrics/loss': b'2.0'}
+
+
+@pytest.mark.parametrize('reduction_name', ['MEAN', 'SUM'])
+def test_distributed_reduce_passes_strings(reduction_name):
+    pytest.importorskip('torch.distributed')
+    from git_ai.metrics.distributed import (DistributedSummaryWriter,
+                                            Reduction)
+    writer = DistributedSummaryWriter.__new__(DistributedSummaryWriter)
+    writer.reduction = Reduction[reduction_name]
+    buffers = [{'loss': [(0, 1.0, 5.0)], 'phase': [(0, 'train', 5.0)]},
+               {'loss': [(0, 3.0, 6.0)], 'phase': [(0, 'eval', 6.0)],
+                'done': [(0, True, 6.0)]}]
+    walltime, values = writer.reduce(buffers)[0]
+    assert walltime == 6.0
+    assert values == {'loss': 2.0 if reduction_name == 'MEAN' else 4.0,
+                      'phase': 'train', 'done': True}
+
+
+def test_writer_stats(tmp_path):
+    writer = AsynchFileWriter(linger=10)
+    filename = str(tmp_path / 'hparams.json')
+    hparams = Hparams()
+    for i in range(10):
+        hparams.add_metric(Metric('m%d' % i, i))
+        writer.enqueue_write(filename, hparams)
+    writer.close()
+
+    stats = writer.stats.snapshot()
+    assert stats['counters']['enqueued'] == 10
+    assert stats['counters']['coalesced'] == 9
+    assert stats['counters']['files_written'] == 1
+    assert stats['counters']['bytes_written'] == os.path.getsize(filename)
+    assert stats['gauges']['max_queue_depth'] == 1
+    assert stats['gauges']['queue_depth'] == 0
+    assert stats['histograms']['write_seconds']['count'] == 1
+    assert stats['histograms']['flush_blocked_seconds']['count'] >= 1
+
+    stats_file = tmp_path / 'stats.jsonl'
+    writer.stats.dump(stats_file)
+    writer.stats.dump(stats_file)
+    lines = stats_file.read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])['counters'] == stats['counters']
@@ -2,6 +2,7 @@ import json
 from typing import Union
 from pygit2 import Repository, Oid
 from git_ai.cmd.constants import AIRepoConstants
+from git_ai.metrics.series import read_series_values
 
 from git_ai.test.utils.data_gen import Metric, Plot
 
@@ -34,9 +35,12 @@ class AIRepoRead:
             commit_oid = data_commit
         commit = self.repo.get(commit_oid)
         plots_folder = commit.tree / AIRepoConstants.METRICS_PATH    # type: ignore
-        return {
-            f.name.removesuffix('_header'):
-            Plot.from_json(
-                json.loads(f.data),
-                json.loads(plots_folder[f.name.removesuffix('_header')].data))
-            for f in plots_folder if f.name.endswith('_header')}
+        plots = {}
+        for f in plots_folder:
+            if not f.name.endswith('_header'):
+                continue
+            name = f.name.removesuffix('_header')
+            header = json.loads(f.data)
+            values = read_series_values(header, plots_folder[name].data)
+            plots[name] = Plot.from_json(header, {'values': values})
+        return plots
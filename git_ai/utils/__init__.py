@@ -1 +1 @@
-from .utils import list_path
+from .utils import list_path, file_lock
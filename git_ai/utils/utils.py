@@ -1,4 +1,5 @@
 import os
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Union
 
@@ -12,3 +13,42 @@ def list_path(path: Union[str, Path]) -> list[Union[str, Path]]:
             f.extend([os.path.join(dirpath, f) for f in filenames])
 
         return f
+
+
+if os.name == 'nt':
+    import msvcrt
+
+    def _lock(fd: int):
+        # Locks the first byte, LK_LOCK gives up after 10 seconds
+        while True:
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def _unlock(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(filename: Union[str, Path]):
+    """Holds an exclusive lock on a file, shared by every process."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        _lock(f.fileno())
+        try:
+            yield
+        finally:
+            _unlock(f.fileno())
+
@@ -22,12 +22,13 @@ setuptools.setup(
         'console_scripts': ['git-ai=git_ai.main.main:main'],
     },
     install_requires=[
-        'tensorboard',
-        'torch',
         'pygit2>=1.4.1',
         'paramiko',
         'prompt_toolkit'
     ],
+    extras_require={
+        'tensorboard': ['tensorboard', 'torch'],
+    },
     packages=setuptools.find_packages(),
     python_requires=">=3.10",
 )